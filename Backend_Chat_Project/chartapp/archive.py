@@ -0,0 +1,309 @@
+"""
+Cold storage for old messages.
+
+Messages older than ``CHAT_ARCHIVE['AGE_DAYS']`` are moved, oldest seq
+first, out of the message table into per-conversation segment files under
+``CHAT_ARCHIVE['ROOT']``. A segment is an append-only run of blocks; a
+block is a zlib-compressed msgpack list of up to ``BLOCK_SIZE`` messages.
+``ArchiveBlock`` rows are the offset index, and ``Conversation.archived_seq``
+marks where the hot table begins.
+
+A block is appended to its segment file first; its index row, the delete
+of its hot rows and the ``archived_seq`` bump then commit together. Bytes
+past the last committed block are garbage from an interrupted run and are
+truncated before the next append, so archiving can be stopped and resumed
+at any point.
+"""
+import mmap
+import os
+import shutil
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import msgpack
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+# the columns of an archived message; rows read back look like Message.objects.values() rows
+FIELDS = ('id', 'seq', 'sender_id', 'content', 'timestamp')
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def encode_block(rows, level=6):
+    packed = [
+        [row['id'], row['seq'], row['sender_id'], row['content'],
+         (row['timestamp'] - EPOCH) // timedelta(microseconds=1)]
+        for row in rows
+    ]
+    return zlib.compress(msgpack.packb(packed, use_bin_type=True), level)
+
+
+def decode_block(data):
+    return [
+        {
+            'id': message_id,
+            'seq': seq,
+            'sender_id': sender_id,
+            'content': content,
+            'timestamp': EPOCH + timedelta(microseconds=micros),
+        }
+        for message_id, seq, sender_id, content, micros in msgpack.unpackb(zlib.decompress(data), raw=False)
+    ]
+
+
+class SegmentMap:
+    """One segment file mapped into memory, closed once it is retired and no reader is slicing it."""
+    __slots__ = ('file', 'map', 'readers', 'retired')
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.readers = 0
+        self.retired = False
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SegmentStore:
+    """
+    Segment files on local disk, read through a small cache of memory maps.
+    Request threads and the database pool read concurrently: the cache is
+    guarded by a lock, and a map evicted while another thread slices it is
+    closed by the last reader.
+    """
+
+    def __init__(self, root, max_open=64):
+        self.root = str(root)
+        self.max_open = max_open
+        self._maps = OrderedDict()  # path -> SegmentMap
+        self._lock = threading.Lock()
+
+    def path(self, conversation_id, segment):
+        return os.path.join(self.root, str(conversation_id), segment)
+
+    def append(self, conversation_id, segment, committed_end, data):
+        """Write ``data`` right after the last committed block; returns its offset."""
+        path = self.path(conversation_id, segment)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            self._forget(path)
+        with open(path, 'ab+') as segment_file:
+            # drop whatever an interrupted run left after the last committed block
+            segment_file.truncate(committed_end)
+            segment_file.seek(committed_end)
+            segment_file.write(data)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        return committed_end
+
+    def read(self, conversation_id, segment, offset, length):
+        path = self.path(conversation_id, segment)
+        with self._lock:
+            mapped = self._maps.get(path)
+            if mapped is None or offset + length > len(mapped.map):
+                # segments only grow; a map made before the last append is too short
+                self._forget(path)
+                mapped = self._maps[path] = SegmentMap(path)
+                if len(self._maps) > self.max_open:
+                    self._forget(next(iter(self._maps)))
+            else:
+                self._maps.move_to_end(path)
+            mapped.readers += 1
+        try:
+            return mapped.map[offset:offset + length]
+        finally:
+            with self._lock:
+                mapped.readers -= 1
+                if mapped.retired and not mapped.readers:
+                    mapped.close()
+
+    def discard(self, conversation_id):
+        prefix = os.path.join(self.root, str(conversation_id)) + os.sep
+        with self._lock:
+            for path in [path for path in self._maps if path.startswith(prefix)]:
+                self._forget(path)
+        shutil.rmtree(os.path.join(self.root, str(conversation_id)), ignore_errors=True)
+
+    def _forget(self, path):
+        # called with the lock held
+        mapped = self._maps.pop(path, None)
+        if mapped is not None:
+            mapped.retired = True
+            if not mapped.readers:
+                mapped.close()
+
+
+_store = None
+
+
+def get_options():
+    options = getattr(settings, 'CHAT_ARCHIVE', {})
+    return {
+        'ROOT': options.get('ROOT', os.path.join(settings.BASE_DIR, 'message_archive')),
+        'AGE_DAYS': options.get('AGE_DAYS', 180),
+        'BLOCK_SIZE': options.get('BLOCK_SIZE', 256),
+        'SEGMENT_BYTES': options.get('SEGMENT_BYTES', 64 * 1024 * 1024),
+        'COMPRESSION_LEVEL': options.get('COMPRESSION_LEVEL', 6),
+    }
+
+
+def get_segment_store():
+    global _store
+    if _store is None:
+        _store = SegmentStore(get_options()['ROOT'])
+    return _store
+
+
+@receiver(setting_changed)
+def reset_segment_store(setting, **kwargs):
+    global _store
+    if setting == 'CHAT_ARCHIVE':
+        _store = None
+
+
+def archive_conversation(conversation_id, cutoff, max_blocks=None):
+    """
+    Move the conversation's messages older than ``cutoff`` into its
+    segments, a block at a time, stopping at the first message that is
+    too new so the archive stays a seq prefix of the history. Returns the
+    number of messages archived.
+    """
+    from .models import ArchiveBlock, Conversation, Message
+    options = get_options()
+    store = get_segment_store()
+    archived = blocks = 0
+
+    while max_blocks is None or blocks < max_blocks:
+        archived_seq = Conversation.objects.filter(id=conversation_id).values_list('archived_seq', flat=True).first()
+        if archived_seq is None:
+            break
+        candidates = list(
+            Message.objects
+            .filter(conversation_id=conversation_id, seq__gt=archived_seq)
+            .order_by('seq')
+            .values(*FIELDS)[:options['BLOCK_SIZE']]
+        )
+        rows = []
+        for row in candidates:
+            if row['timestamp'] >= cutoff:
+                break
+            rows.append(row)
+        if not rows:
+            break
+
+        last_block = ArchiveBlock.objects.filter(conversation_id=conversation_id).order_by('-last_seq').first()
+        if last_block is None or last_block.offset + last_block.length >= options['SEGMENT_BYTES']:
+            segment, committed_end = f'{rows[0]["seq"]:012d}.seg', 0
+        else:
+            segment, committed_end = last_block.segment, last_block.offset + last_block.length
+
+        data = encode_block(rows, options['COMPRESSION_LEVEL'])
+        offset = store.append(conversation_id, segment, committed_end, data)
+        with transaction.atomic():
+            ArchiveBlock.objects.create(
+                conversation_id=conversation_id,
+                segment=segment,
+                offset=offset,
+                length=len(data),
+                message_count=len(rows),
+                first_seq=rows[0]['seq'],
+                last_seq=rows[-1]['seq'],
+                min_id=min(row['id'] for row in rows),
+                max_id=max(row['id'] for row in rows),
+                min_timestamp=min(row['timestamp'] for row in rows),
+                max_timestamp=max(row['timestamp'] for row in rows),
+            )
+            # a raw delete: no per-row post_delete, so the inbox does not treat
+            # archival as users deleting their messages
+            Message.objects.filter(id__in=[row['id'] for row in rows])._raw_delete(Message.objects.db)
+            Conversation.objects.filter(id=conversation_id).update(archived_seq=rows[-1]['seq'])
+        archived += len(rows)
+        blocks += 1
+    return archived
+
+
+def archive_old_messages(age_days=None, conversation_ids=None, max_blocks=None):
+    """Archive every conversation (or the given ones); returns {conversation_id: messages archived}."""
+    from .models import Message
+    if age_days is None:
+        age_days = get_options()['AGE_DAYS']
+    cutoff = timezone.now() - timedelta(days=age_days)
+    if conversation_ids is None:
+        conversation_ids = (Message.objects.filter(timestamp__lt=cutoff)
+                            .order_by('conversation_id').values_list('conversation_id', flat=True).distinct())
+    results = {}
+    for conversation_id in conversation_ids:
+        count = archive_conversation(conversation_id, cutoff, max_blocks)
+        if count:
+            results[conversation_id] = count
+    return results
+
+
+def read_block(block):
+    return decode_block(get_segment_store().read(block.conversation_id, block.segment, block.offset, block.length))
+
+
+def read_page(conversation_id, cursor, newer, limit, rows):
+    """
+    Merge archived messages into a keyset page. ``rows`` are the hot rows
+    already fetched past ``cursor`` (a ``(timestamp, id)`` list or None for
+    the newest page) in page order; returns up to ``limit`` rows in the
+    same order. Blocks are read until none can hold a row that would make
+    the cut.
+    """
+    from .models import ArchiveBlock
+
+    def key(row):
+        return (row['timestamp'], row['id'])
+
+    blocks = ArchiveBlock.objects.filter(conversation_id=conversation_id)
+    if newer:
+        if cursor is not None:
+            blocks = blocks.filter(max_timestamp__gte=cursor[0])
+        blocks = blocks.order_by('first_seq')
+    else:
+        if cursor is not None:
+            blocks = blocks.filter(min_timestamp__lte=cursor[0])
+        blocks = blocks.order_by('-first_seq')
+
+    merged = list(rows)
+    for block in blocks.iterator(chunk_size=16):
+        if len(merged) >= limit:
+            boundary = merged[limit - 1]['timestamp']
+            if (newer and block.min_timestamp > boundary) or (not newer and block.max_timestamp < boundary):
+                break
+        for row in read_block(block):
+            if cursor is None or (key(row) > tuple(cursor) if newer else key(row) < tuple(cursor)):
+                merged.append(row)
+        merged.sort(key=key, reverse=not newer)
+    return merged[:limit]
+
+
+def read_after_seq(conversation_id, since, limit):
+    """Archived messages with seq > ``since``, in seq order (for delta sync)."""
+    from .models import ArchiveBlock
+    found = []
+    blocks = ArchiveBlock.objects.filter(conversation_id=conversation_id, last_seq__gt=since).order_by('first_seq')
+    for block in blocks.iterator(chunk_size=16):
+        found.extend(row for row in read_block(block) if row['seq'] > since)
+        if len(found) >= limit:
+            break
+    return found[:limit]
+
+
+def get_message(conversation_id, message_id):
+    """An archived message as a values() row, or None."""
+    from .models import ArchiveBlock
+    for block in ArchiveBlock.objects.filter(conversation_id=conversation_id,
+                                             min_id__lte=message_id, max_id__gte=message_id):
+        for row in read_block(block):
+            if row['id'] == message_id:
+                return row
+    return None
@@ -0,0 +1,653 @@
+"""
+In-process load generator for the chat WebSocket consumers.
+
+Sockets are Channels ``WebsocketCommunicator`` instances driving
+``chat_system.asgi.application`` directly, so the numbers cover the
+consumer, the channel layer and the database, not a network stack. Run it
+through ``manage.py chat_benchmark``, which creates a throwaway test
+database first (``test_databases``).
+"""
+import asyncio
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from contextlib import ExitStack, contextmanager
+
+import django
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import get_runner, override_settings
+
+BENCH_PREFIX = 'bench '
+
+
+def percentiles(samples):
+    """p50/p95/p99/max of latencies in seconds, reported in milliseconds."""
+    if not samples:
+        return {'count': 0, 'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None}
+    ordered = sorted(samples)
+
+    def rank(fraction):
+        # nearest-rank percentile
+        index = max(0, math.ceil(fraction * len(ordered)) - 1)
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'p50_ms': rank(0.50),
+        'p95_ms': rank(0.95),
+        'p99_ms': rank(0.99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+class ExecuteWrapper:
+    """A wrapper for every query on every connection, including ones opened while it is active."""
+
+    def __call__(self, execute, sql, params, many, context):
+        return execute(sql, params, many, context)
+
+    def install(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    @contextmanager
+    def active(self):
+        def on_connection_created(sender, connection, **kwargs):
+            self.install(connection)
+
+        for connection in connections.all(initialized_only=True):
+            self.install(connection)
+        connection_created.connect(on_connection_created, weak=False)
+        try:
+            yield self
+        finally:
+            connection_created.disconnect(on_connection_created)
+            for connection in connections.all(initialized_only=True):
+                if self in connection.execute_wrappers:
+                    connection.execute_wrappers.remove(self)
+
+
+class QueryCounter(ExecuteWrapper):
+    """Counts SQL statements on every connection, including sync_to_async threads."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class QueryDelay(ExecuteWrapper):
+    """
+    Sleeps before each query, like the round trip to a database server
+    (SQLite has none). Queries inside transactions are not delayed: on
+    SQLite they would hold the database-wide write lock while sleeping,
+    where a server database only locks the rows involved.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, execute, sql, params, many, context):
+        if not context['connection'].in_atomic_block:
+            time.sleep(self.seconds)
+        return execute(sql, params, many, context)
+
+
+class Recorder:
+    """Send times of benchmark messages and the latencies their deliveries saw."""
+
+    def __init__(self):
+        self.sent_at = {}
+        self.latencies = []
+        self.deliveries = 0
+        self.typing_events = 0
+        self.presence_events = 0
+        self.delivered = asyncio.Event()
+        self.expected = 0
+
+    def expect(self, deliveries):
+        self.expected += deliveries
+        self.delivered.clear()
+
+    def frame(self, client, frame, received_at):
+        frame_type = frame.get('type')
+        if frame_type == 'chat_message':
+            content = frame.get('message') or ''
+            if not content.startswith(BENCH_PREFIX) or frame['user']['id'] == client.user_id:
+                return
+            sent_at = self.sent_at.get(content)
+            if sent_at is not None:
+                self.latencies.append(received_at - sent_at)
+            self.deliveries += 1
+            if self.deliveries >= self.expected:
+                self.delivered.set()
+        elif frame_type == 'typing':
+            self.typing_events += 1
+        elif frame_type == 'online_status':
+            self.presence_events += 1
+
+
+class Client:
+    """One socket of one user in one conversation, with a task reading every frame it gets."""
+
+    def __init__(self, application, user_id, token, conversation_id, recorder):
+        from channels.testing import WebsocketCommunicator
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.recorder = recorder
+        self.communicator = WebsocketCommunicator(
+            application, f'/ws/chat/{conversation_id}/?token={token}'
+        )
+        self.reader = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f'User {self.user_id} could not join conversation {self.conversation_id}')
+        self.reader = asyncio.get_running_loop().create_task(self._read())
+
+    async def send(self, payload):
+        await self.communicator.send_to(text_data=json.dumps(payload))
+
+    async def disconnect(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.communicator.disconnect(timeout=30)
+
+    async def _read(self):
+        # reading the queue directly: communicator.receive_output() kills the app on timeout
+        queue = self.communicator.output_queue
+        while True:
+            message = await queue.get()
+            if message['type'] != 'websocket.send':
+                return
+            if message.get('text') is not None:
+                self.recorder.frame(self, json.loads(message['text']), time.perf_counter())
+
+
+class ChatBenchmark:
+    """
+    Scenarios, run in order on one set of users: ``connect_storm`` opens
+    every socket at once, ``chat_traffic`` sends messages across all
+    conversations, ``typing_bursts`` sends keystroke frames back to back,
+    and ``disconnect_storm`` closes every socket at once. Each conversation
+    has two participants with one socket each.
+
+    With ``abusers``, ``chat_traffic_under_abuse`` repeats the chat traffic
+    while that many extra sockets each flood about ``abuse_rate`` chat and
+    typing frames per second (reconnecting whenever they are closed), so its
+    latency can be compared with ``chat_traffic``. The flooding clients run
+    in the same process, so their own cost is part of what is measured.
+    """
+
+    def __init__(self, conversations=100, messages=2000, rate=100, typing_frames=20, abusers=0,
+                 abuse_rate=1000, delivery_timeout=60):
+        self.conversation_count = conversations
+        self.message_count = messages
+        self.rate = rate
+        self.typing_frames = typing_frames
+        self.abuser_count = abusers
+        self.abuse_rate = abuse_rate
+        self.delivery_timeout = delivery_timeout
+        self.clients = []
+        self.recorder = None
+
+    def setup(self):
+        # runs outside the event loop: plain ORM calls
+        from django.contrib.auth.models import User
+        from rest_framework_simplejwt.tokens import AccessToken
+        from .models import Conversation
+
+        users = User.objects.bulk_create([
+            User(username=f'bench_{index}') for index in range((self.conversation_count + self.abuser_count) * 2)
+        ])
+        self.members = []
+        for index in range(self.conversation_count + self.abuser_count):
+            pair = users[index * 2:index * 2 + 2]
+            conversation, _ = Conversation.objects.get_or_create_for_participants(pair)
+            self.members.append((conversation.id, [(user.id, str(AccessToken.for_user(user))) for user in pair]))
+        # abusers get conversations of their own; only their first member connects
+        self.members, self.abuser_members = self.members[:self.conversation_count], self.members[self.conversation_count:]
+
+    async def run(self):
+        from chat_system.asgi import application
+        from .lifespan import run_shutdown_callbacks
+
+        self.application = application
+        self.recorder = Recorder()
+        self.clients = [
+            Client(application, user_id, token, conversation_id, self.recorder)
+            for conversation_id, members in self.members
+            for user_id, token in members
+        ]
+        results = {}
+        scenarios = ['connect_storm', 'chat_traffic', 'typing_bursts', 'disconnect_storm']
+        if self.abuser_count:
+            scenarios.insert(2, 'chat_traffic_under_abuse')
+        counter = QueryCounter()
+        with counter.active():
+            for name in scenarios:
+                counter.count = 0
+                started = time.perf_counter()
+                results[name] = await getattr(self, name)()
+                results[name]['duration_s'] = round(time.perf_counter() - started, 4)
+                results[name]['db_queries'] = counter.count
+            results['chat_traffic']['db_queries_per_message'] = round(
+                results['chat_traffic']['db_queries'] / max(self.message_count, 1), 3
+            )
+        await run_shutdown_callbacks()
+        return results
+
+    async def connect_storm(self):
+        latencies = []
+
+        async def connect(client):
+            started = time.perf_counter()
+            await client.connect()
+            latencies.append(time.perf_counter() - started)
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        await asyncio.gather(*(connect(client) for client in self.clients))
+        elapsed = time.perf_counter() - started
+        # let join snapshots and presence diffs settle before measuring
+        await asyncio.sleep(0.5)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return {
+            'connections': len(self.clients),
+            'connections_per_s': round(len(self.clients) / elapsed, 1),
+            'connect_latency': percentiles(latencies),
+            'memory_per_connection_bytes': int((after - before) / max(len(self.clients), 1)),
+            'note': 'tracemalloc is on during this scenario, which slows it down',
+        }
+
+    async def chat_traffic(self):
+        recorder = self.recorder
+        # every message is delivered to the one other participant of its conversation
+        recorder.expect(self.message_count)
+        interval = 1 / self.rate if self.rate else 0
+        started = time.perf_counter()
+        for number in range(self.message_count):
+            client = self.clients[number % len(self.clients)]
+            content = f'{BENCH_PREFIX}{number}'
+            recorder.sent_at[content] = time.perf_counter()
+            await client.send({'type': 'chat_message', 'message': content})
+            if interval:
+                await asyncio.sleep(max(0, started + (number + 1) * interval - time.perf_counter()))
+            elif number % 50 == 49:
+                await asyncio.sleep(0)
+        sent = time.perf_counter() - started
+        try:
+            await asyncio.wait_for(recorder.delivered.wait(), self.delivery_timeout)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - started
+        return {
+            'messages': self.message_count,
+            'delivered': recorder.deliveries,
+            'send_rate_per_s': round(self.message_count / sent, 1) if sent else None,
+            'throughput_per_s': round(recorder.deliveries / elapsed, 1),
+            'latency': percentiles(recorder.latencies),
+        }
+
+    async def chat_traffic_under_abuse(self):
+        from . import metrics
+        stop = asyncio.Event()
+        abuse = {'frames': 0, 'connections': 0}
+        rate_limited = sum(metrics.ws_rate_limited._merged().values())
+        floods = [
+            asyncio.get_running_loop().create_task(self.flood(conversation_id, *members[0], stop, abuse))
+            for conversation_id, members in self.abuser_members
+        ]
+        # let the floods reach their rate limits first
+        await asyncio.sleep(0.5)
+        recorder = self.recorder
+        recorder.latencies = []
+        recorder.deliveries = 0
+        recorder.expected = 0
+        try:
+            results = await self.chat_traffic()
+        finally:
+            stop.set()
+            await asyncio.gather(*floods)
+        results.update({
+            'abusers': self.abuser_count,
+            'abuse_rate_per_socket': self.abuse_rate,
+            'abuse_frames': abuse['frames'],
+            'abuse_connections': abuse['connections'],
+            'frames_rate_limited': sum(metrics.ws_rate_limited._merged().values()) - rate_limited,
+        })
+        return results
+
+    async def flood(self, conversation_id, user_id, token, stop, abuse):
+        while not stop.is_set():
+            client = Client(self.application, user_id, token, conversation_id, self.recorder)
+            await client.connect()
+            abuse['connections'] += 1
+            # the reader ends when the server closes the socket
+            while not stop.is_set() and not client.reader.done():
+                for _ in range(10):
+                    await client.send({'type': 'chat_message', 'message': 'flood'})
+                    await client.send({'type': 'typing'})
+                abuse['frames'] += 20
+                await asyncio.sleep(20 / self.abuse_rate)
+            await client.disconnect()
+
+    async def typing_bursts(self):
+        recorder = self.recorder
+        recorder.typing_events = 0
+        frames = 0
+        for client in self.clients[::2]:
+            for _ in range(self.typing_frames):
+                await client.send({'type': 'typing'})
+                frames += 1
+        # the tracker sends "started" at once and "stopped" after its timeout; count the starts
+        await asyncio.sleep(0.5)
+        return {
+            'typing_frames': frames,
+            'typing_events_delivered': recorder.typing_events,
+            'events_per_frame': round(recorder.typing_events / max(frames, 1), 4),
+        }
+
+    async def disconnect_storm(self):
+        latencies = []
+
+        async def disconnect(client):
+            started = time.perf_counter()
+            await client.disconnect()
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(disconnect(client) for client in self.clients))
+        elapsed = time.perf_counter() - started
+        return {
+            'disconnections': len(self.clients),
+            'disconnections_per_s': round(len(self.clients) / elapsed, 1),
+            'disconnect_latency': percentiles(latencies),
+        }
+
+
+class DataAccessBenchmark:
+    """
+    The database work of a socket: ``join`` looks up its user, its
+    conversation and members and the messages to replay; ``send`` stores a
+    message. ``sockets`` units run at once, ``rounds`` times, on each
+    ``CHAT_DB_EXECUTOR`` mode in turn, so the native async ORM and the
+    thread pool can be compared with the old ``sync_to_async`` wrappers.
+
+    With SQLite a query is mostly ORM work holding the GIL, which no
+    thread pool speeds up; ``db_latency_ms`` adds a sleep per query to
+    stand in for the network round trip of a database server.
+    """
+
+    def __init__(self, sockets=1000, rounds=3, workers=16, modes=None, db_latency_ms=0):
+        from . import data
+        self.db_latency_ms = db_latency_ms
+        self.sockets = sockets
+        self.rounds = rounds
+        self.workers = workers
+        self.modes = modes or data.MODES
+
+    def setup(self):
+        from django.contrib.auth.models import User
+        from .models import Conversation
+        users = User.objects.bulk_create([User(username=f'bench_db_{index}') for index in range(100)])
+        self.users = {user.id: user for user in users}
+        self.members = []
+        for index in range(0, len(users), 2):
+            conversation, _ = Conversation.objects.get_or_create_for_participants(users[index:index + 2])
+            self.members.append((conversation.id, users[index].id))
+
+    async def join(self, number):
+        # the lookups of a connect or subscribe, plus a resume replay
+        from . import data
+        conversation_id, user_id = self.members[number % len(self.members)]
+        await data.get_user(user_id)
+        conversation, _ = await data.get_conversation_members(conversation_id)
+        await data.get_messages_after(conversation_id, max(conversation.last_seq - 20, 0), 50)
+
+    async def send(self, number):
+        from . import data
+        conversation_id, user_id = self.members[number % len(self.members)]
+        conversation, _ = await data.get_conversation_members(conversation_id)
+        await data.create_message(conversation, self.users[user_id], f'{BENCH_PREFIX}db {number}')
+
+    async def phase(self, unit):
+        latencies = []
+
+        async def timed(number):
+            started = time.perf_counter()
+            await unit(number)
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for _ in range(self.rounds):
+            await asyncio.gather(*(timed(number) for number in range(self.sockets)))
+        elapsed = time.perf_counter() - started
+        return {
+            'units': len(latencies),
+            'units_per_s': round(len(latencies) / elapsed, 1),
+            'latency': percentiles(latencies),
+        }
+
+    async def run_mode(self):
+        return {'join': await self.phase(self.join), 'send': await self.phase(self.send)}
+
+    def run(self):
+        results = {}
+        with ExitStack() as stack:
+            if self.db_latency_ms:
+                stack.enter_context(QueryDelay(self.db_latency_ms / 1000).active())
+            for mode in self.modes:
+                with override_settings(CHAT_DB_EXECUTOR={'MODE': mode, 'MAX_WORKERS': self.workers}):
+                    results[mode] = asyncio.run(self.run_mode())
+        return results
+
+
+class GroupRecorder(Recorder):
+    """A ``Recorder`` that also notes when each message reached its last recipient."""
+
+    def __init__(self):
+        super().__init__()
+        self.completed_at = {}  # content -> latest delivery time
+
+    def frame(self, client, frame, received_at):
+        super().frame(client, frame, received_at)
+        if frame.get('type') == 'chat_message' and frame['user']['id'] != client.user_id:
+            self.completed_at[frame.get('message')] = received_at
+
+
+class GroupFanoutBenchmark:
+    """
+    One group conversation of ``members`` users, every member online with
+    one socket in this process. ``messages`` are sent one after the other
+    by different members, and each is timed until every other member has
+    received it (``all_delivered``) as well as per delivery. The group is
+    joined and the messages sent once per ``CHAT_FANOUT`` strategy, so the
+    per-worker relay can be compared with one group member per socket.
+    ``InMemoryChannelLayer`` sweeps every channel on each receive, which
+    makes the ``group`` strategy slower still at this size than on Redis.
+    """
+
+    def __init__(self, members=5000, messages=20, strategies=None, connect_batch=500, delivery_timeout=60):
+        from .fanout import STRATEGIES
+        self.member_count = members
+        self.message_count = messages
+        self.strategies = strategies or STRATEGIES
+        self.connect_batch = connect_batch
+        self.delivery_timeout = delivery_timeout
+
+    def setup(self):
+        from django.contrib.auth.models import User
+        from rest_framework_simplejwt.tokens import AccessToken
+        from .models import Conversation
+
+        users = User.objects.bulk_create([User(username=f'bench_group_{index}') for index in range(self.member_count)])
+        conversation = Conversation.objects.create_group(f'{BENCH_PREFIX}group', users[0], users)
+        self.conversation_id = conversation.id
+        self.members = [(user.id, str(AccessToken.for_user(user))) for user in users]
+
+    async def run_strategy(self):
+        from chat_system.asgi import application
+        from .lifespan import run_shutdown_callbacks
+
+        recorder = GroupRecorder()
+        clients = [Client(application, user_id, token, self.conversation_id, recorder)
+                   for user_id, token in self.members]
+        started = time.perf_counter()
+        for index in range(0, len(clients), self.connect_batch):
+            await asyncio.gather(*(client.connect() for client in clients[index:index + self.connect_batch]))
+        connected = time.perf_counter() - started
+        # let the presence diffs of the join settle
+        await asyncio.sleep(1)
+
+        completions = []
+        undelivered = 0
+        started = time.perf_counter()
+        for number in range(self.message_count):
+            # a different sender each time, so no socket reaches its rate limit
+            client = clients[number * len(clients) // max(self.message_count, 1)]
+            content = f'{BENCH_PREFIX}{number}'
+            recorder.expect(len(clients) - 1)
+            recorder.sent_at[content] = time.perf_counter()
+            await client.send({'type': 'chat_message', 'message': content})
+            try:
+                await asyncio.wait_for(recorder.delivered.wait(), self.delivery_timeout)
+            except asyncio.TimeoutError:
+                undelivered += recorder.expected - recorder.deliveries
+                recorder.expected = recorder.deliveries
+            if content in recorder.completed_at:
+                completions.append(recorder.completed_at[content] - recorder.sent_at[content])
+        elapsed = time.perf_counter() - started
+
+        await asyncio.gather(*(client.disconnect() for client in clients))
+        await run_shutdown_callbacks()
+        return {
+            'members_online': len(clients),
+            'connect_s': round(connected, 4),
+            'messages': self.message_count,
+            'deliveries': recorder.deliveries,
+            'undelivered': undelivered,
+            'deliveries_per_s': round(recorder.deliveries / elapsed, 1),
+            'all_delivered': percentiles(completions),
+            'latency': percentiles(recorder.latencies),
+            'presence_events': recorder.presence_events,
+        }
+
+    def run(self):
+        results = {}
+        for strategy in self.strategies:
+            with override_settings(CHAT_FANOUT={'STRATEGY': strategy}):
+                results[strategy] = asyncio.run(self.run_strategy())
+        return results
+
+
+@contextmanager
+def test_databases():
+    """
+    The databases a test run would use, created for the benchmark and
+    dropped afterwards. SQLite gets a temporary file instead of the usual
+    in-memory database, where concurrent writers from the data access pool
+    fail with "table is locked" instead of waiting for each other.
+    """
+    directory = tempfile.mkdtemp()
+    for connection in connections.all():
+        test_settings = connection.settings_dict['TEST']
+        if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+            test_settings['NAME'] = os.path.join(directory, f'{connection.alias}.sqlite3')
+    runner = get_runner(settings)(verbosity=0, interactive=False)
+    old_config = runner.setup_databases()
+    try:
+        yield
+    finally:
+        runner.teardown_databases(old_config)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def describe_environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connections['default'].vendor,
+    }
+
+
+def benchmark_channel_layers(layer):
+    """
+    ``layer`` is ``memory`` (``InMemoryChannelLayer``) or ``redis`` (the
+    configured ``CHANNEL_LAYERS``, e.g. a local Redis).
+    """
+    if layer == 'memory':
+        return {'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {'capacity': 100000},
+        }}
+    return settings.CHANNEL_LAYERS
+
+
+def run_benchmark(layer='memory', persistence='sync', **options):
+    """Run every scenario and return the results as a JSON-ready dict."""
+    channel_layers = benchmark_channel_layers(layer)
+    benchmark = ChatBenchmark(**options)
+    with override_settings(CHANNEL_LAYERS=channel_layers, CHAT_MESSAGE_PERSISTENCE=persistence):
+        benchmark.setup()
+        results = asyncio.run(benchmark.run())
+    return {
+        'environment': describe_environment(),
+        'parameters': dict(options, layer=layer, persistence=persistence),
+        'scenarios': results,
+    }
+
+
+def run_data_access_benchmark(**options):
+    """Compare the CHAT_DB_EXECUTOR modes; returns a JSON-ready dict."""
+    benchmark = DataAccessBenchmark(**options)
+    benchmark.setup()
+    return {
+        'environment': describe_environment(),
+        'parameters': {
+            'sockets': benchmark.sockets,
+            'rounds': benchmark.rounds,
+            'workers': benchmark.workers,
+            'modes': list(benchmark.modes),
+            'db_latency_ms': benchmark.db_latency_ms,
+        },
+        'modes': benchmark.run(),
+    }
+
+
+def run_group_benchmark(layer='memory', **options):
+    """Deliver messages to every member of one large group; returns a JSON-ready dict."""
+    benchmark = GroupFanoutBenchmark(**options)
+    with override_settings(CHANNEL_LAYERS=benchmark_channel_layers(layer)):
+        benchmark.setup()
+        results = benchmark.run()
+    return {
+        'environment': describe_environment(),
+        'parameters': {
+            'members': benchmark.member_count,
+            'messages': benchmark.message_count,
+            'strategies': list(benchmark.strategies),
+            'layer': layer,
+        },
+        'strategies': results,
+    }
@@ -1,189 +1,561 @@
-from asgiref.sync import sync_to_async
-import json 
-import jwt 
+import logging
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 
-from django.conf import settings
 from urllib.parse import parse_qs
 
+from . import data, flow_control, metrics
+from .fanout import get_fanout
+from .membership import get_member_cache
+from .persistence import get_message_writer, write_behind_enabled
+from .presence import get_presence_broadcaster, get_presence_registry
+from .receipts import get_receipt_buffer
+from .typing_indicators import get_typing_tracker
+from .wire import MalformedFrame, decode_frame, frame_cache, negotiate, new_event_id
 
+logger = logging.getLogger(__name__)
 
-class ChatConsumer(AsyncWebsocketConsumer):
 
-    async def connect(self):
-        query_string = self.scope['query_string'].decode('utf-8')
-        params = parse_qs(query_string)
-        token = params.get('token', [None])[0] # token retrieved
+# frame types clients send; anything else is counted as 'other' to keep metric labels bounded
+CLIENT_FRAME_TYPES = frozenset(['chat_message', 'typing', 'ack', 'heartbeat', 'subscribe', 'unsubscribe'])
 
-        if token:
-            try:
-                decoded_data = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-                self.user = await self.get_user(decoded_data['user_id']) #get the user from the token
-                self.scope['user'] = self.user
-            except jwt.ExpiredSignatureError:
-                await self.close(code=4000) #close the connection if token is expired
-                return
-            except jwt.InvalidTokenError:
-                await self.close(code=4001) #close the connection if token is invalid
-                return
-        else:
-            await self.close(code=4002) #close the connection if no token is provided
-            return
 
-        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-        self.room_group_name = f'chat_{self.conversation_id}'
+def parse_id(value):
+    """
+    A client-supplied id, seq or watermark: a non-negative integer that fits
+    a database column, or a string of its digits. None for anything else;
+    floats (``3.7``, ``1e400``) and booleans are not ids.
+    """
+    if isinstance(value, str) and value.isascii() and value.isdigit() and len(value) <= 19:
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value < 2 ** 63:
+        return None
+    return value
 
 
-        # Add channel to the  group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+def parse_seq(value):
+    # a client-supplied last_seq; anything that is not a non-negative integer means "no resume"
+    return parse_id(value)
+
+
+class Subscription:
+    """Everything a socket caches about one conversation it has joined."""
+    __slots__ = ('conversation_id', 'conversation', 'members', 'group_name', 'presence_refreshed_at',
+                 'replayed_seq')
+
+    def __init__(self, conversation, members):
+        self.conversation_id = conversation.id
+        self.conversation = conversation
+        # membership.Members, shared by every socket of the process in this conversation
+        self.members = members
+        self.group_name = f'chat_{conversation.id}'
+        self.presence_refreshed_at = 0
+        # live chat_message events up to this seq were already sent by the resume replay
+        self.replayed_seq = 0
+
+
+class BaseChatConsumer(AsyncWebsocketConsumer):
+    """
+    Authentication, conversation membership, presence, typing and message
+    handling shared by the per-conversation and the multiplexed endpoints.
+    Every group event carries its conversation id so one socket can be
+    joined to many conversations, and so the fan-out relay
+    (``chartapp.fanout``) can find a conversation's sockets.
 
-        # accept websocket connections
-        await self.accept()
-
-        user_data = await self.get_user_data(self.user)
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'online_status',
-                'online_users': [user_data],
-                'status': 'online',
-            }
+    Frames are JSON text unless the client negotiates the ``chat.msgpack``
+    subprotocol, in which case the server sends MessagePack binary frames.
+    Group events carry an ``event_id`` so each worker encodes an event once
+    per codec and reuses the bytes for every recipient socket.
+
+    Messages carry their per-conversation ``seq``. A client that reconnects
+    with the last seq it saw gets the missed messages replayed from the
+    database before live events, or ``resync_required`` when it missed more
+    than ``max_replay`` (it should then page through the REST delta view).
+
+    Client frames are rate limited per socket and per user (see
+    ``chartapp.flow_control``): over-limit typing frames are dropped
+    silently, others get one ``error`` frame (code 4008) per run of dropped
+    frames, and a socket that keeps going is closed with 4008. Outbound
+    frames go through a bounded buffer; a client too slow to keep up with
+    its chat messages is closed with 4009 and resumes with ``last_seq``.
+    A frame that is not a JSON or MessagePack map is answered with an
+    ``error`` frame (code 4005) and counts against the 'other' limit. A
+    field of the wrong type gets 4005 as well: a ``message`` that is not a
+    non-empty string of at most ``max_message_length`` characters, or an id
+    that is not an integer.
+    """
+    max_replay = 500
+    max_message_length = 10000
+
+    async def authenticate(self):
+        # self.user comes from the ?token= JWT, verified by ws_auth.JWTAuthMiddleware;
+        # otherwise the socket is closed with its code (4000 expired, 4001 invalid, 4002 missing)
+        self.user = self.scope.get('user')
+        if self.user is None or not self.user.is_authenticated:
+            code = self.scope.get('auth_close_code') or 4002
+            metrics.ws_auth_failures.inc(code=code)
+            await self.close(code=code)
+            return False
+
+        from .serializers import UserListSerializer
+        self.user_data = UserListSerializer(self.user).data
+        self.subscriptions = {}
+        self.flow_options = flow_control.get_options()
+        self.limiter = flow_control.FrameLimiter(
+            self.user.id, flow_control.get_user_buckets(), self.flow_options['LIMITS'],
+            self.flow_options['DISCONNECT_AFTER'], self.flow_options['DISCONNECT_WINDOW'],
         )
+        return True
+
+    async def accept_negotiated(self):
+        self.codec, subprotocol = negotiate(self.scope.get('subprotocols', []))
+        await self.accept(subprotocol=subprotocol)
+        self.outbox = flow_control.OutboundBuffer(self.write_frame, self.flow_options['OUTBOUND_BUFFER'])
+        self.counted_socket = True
+        metrics.ws_active_sockets.inc(consumer=type(self).__name__)
+
+    async def send_frame(self, payload, event_id=None, live=False):
+        # live group events never wait for a slow client; replies and replays do
+        frame = frame_cache.encode(self.codec, payload, event_id)
+        low_priority = flow_control.low_priority(payload)
+        if not live:
+            await self.outbox.put(frame, payload['type'], low_priority)
+        elif not self.outbox.push(frame, payload['type'], low_priority):
+            if self.flow_options['OUTBOUND_OVERFLOW'] == 'drop':
+                metrics.ws_outbound_dropped.inc(type=payload['type'])
+            else:
+                logger.info('Closing socket of user %s: %d frames not read', self.user.id, len(self.outbox))
+                metrics.ws_forced_closes.inc(reason='slow_consumer')
+                await self.close(code=4009)
+
+    async def write_frame(self, frame, frame_type):
+        metrics.ws_frames_sent.inc(type=frame_type)
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def close(self, code=None, reason=None):
+        # frames still queued would be written after the close frame
+        self.closing = True
+        outbox = getattr(self, 'outbox', None)
+        if outbox is not None:
+            outbox.close()
+        await super().close(code=code, reason=reason)
+
+    async def read_frame(self, text_data, bytes_data):
+        # the decoded client frame, or None if it was malformed or refused by the size or rate limits
+        if getattr(self, 'closing', False):
+            return None
+        size = len(bytes_data) if bytes_data is not None else len(text_data or '')
+        if size > self.flow_options['MAX_FRAME_BYTES']:
+            metrics.ws_forced_closes.inc(reason='frame_too_large')
+            await self.close(code=1009)
+            return None
+        try:
+            text_data_json = decode_frame(text_data, bytes_data)
+        except MalformedFrame:
+            # answered below, and counted against the 'other' bucket like any unknown frame
+            text_data_json = None
+        event_type = text_data_json.get('type') if text_data_json is not None else None
+        if not isinstance(event_type, str):
+            event_type = None
+        metrics.ws_frames_received.inc(type=event_type if event_type in CLIENT_FRAME_TYPES else 'other')
+
+        kind = flow_control.frame_kind(event_type)
+        scope = self.limiter.check(kind)
+        if scope is None:
+            if text_data_json is None:
+                await self.send_error(getattr(self, 'conversation_id', None), 4005, 'Malformed frame')
+            return text_data_json
+        metrics.ws_rate_limited.inc(type=kind, scope=scope)
+        if self.limiter.abusive:
+            logger.info('Closing socket of user %s: %d frames over the rate limit', self.user.id,
+                        self.limiter.window_dropped)
+            metrics.ws_forced_closes.inc(reason='rate_limit')
+            await self.close(code=4008)
+        elif kind != 'typing' and self.limiter.dropped == 1:
+            # one notice per run of dropped frames, so the notices cannot be used as an amplifier
+            await self.send_frame({
+                'type': 'error',
+                'conversation': (text_data_json or {}).get('conversation', getattr(self, 'conversation_id', None)),
+                'code': 4008,
+                'detail': 'Rate limit exceeded, frame dropped',
+                'retry_after': round(self.limiter.retry_after(kind), 3),
+            })
+        return None
+
+    async def send_error(self, conversation_id, code, detail):
+        await self.send_frame({
+            'type': 'error',
+            'conversation': conversation_id,
+            'code': code,
+            'detail': detail,
+        })
+
+    async def load_subscription(self, conversation_id):
+        # membership is checked once here; returns a Subscription or a close code
+        conversation, members = await self.get_conversation_members(conversation_id)
+        if conversation is None:
+            return 4004 # the conversation does not exist
+        if self.user.id not in members:
+            return 4003 # the user is not a participant
+        return Subscription(conversation, members)
+
+    async def join(self, subscription, last_seq=None):
+        self.subscriptions[subscription.conversation_id] = subscription
+
+        # Add the socket to the conversation's fan-out (CHAT_FANOUT)
+        await get_fanout().add(self, subscription.conversation_id)
+
+        # the joining socket gets the full online list once; everyone else
+        # only sees a coalesced diff if this user was not already online
+        registry = get_presence_registry()
+        if await registry.join(subscription.conversation_id, self.user_data, self.channel_name):
+            get_presence_broadcaster().publish(self.channel_layer, subscription.conversation_id, self.user_data, 'online')
+        subscription.presence_refreshed_at = time.monotonic()
+        limit = registry.snapshot_limit
+        online_users = await registry.snapshot(subscription.conversation_id, None if limit is None else limit + 1)
+        snapshot = {
+            'type': 'online_status',
+            'status': 'snapshot',
+            'conversation': subscription.conversation_id,
+            'online_users': online_users[:limit],
+        }
+        if limit is not None and len(online_users) > limit:
+            # a large group: the client gets diffs from here on, but not the full list
+            snapshot['truncated'] = True
+        await self.send_frame(snapshot)
+
+        if last_seq is not None:
+            await self.replay(subscription, last_seq)
+
+    async def replay(self, subscription, last_seq):
+        # the socket is already in the group, so anything newer than this query
+        # arrives live; live events the replay already covered are dropped
+        rows = []
+        if last_seq >= subscription.conversation.archived_seq:
+            rows = await self.get_messages_after(subscription.conversation_id, last_seq, self.max_replay + 1)
+        if len(rows) > self.max_replay or last_seq < subscription.conversation.archived_seq:
+            # too far behind, or behind the archive: catch up through the delta view
+            await self.send_frame({
+                'type': 'resync_required',
+                'conversation': subscription.conversation_id,
+                'last_seq': last_seq,
+            })
+            return
+        for row in rows:
+            await self.send_frame({
+                'type': 'chat_message',
+                'conversation': subscription.conversation_id,
+                'id': row['id'],
+                'seq': row['seq'],
+                'message': row['content'],
+                'user': {'id': row['sender_id'], 'username': row['sender__username']},
+                'timestamp': row['timestamp'].isoformat(),
+                'client_id': row['client_id'],
+            })
+        if rows:
+            subscription.replayed_seq = rows[-1]['seq']
+
+    async def leave(self, conversation_id):
+        subscription = self.subscriptions.pop(conversation_id, None)
+        if subscription is None:
+            return
+        await get_typing_tracker().stop(self.channel_layer, conversation_id, self.user.id)
+
+        # notify others only when the user's last socket in the room is gone
+        if await get_presence_registry().leave(conversation_id, self.user.id, self.channel_name):
+            get_presence_broadcaster().publish(self.channel_layer, conversation_id, self.user_data, 'offline')
+
+        # Remove the socket from the conversation's fan-out
+        await get_fanout().discard(self, conversation_id)
 
     async def disconnect(self, close_code):
-        if hasattr(self, 'room_group_name'):
-            # notify others about the disconnect
-            user_data = await self.get_user_data(self.scope["user"])
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'online_status',
-                    'online_users': [user_data],
-                    'status': 'offline',
-                }
-            )
+        if getattr(self, 'counted_socket', False):
+            self.counted_socket = False
+            metrics.ws_active_sockets.dec(consumer=type(self).__name__)
+        if getattr(self, 'outbox', None) is not None:
+            self.outbox.close()
+        if getattr(self, 'limiter', None) is not None:
+            self.limiter.release()
+        for conversation_id in list(getattr(self, 'subscriptions', ())):
+            await self.leave(conversation_id)
 
-            # Remove channel from the group
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+    async def refresh_presence(self):
+        # any inbound frame counts as a heartbeat; talk to the registry at most
+        # a few times per TTL and sweep sockets that stopped heartbeating
+        registry = get_presence_registry()
+        broadcaster = get_presence_broadcaster()
+        now = time.monotonic()
+        for subscription in list(self.subscriptions.values()):
+            if now - subscription.presence_refreshed_at < registry.ttl / 3:
+                continue
+            subscription.presence_refreshed_at = now
+            conversation_id = subscription.conversation_id
+            if await registry.heartbeat(conversation_id, self.user_data, self.channel_name):
+                broadcaster.publish(self.channel_layer, conversation_id, self.user_data, 'online')
+            for user_data in await registry.expire(conversation_id):
+                broadcaster.publish(self.channel_layer, conversation_id, user_data, 'offline')
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        event_type = text_data_json.get('type')
+    async def handle_conversation_event(self, subscription, event_type, text_data_json):
+        conversation_id = subscription.conversation_id
 
         if event_type == 'chat_message':
             message_content = text_data_json.get('message')
-            user_id = text_data_json.get('user')
+            # checked before anything is stored or broadcast: a msgpack client can send any type
+            if not isinstance(message_content, str) or not message_content.strip():
+                await self.send_error(conversation_id, 4005, 'message must be a non-empty string')
+                return
+            if len(message_content) > self.max_message_length:
+                await self.send_error(conversation_id, 4005,
+                                      f'message must be at most {self.max_message_length} characters')
+                return
+            # optional id the client picked for this send; a retry with the same id is not stored twice
+            client_id = text_data_json.get('client_id') or None
+            if client_id is not None and (not isinstance(client_id, str) or len(client_id) > 64):
+                await self.send_error(conversation_id, 4005, 'client_id must be a string of at most 64 characters')
+                return
 
+            # a sent message ends typing; receivers clear the indicator on chat_message
+            await get_typing_tracker().stop(self.channel_layer, conversation_id, self.user.id, notify=False)
             try:
-                user = await self.get_user(user_id)
-                
-                conversation = await self.get_conversation(self.conversation_id)
-                from .serializers import UserListSerializer
-                user_data = UserListSerializer(user).data
-
-                #say message to the group/database
-                message = await self.save_message(conversation, user, message_content)
+                # the sender is the authenticated user, never a client-supplied id
+                if write_behind_enabled() and client_id is None:
+                    # broadcast first, the per-process writer inserts it with the next batch.
+                    # Sends with a client_id are stored first: a retry must be caught before it is broadcast
+                    from .models import Message
+                    message = Message(conversation=subscription.conversation, sender=self.user, content=message_content)
+                else:
+                    #say message to the group/database
+                    message, created = await self.save_message(
+                        subscription.conversation, self.user, message_content, client_id
+                    )
+                    if not created:
+                        # a retry: the others already have it, confirm to this socket only
+                        await self.send_frame(self.message_frame(conversation_id, message))
+                        return
                 #broadcast the message to the group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': message.content,
-                        'user': user_data,
-                        'timestamp': message.timestamp.isoformat(),
-                    }
+                await metrics.group_send(
+                    self.channel_layer,
+                    subscription.group_name,
+                    {**self.message_frame(conversation_id, message), 'event_id': new_event_id()}
                 )
-            except Exception as e:
-                print(f"Error saving message: {e}")
-        
+                if message.pk is None:
+                    await get_message_writer().enqueue(message)
+            except Exception:
+                logger.exception('Error saving message from user %s in conversation %s', self.user.id, conversation_id)
+
         elif event_type == 'typing':
-            try:
-                user_data = await self.get_user_data(self.scope['user'])
-                receiver_id = text_data_json.get('receiver')
-
-                if receiver_id is not None:
-                    if isinstance(receiver_id, (str, int, float)):
-                        receiver_id = int(receiver_id)
-
-                        if receiver_id != self.scope['user'].id:
-                            print(f"{user_data['username']} is typing for Receiver: {receiver_id}")
-                            await self.channel_layer.group_send(
-                                self.room_group_name,
-                                {
-                                    'type': 'typing',
-                                    'user': user_data,
-                                    'receiver': receiver_id,
-                                }
-                            )
-                        else:
-                            print(f"User is typing for themselves")
-                    else:
-                        print(f"Invalid receiver ID: {type(receiver_id)}")
-                else:
-                    print("No receiver ID provided")
-            except ValueError as e:
-                print(f"Error parsing receiver ID: {e}")
-            except Exception as e:
-                print(f"Error getting user data: {e}")
+            # keystroke frames are throttled and coalesced into start/stop transitions
+            receiver_id = text_data_json.get('receiver')
+            if receiver_id is not None:
+                receiver_id = parse_id(receiver_id)
+                if receiver_id is None:
+                    await self.send_error(conversation_id, 4005, 'receiver must be a user id')
+                    return
+            if receiver_id == self.user.id or (receiver_id is not None and receiver_id not in subscription.members):
+                return
+            await get_typing_tracker().keystroke(
+                self.channel_layer, conversation_id, self.user_data, receiver_id
+            )
+
+        elif event_type == 'ack':
+            # newest message ids delivered to / read by this user; coalesced and written in batches
+            delivered = parse_id(text_data_json.get('delivered') or 0)
+            read = parse_id(text_data_json.get('read') or 0)
+            if delivered is None or read is None:
+                await self.send_error(conversation_id, 4005, 'delivered and read must be message ids')
+                return
+            if delivered > 0 or read > 0:
+                get_receipt_buffer().ack(conversation_id, self.user.id, delivered, read)
+
+    def message_frame(self, conversation_id, message):
+        return {
+            'type': 'chat_message',
+            'conversation': conversation_id,
+            # assigned on insert, so still None with write-behind persistence
+            'id': message.pk,
+            'seq': message.seq,
+            'message': message.content,
+            'user': self.user_data,
+            'timestamp': message.timestamp.isoformat(),
+            'client_id': message.client_id,
+        }
 
     # helper functions
     async def chat_message(self, event):
-        message = event['message']
-        user = event['user']
-        timestamp = event['timestamp']
-        await self.send(text_data=json.dumps({
+        subscription = self.subscriptions.get(event.get('conversation'))
+        if subscription is None:
+            return # in flight while the socket unsubscribed
+        seq = event.get('seq')
+        if seq is not None and seq <= subscription.replayed_seq:
+            return # already sent by the resume replay
+        await self.send_frame({
             'type': 'chat_message',
-            'message': message,
-            'user': user,
-            'timestamp': timestamp,
-        }))
-    
+            'conversation': event['conversation'],
+            'id': event.get('id'),
+            'seq': seq,
+            'message': event['message'],
+            'user': event['user'],
+            'timestamp': event['timestamp'],
+            'client_id': event.get('client_id'),
+        }, event.get('event_id'), live=True)
+
     async def typing(self, event):
-        user = event['user']
-        receiver = event.get('receiver')
-        is_typing = event.get('is_typing', False)
-        await self.send(text_data=json.dumps({
+        if event.get('conversation') not in self.subscriptions:
+            return
+        await self.send_frame({
             'type': 'typing',
-            'user': user,
-            'receiver': receiver,
-            'is_typing': is_typing,
-        }))
+            'conversation': event['conversation'],
+            'user': event['user'],
+            'receiver': event.get('receiver'),
+            'is_typing': event.get('is_typing', False),
+        }, event.get('event_id'), live=True)
 
     async def online_status(self, event):
-        await self.send(text_data=json.dumps(event))
-    
-    
-    @sync_to_async
-    def get_user(self, user_id):
-        from django.contrib.auth import get_user_model
-        User = get_user_model()
-        return User.objects.get(id=user_id)
-
-    @sync_to_async
-    def get_user_data(self, user):
-        from .serializers import UserListSerializer
-        return UserListSerializer(user).data
+        if event.get('conversation') not in self.subscriptions:
+            return
+        payload = {key: value for key, value in event.items() if key != 'event_id'}
+        await self.send_frame(payload, event.get('event_id'), live=True)
 
-    @sync_to_async
-    def get_conversation(self, conversation_id):
-        from .models import Conversation
-        try:
-            return Conversation.objects.get(id=conversation_id)
-        except Conversation.DoesNotExist:
-            print(F"Conversation with id {conversation_id} does not exist")
-            return None
+    async def receipts(self, event):
+        if event.get('conversation') not in self.subscriptions:
+            return
+        await self.send_frame({
+            'type': 'receipts',
+            'conversation': event['conversation'],
+            'receipts': event['receipts'],
+        }, event.get('event_id'), live=True)
+
+    async def members_changed(self, event):
+        subscription = self.subscriptions.get(event.get('conversation'))
+        if subscription is None:
+            return
+        changes = [(change['user']['id'], change['role']) for change in event['changes']]
+        subscription.members = get_member_cache().apply(subscription.members, changes, event['version'])
+        await self.send_frame({
+            'type': 'members_changed',
+            'conversation': event['conversation'],
+            'changes': event['changes'],
+        }, event.get('event_id'), live=True)
+        if self.user.id not in subscription.members:
+            await self.leave(subscription.conversation_id)
+            await self.removed(subscription.conversation_id)
+
+    async def removed(self, conversation_id):
+        # the user was removed from a conversation this socket had joined
+        await self.close(code=4003)
+
+
+    # database access goes through chartapp.data (CHAT_DB_EXECUTOR picks how it runs)
+    async def get_conversation_members(self, conversation_id):
+        return await data.get_conversation_members(conversation_id)
+
+    async def get_messages_after(self, conversation_id, last_seq, limit):
+        return await data.get_messages_after(conversation_id, last_seq, limit)
+
+    async def save_message(self, conversation, user, content, client_id=None):
+        return await data.create_message(conversation, user, content, client_id)
+
+
+class ChatConsumer(BaseChatConsumer):
+    """
+    One socket per conversation: ``ws/chat/<conversation_id>/``.
+    """
+
+    async def connect(self):
+        if not await self.authenticate():
+            return
+
+        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
+
+        # resolve the conversation and its members once; receive() reuses them for every message
+        subscription = await self.load_subscription(self.conversation_id)
+        if not isinstance(subscription, Subscription):
+            await self.close(code=subscription) #close the connection if the user may not join
+            return
+
+        # accept websocket connections, in the codec the client asked for
+        await self.accept_negotiated()
+        # ?last_seq=N on a reconnect replays what the client missed
+        params = parse_qs(self.scope['query_string'].decode('utf-8'))
+        await self.join(subscription, parse_seq(params.get('last_seq', [None])[0]))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = await self.read_frame(text_data, bytes_data)
+        if text_data_json is None:
+            return
+        event_type = text_data_json.get('type')
+        await self.refresh_presence()
+
+        subscription = self.subscriptions.get(self.conversation_id)
+        if event_type == 'heartbeat' or subscription is None:
+            return
+        await self.handle_conversation_event(subscription, event_type, text_data_json)
+
+
+class UserChatConsumer(BaseChatConsumer):
+    """
+    One socket per user carrying any number of conversations: ``ws/user/``.
+
+    The client sends ``{"type": "subscribe", "conversation": <id>}``
+    (optionally with ``"last_seq"`` to resume) and ``unsubscribe`` to join
+    and leave rooms; ``chat_message`` and ``typing`` frames name their
+    conversation the same way, and every frame the server sends is tagged
+    with ``conversation``.
+
+    A frame the server cannot act on gets an ``error`` frame back and the
+    socket stays open. Its ``code`` is 4003 (not a participant), 4004 (no
+    such conversation), 4005 (bad request: a malformed frame, no
+    conversation id, or not subscribed to it) or 4006 (too many
+    subscriptions). 4000 to 4002 are
+    only used to close sockets whose handshake token was refused.
+    """
+    max_subscriptions = 500
+
+    async def connect(self):
+        if not await self.authenticate():
+            return
+        await self.accept_negotiated()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = await self.read_frame(text_data, bytes_data)
+        if text_data_json is None:
+            return
+        event_type = text_data_json.get('type')
+        await self.refresh_presence()
+        if event_type == 'heartbeat':
+            return
+
+        conversation_id = parse_id(text_data_json.get('conversation'))
+        if conversation_id is None:
+            await self.send_error(None, 4005, 'A conversation id is required')
+            return
+
+        if event_type == 'subscribe':
+            await self.subscribe(conversation_id, parse_seq(text_data_json.get('last_seq')))
+        elif event_type == 'unsubscribe':
+            await self.leave(conversation_id)
+            await self.send_frame({'type': 'unsubscribed', 'conversation': conversation_id})
+        elif conversation_id in self.subscriptions:
+            await self.handle_conversation_event(self.subscriptions[conversation_id], event_type, text_data_json)
+        else:
+            await self.send_error(conversation_id, 4005, 'Not subscribed to this conversation')
+
+    async def subscribe(self, conversation_id, last_seq=None):
+        if conversation_id in self.subscriptions:
+            return
+        if len(self.subscriptions) >= self.max_subscriptions:
+            await self.send_error(conversation_id, 4006, 'Too many subscriptions')
+            return
+        subscription = await self.load_subscription(conversation_id)
+        if not isinstance(subscription, Subscription):
+            detail = 'Conversation not found' if subscription == 4004 else 'You are not a participant of this conversation'
+            await self.send_error(conversation_id, subscription, detail)
+            return
+        await self.send_frame({'type': 'subscribed', 'conversation': conversation_id})
+        await self.join(subscription, last_seq)
 
-    @sync_to_async
-    def save_message(self, conversation, user, content):
-        from .models import Message
-        return Message.objects.create(
-            conversation=conversation,
-            sender=user,
-            content=content
-        )
\ No newline at end of file
+    async def removed(self, conversation_id):
+        await self.send_frame({'type': 'unsubscribed', 'conversation': conversation_id, 'reason': 'removed'})
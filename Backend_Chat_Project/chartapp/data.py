@@ -0,0 +1,138 @@
+"""
+Async data access for the consumers and the async views.
+
+Django's async ORM methods (``aget``, ``acreate``, ``async for``) are
+still ``sync_to_async`` calls underneath: each query hops to the
+thread-sensitive executor. Outside an HTTP request (every WebSocket
+consumer) that executor is one thread shared by the whole worker, so
+thousands of sockets queue behind it. ``CHAT_DB_EXECUTOR['MODE']`` picks
+how the calls below run:
+
+- ``pool`` (default): each unit of work runs as one sync call on a bounded
+  pool of ``MAX_WORKERS`` threads, each with its own database connection,
+  so lookups for different sockets run side by side.
+- ``async_orm``: the native async ORM calls, one hop per query.
+- ``sync_to_async``: one hop per unit on the shared thread, which is what
+  the consumers used to do.
+
+Size the pool to what the database accepts: every pool thread keeps a
+connection for ``CONN_MAX_AGE``, and SQLite still allows one writer at a
+time.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync, sync_to_async
+from django.conf import settings
+from django.core.signals import request_finished, setting_changed
+from django.db import close_old_connections, connections
+from django.dispatch import receiver
+
+from .membership import get_member_cache
+
+MODES = ('pool', 'async_orm', 'sync_to_async')
+
+_executor = None
+
+
+def get_options():
+    options = getattr(settings, 'CHAT_DB_EXECUTOR', {})
+    return {
+        'MODE': options.get('MODE', 'pool'),
+        'MAX_WORKERS': options.get('MAX_WORKERS', 16),
+    }
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=get_options()['MAX_WORKERS'], thread_name_prefix='chat-db')
+    return _executor
+
+
+@receiver(setting_changed)
+def reset_executor(setting, **kwargs):
+    global _executor
+    if setting == 'CHAT_DB_EXECUTOR' and _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+@receiver(request_finished)
+def close_request_thread_connections(**kwargs):
+    # under ASGI a request's sync code runs on a thread that ends with the
+    # request, so a connection kept there for CONN_MAX_AGE would never be
+    # reused; long-lived threads (this pool, WSGI workers) keep theirs
+    if SyncToAsync.thread_sensitive_context.get(None) is not None:
+        connections.close_all()
+
+
+def _in_pool_thread(func, args, kwargs):
+    # pool threads outlive requests; drop connections past CONN_MAX_AGE or broken,
+    # as channels' database_sync_to_async does
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run(func, *args, **kwargs):
+    """Run a sync unit of database work without blocking the event loop."""
+    if get_options()['MODE'] == 'pool':
+        return await sync_to_async(_in_pool_thread, thread_sensitive=False, executor=get_executor())(
+            func, args, kwargs
+        )
+    return await sync_to_async(func)(*args, **kwargs)
+
+
+def native():
+    return get_options()['MODE'] == 'async_orm'
+
+
+async def get_user(user_id):
+    from django.contrib.auth import get_user_model
+    User = get_user_model()
+    if native():
+        return await User.objects.aget(id=user_id)
+    return await run(User.objects.get, id=user_id)
+
+
+def _conversation_members(conversation):
+    if conversation is None:
+        return None, frozenset()
+    return conversation, get_member_cache().get(conversation.id)
+
+
+async def get_conversation_members(conversation_id):
+    """
+    ``(conversation, members)``, or ``(None, frozenset())`` if it does not
+    exist. ``members`` is the cached ``membership.Members`` (ids and roles).
+    """
+    from .models import Conversation
+    # members come from the member cache, not the default manager's participant prefetch
+    queryset = Conversation.objects.prefetch_related(None).filter(id=conversation_id)
+    if native():
+        conversation = await queryset.afirst()
+        if conversation is None:
+            return None, frozenset()
+        return conversation, await sync_to_async(get_member_cache().get)(conversation.id)
+    return await run(lambda: _conversation_members(queryset.first()))
+
+
+async def get_messages_after(conversation_id, last_seq, limit):
+    from .models import Message
+    queryset = (Message.objects
+                .filter(conversation_id=conversation_id, seq__gt=last_seq)
+                .order_by('seq')
+                .values('id', 'seq', 'content', 'timestamp', 'sender_id', 'sender__username', 'client_id')[:limit])
+    if native():
+        return [row async for row in queryset]
+    return await run(list, queryset)
+
+
+async def create_message(conversation, sender, content, client_id=None):
+    """``(message, created)``; a retry with the same ``client_id`` returns the stored message."""
+    from .models import Message
+    if native():
+        return await sync_to_async(Message.objects.send)(conversation, sender, content, client_id)
+    return await run(Message.objects.send, conversation, sender, content, client_id)
@@ -0,0 +1,57 @@
+import hashlib
+import string
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags
+
+VERSION_KEY = 'chat:user_directory:version'
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def get_version():
+    """
+    Opaque token that changes whenever a user is added, renamed or removed.
+    It is the directory's ETag and part of every cached page key, so
+    bumping it invalidates all cached pages at once. With several worker
+    processes the cache must be shared (e.g. Redis) for this to hold.
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_version():
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def etag_matches(etag, if_none_match):
+    """True if an ``If-None-Match`` header names ``etag``, compared whole and weakly (RFC 9110)."""
+    tags = parse_etags(if_none_match or '')
+    return '*' in tags or any(tag.removeprefix('W/') == etag.removeprefix('W/') for tag in tags)
+
+
+def page_key(version, query_params):
+    query = '&'.join(f'{name}={value}' for name, value in sorted(query_params.items()))
+    return f'chat:user_directory:{version}:{hashlib.md5(query.encode("utf-8")).hexdigest()}'
+
+
+def cache_timeout():
+    return getattr(settings, 'CHAT_USER_DIRECTORY', {}).get('CACHE_TIMEOUT', 300)
+
+
+def fold_case(value):
+    # SQLite's LOWER() only folds ASCII letters; fold the same way so both sides agree
+    return value.translate(ASCII_LOWER)
+
+
+def prefix_range(prefix):
+    # LOWER(username) LIKE 'ab%' as a range ('ab' <= x < 'ac') the expression index can serve
+    prefix = fold_case(prefix)
+    last = ord(prefix[-1])
+    if last >= 0x10FFFF:
+        return prefix, None
+    return prefix, prefix[:-1] + chr(last + 1)
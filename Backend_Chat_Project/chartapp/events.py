@@ -0,0 +1,273 @@
+"""
+Real-time delivery over plain HTTP, for clients behind proxies that break
+WebSockets: Server-Sent Events (``events/stream/``) and long polling
+(``events/poll/``).
+
+An ``EventListener`` is one HTTP client listening to its conversations. It
+joins their fan-out (``chartapp.fanout``) the way a socket does, so it gets
+the same group events, and queues the frames a socket would be sent. While
+it waits it holds that queue and nothing else: no database connection and
+no thread. The database is used when a listener opens, to list the user's
+conversations and to catch up on missed messages.
+
+Clients resume from the id of the last message they saw (``Last-Event-ID``
+for SSE, ``?last_id=`` for either endpoint). Newer messages of the user's
+conversations are sent before live events, or ``resync_required`` when
+more than ``MAX_CATCH_UP`` are missing (page through the REST delta view).
+Messages broadcast before they are stored (write-behind persistence) have
+no id yet and are not resumable.
+
+Message ids are global and committed out of order across conversations, so
+live messages are delivered whatever their id, and ``last_id`` is a best
+effort cursor: a message of one conversation committed late with a lower
+id than one already seen elsewhere is missed by a resume. Clients that
+must not miss any should resync each conversation by its ``seq``, as the
+``ws/chat/`` sockets do.
+"""
+import asyncio
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import data, flow_control
+from .fanout import GroupFanout, get_fanout
+from .presence import get_presence_broadcaster, get_presence_registry
+from .wire import DEFAULT_CODEC, frame_cache
+
+
+def get_options():
+    options = getattr(settings, 'CHAT_EVENTS', {})
+    return {
+        'POLL_TIMEOUT': options.get('POLL_TIMEOUT', 25),
+        'KEEPALIVE': options.get('KEEPALIVE', 15),
+        'BUFFER': options.get('BUFFER', 1024),
+        'MAX_CATCH_UP': options.get('MAX_CATCH_UP', 500),
+        'MAX_CONVERSATIONS': options.get('MAX_CONVERSATIONS', 500),
+    }
+
+
+def listened_conversations(user_id, conversation_ids, limit):
+    """``{conversation_id: last_message_id}`` of the user's conversations, most recently active first."""
+    from .models import ParticipantState
+    queryset = ParticipantState.objects.filter(user_id=user_id)
+    if conversation_ids is not None:
+        queryset = queryset.filter(conversation_id__in=conversation_ids)
+    rows = (queryset.order_by('-last_activity_at')
+            .values_list('conversation_id', 'conversation__last_message_id')[:limit])
+    return {conversation_id: last_message_id or 0 for conversation_id, last_message_id in rows}
+
+
+def messages_since(conversation_ids, last_id, limit):
+    """Messages after ``last_id`` in these conversations, oldest first, or None if some are archived."""
+    from .models import ArchiveBlock, Message
+    if ArchiveBlock.objects.filter(conversation_id__in=conversation_ids, max_id__gt=last_id).exists():
+        return None
+    return list(Message.objects
+                .filter(conversation_id__in=conversation_ids, id__gt=last_id)
+                .order_by('id')
+                .values('id', 'conversation_id', 'seq', 'content', 'timestamp', 'sender_id', 'sender__username',
+                        'client_id')[:limit])
+
+
+class EventListener:
+    """
+    One HTTP client's subscription to its conversations. Group events are
+    turned into the JSON frames a socket gets (and share its encoding
+    through the frame cache) and wait in a bounded queue until the
+    response takes them.
+    """
+
+    def __init__(self, user, buffer=1024, max_catch_up=500, max_conversations=500):
+        from channels.layers import get_channel_layer
+        self.user = user
+        self.user_data = {'id': user.id, 'username': user.username}
+        self.buffer = buffer
+        self.max_catch_up = max_catch_up
+        self.max_conversations = max_conversations
+        self.channel_layer = get_channel_layer()
+        self.channel_name = None
+        self.conversation_ids = set()
+        self.frames = deque()  # (encoded frame, message id or None)
+        self.ready = asyncio.Event()
+        # the queue filled up with messages; the client should resume from last_id
+        self.overflowed = False
+        # newest message id sent, the resume cursor handed to the client
+        self.last_id = 0
+        # newest message id the catch-up sent; live copies up to it are duplicates
+        self.caught_up_id = 0
+        # where the client resumed from (or the newest message when it did not)
+        self.start_id = 0
+        # live messages arriving while the listener opens wait for the catch-up
+        self.held = []
+        self.presence = False
+        self.presence_refreshed_at = 0
+        self.receiver = None
+
+    async def open(self, conversation_ids=None, last_id=None, presence=False):
+        conversations = await data.run(listened_conversations, self.user.id, conversation_ids, self.max_conversations)
+        # a named channel identifies the listener to the presence registry and, with the
+        # 'group' fan-out strategy, is where its group events arrive
+        self.channel_name = await self.channel_layer.new_channel('chat-listener')
+        fanout = get_fanout()
+        if isinstance(fanout, GroupFanout):
+            self.receiver = asyncio.get_running_loop().create_task(self.receive())
+        for conversation_id in conversations:
+            self.conversation_ids.add(conversation_id)
+            await fanout.add(self, conversation_id)
+
+        self.last_id = self.start_id = max(conversations.values(), default=0) if last_id is None else last_id
+        if presence:
+            await self.join_presence()
+        # joined before the catch-up query, so nothing falls in between
+        if last_id is not None:
+            await self.catch_up()
+        held, self.held = self.held, None
+        for event in held:
+            await self.chat_message(event)
+
+    async def close(self):
+        fanout = get_fanout()
+        registry = get_presence_registry()
+        broadcaster = get_presence_broadcaster()
+        for conversation_id in list(self.conversation_ids):
+            self.conversation_ids.discard(conversation_id)
+            if self.presence and await registry.leave(conversation_id, self.user.id, self.channel_name):
+                broadcaster.publish(self.channel_layer, conversation_id, self.user_data, 'offline')
+            await fanout.discard(self, conversation_id)
+        if self.receiver is not None:
+            self.receiver.cancel()
+            self.receiver = None
+
+    async def catch_up(self):
+        rows = []
+        if self.conversation_ids:
+            rows = await data.run(messages_since, list(self.conversation_ids), self.last_id, self.max_catch_up + 1)
+        if rows is None or len(rows) > self.max_catch_up:
+            self.push({'type': 'resync_required', 'last_id': self.last_id})
+            return
+        # saved before the held live messages are released, and never moved by them
+        self.caught_up_id = max((row['id'] for row in rows), default=0)
+        for row in rows:
+            self.push({
+                'type': 'chat_message',
+                'conversation': row['conversation_id'],
+                'id': row['id'],
+                'seq': row['seq'],
+                'message': row['content'],
+                'user': {'id': row['sender_id'], 'username': row['sender__username']},
+                'timestamp': row['timestamp'].isoformat(),
+                'client_id': row['client_id'],
+            }, message_id=row['id'])
+
+    async def join_presence(self):
+        # an open stream counts as online, like a socket (long polls come and go too often to)
+        self.presence = True
+        self.presence_refreshed_at = time.monotonic()
+        registry = get_presence_registry()
+        broadcaster = get_presence_broadcaster()
+        limit = registry.snapshot_limit
+        for conversation_id in list(self.conversation_ids):
+            if await registry.join(conversation_id, self.user_data, self.channel_name):
+                broadcaster.publish(self.channel_layer, conversation_id, self.user_data, 'online')
+            online_users = await registry.snapshot(conversation_id, None if limit is None else limit + 1)
+            snapshot = {
+                'type': 'online_status',
+                'status': 'snapshot',
+                'conversation': conversation_id,
+                'online_users': online_users[:limit],
+            }
+            if limit is not None and len(online_users) > limit:
+                snapshot['truncated'] = True
+            self.push(snapshot)
+
+    async def refresh_presence(self):
+        # the stream's keepalive is its heartbeat; see BaseChatConsumer.refresh_presence
+        registry = get_presence_registry()
+        now = time.monotonic()
+        if not self.presence or now - self.presence_refreshed_at < registry.ttl / 3:
+            return
+        self.presence_refreshed_at = now
+        broadcaster = get_presence_broadcaster()
+        for conversation_id in list(self.conversation_ids):
+            if await registry.heartbeat(conversation_id, self.user_data, self.channel_name):
+                broadcaster.publish(self.channel_layer, conversation_id, self.user_data, 'online')
+            for user_data in await registry.expire(conversation_id):
+                broadcaster.publish(self.channel_layer, conversation_id, user_data, 'offline')
+
+    def push(self, payload, event_id=None, message_id=None):
+        if len(self.frames) >= self.buffer:
+            if not flow_control.low_priority(payload):
+                self.overflowed = True
+                self.ready.set()
+            return
+        self.frames.append((frame_cache.encode(DEFAULT_CODEC, payload, event_id), message_id))
+        if message_id is not None:
+            self.last_id = max(self.last_id, message_id)
+        self.ready.set()
+
+    def take(self):
+        frames = list(self.frames)
+        self.frames.clear()
+        self.ready.clear()
+        return frames
+
+    async def wait(self, timeout):
+        """True once frames are queued (or the queue overflowed), False after ``timeout`` seconds."""
+        if self.frames or self.overflowed:
+            return True
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def receive(self):
+        # the 'group' fan-out strategy sends each group member its own copy
+        while True:
+            event = await self.channel_layer.receive(self.channel_name)
+            handler = getattr(self, event['type'].replace('.', '_'), None)
+            if handler is not None:
+                await handler(event)
+
+    # group event handlers, as called by the fan-out
+    async def chat_message(self, event):
+        if event.get('conversation') not in self.conversation_ids:
+            return
+        if self.held is not None:
+            self.held.append(event)
+            return
+        message_id = event.get('id')
+        if message_id is not None and message_id <= self.caught_up_id:
+            return # already sent by the catch-up
+        self.push({key: value for key, value in event.items() if key != 'event_id'},
+                  event.get('event_id'), message_id)
+
+    async def typing(self, event):
+        if event.get('conversation') in self.conversation_ids:
+            self.push({key: value for key, value in event.items() if key != 'event_id'}, event.get('event_id'))
+
+    async def online_status(self, event):
+        if event.get('conversation') in self.conversation_ids:
+            self.push({key: value for key, value in event.items() if key != 'event_id'}, event.get('event_id'))
+
+    async def receipts(self, event):
+        if event.get('conversation') in self.conversation_ids:
+            self.push({key: value for key, value in event.items() if key != 'event_id'}, event.get('event_id'))
+
+    async def members_changed(self, event):
+        conversation_id = event.get('conversation')
+        if conversation_id not in self.conversation_ids:
+            return
+        self.push({
+            'type': 'members_changed',
+            'conversation': conversation_id,
+            'changes': event['changes'],
+        }, event.get('event_id'))
+        if any(change['user']['id'] == self.user.id and change['role'] is None for change in event['changes']):
+            # removed from the conversation: stop listening to it
+            self.conversation_ids.discard(conversation_id)
+            if self.presence and await get_presence_registry().leave(conversation_id, self.user.id, self.channel_name):
+                get_presence_broadcaster().publish(self.channel_layer, conversation_id, self.user_data, 'offline')
+            await get_fanout().discard(self, conversation_id)
+            self.push({'type': 'unsubscribed', 'conversation': conversation_id, 'reason': 'removed'})
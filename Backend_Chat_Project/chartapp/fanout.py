@@ -0,0 +1,202 @@
+"""
+How conversation events reach the sockets of a worker process.
+
+``CHAT_FANOUT['STRATEGY']``:
+
+- ``group``: every socket joins the conversation's channel layer group
+  itself, so ``group_send`` writes one copy of an event per socket and
+  each socket's consumer picks its copy up from the layer.
+- ``relay`` (default): one relay channel per worker process joins the
+  group on behalf of all the process's sockets in that conversation and
+  hands each event to them directly. ``group_send`` writes one copy per
+  process, whatever the size of the room, and local delivery is a loop
+  over the room's sockets in memory.
+
+Group events name their conversation, which is how the relay finds the
+sockets. The relay channel carries every event of its process: give it a
+larger capacity than the layer's default, e.g.
+``'channel_capacity': {'chat-relay*': 100000}`` in the layer's CONFIG.
+
+Group memberships expire after the layer's ``group_expiry`` (a day with
+channels_redis), however long the relay keeps sockets in the room, so the
+relay joins every group it is in again each ``GROUP_REFRESH`` seconds.
+Keep that well under ``group_expiry``.
+"""
+import asyncio
+import contextlib
+import logging
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .lifespan import on_shutdown
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ('relay', 'group')
+
+
+def get_options():
+    options = getattr(settings, 'CHAT_FANOUT', {})
+    return {
+        'STRATEGY': options.get('STRATEGY', 'relay'),
+        'GROUP_REFRESH': options.get('GROUP_REFRESH', 3600),
+    }
+
+
+def group_name(conversation_id):
+    return f'chat_{conversation_id}'
+
+
+class GroupFanout:
+    """Each socket is a member of the channel layer group."""
+
+    async def add(self, consumer, conversation_id):
+        await consumer.channel_layer.group_add(group_name(conversation_id), consumer.channel_name)
+
+    async def discard(self, consumer, conversation_id):
+        await consumer.channel_layer.group_discard(group_name(conversation_id), consumer.channel_name)
+
+    async def close(self):
+        pass
+
+
+class RelayFanout:
+    """
+    The process's relay channel is a member of the channel layer group and
+    delivers each event to the local sockets of its conversation by calling
+    their handler for it, as the consumer's own dispatch would.
+    """
+
+    def __init__(self):
+        self.channel_layer = None
+        self.channel_name = None
+        self.loop = None
+        self.started = None
+        self.task = None
+        self.refresher = None
+        self.sockets = {}  # conversation_id -> {consumer: None}, in join order
+        self.locks = {}  # conversation_id -> [asyncio.Lock, users]
+
+    async def add(self, consumer, conversation_id):
+        await self.start(consumer.channel_layer)
+        async with self.locked(conversation_id):
+            # returns only once the relay is in the group: the join's replay relies on it
+            sockets = self.sockets.get(conversation_id)
+            if sockets is None:
+                await self.channel_layer.group_add(group_name(conversation_id), self.channel_name)
+                sockets = self.sockets[conversation_id] = {}
+            sockets[consumer] = None
+
+    async def discard(self, consumer, conversation_id):
+        async with self.locked(conversation_id):
+            sockets = self.sockets.get(conversation_id)
+            if sockets is None or sockets.pop(consumer, False) is False:
+                return
+            if not sockets:
+                del self.sockets[conversation_id]
+                await self.channel_layer.group_discard(group_name(conversation_id), self.channel_name)
+
+    @contextlib.asynccontextmanager
+    async def locked(self, conversation_id):
+        # group_add and group_discard of one conversation must not overtake each other
+        entry = self.locks.get(conversation_id)
+        if entry is None:
+            entry = self.locks[conversation_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[conversation_id]
+
+    async def start(self, channel_layer):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # first socket, or a new event loop (tests, benchmarks) whose sockets are all new
+            self.loop = loop
+            self.sockets = {}
+            self.locks = {}
+            self.channel_layer = channel_layer
+            self.started = loop.create_task(self.open())
+        await self.started
+
+    async def open(self):
+        self.channel_name = await self.channel_layer.new_channel('chat-relay')
+        loop = asyncio.get_running_loop()
+        self.task = loop.create_task(self.receive())
+        self.refresher = loop.create_task(self.refresh_groups(get_options()['GROUP_REFRESH']))
+
+    async def receive(self):
+        while True:
+            try:
+                event = await self.channel_layer.receive(self.channel_name)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Relay channel %s failed to receive', self.channel_name)
+                await asyncio.sleep(1)
+                continue
+            await self.dispatch(event)
+
+    async def refresh_groups(self, interval):
+        # group_add again before the layer's group_expiry drops the relay from its groups
+        while True:
+            await asyncio.sleep(interval)
+            for conversation_id in list(self.sockets):
+                try:
+                    async with self.locked(conversation_id):
+                        if conversation_id in self.sockets:
+                            await self.channel_layer.group_add(group_name(conversation_id), self.channel_name)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception('Relay channel %s failed to rejoin conversation %s',
+                                     self.channel_name, conversation_id)
+
+    async def dispatch(self, event):
+        sockets = self.sockets.get(event.get('conversation'))
+        if not sockets:
+            return
+        handler_name = event['type'].replace('.', '_')
+        for consumer in list(sockets):
+            try:
+                await getattr(consumer, handler_name)(event)
+            except Exception:
+                logger.exception('Relaying %s to %s failed', event['type'], consumer.channel_name)
+
+    async def close(self):
+        for task in (self.task, self.refresher):
+            if task is not None:
+                task.cancel()
+        self.task = self.refresher = None
+        self.loop = None
+
+
+_fanout = None
+
+
+def get_fanout():
+    global _fanout
+    if _fanout is None:
+        strategy = get_options()['STRATEGY']
+        if strategy not in STRATEGIES:
+            raise ValueError(f"CHAT_FANOUT['STRATEGY'] must be one of {', '.join(STRATEGIES)}, not {strategy!r}")
+        _fanout = RelayFanout() if strategy == 'relay' else GroupFanout()
+    return _fanout
+
+
+@receiver(setting_changed)
+def reset_fanout(setting, **kwargs):
+    global _fanout
+    if setting in ('CHAT_FANOUT', 'CHANNEL_LAYERS'):
+        _fanout = None
+
+
+@on_shutdown
+async def stop_relay():
+    if _fanout is not None:
+        await _fanout.close()
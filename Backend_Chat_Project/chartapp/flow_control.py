@@ -0,0 +1,283 @@
+"""
+Flow control for WebSocket consumers.
+
+Inbound, every frame a client sends takes a token from two buckets for its
+kind (``chat``, ``typing``, ``ack``, ``subscribe``, ``other``): one per socket and
+one per user, shared by the user's sockets in this worker. Frames that find
+either bucket empty are dropped before any work is done for them.
+
+Outbound, frames wait in a bounded ``OutboundBuffer`` per socket instead of
+being written from the group event handlers, so a client that reads slowly
+never holds up its channel layer queue. When the buffer is full, typing and
+presence frames are dropped first; ``CHAT_FLOW_CONTROL['OUTBOUND_OVERFLOW']``
+decides what happens to a chat frame that still does not fit.
+
+Whether a slow client fills the buffer depends on the server: uvicorn makes
+``send`` wait while its socket buffer is full, daphne buffers without limit.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# client frame type -> the bucket it draws from; everything else is 'other'
+FRAME_KINDS = {
+    'chat_message': 'chat',
+    'typing': 'typing',
+    'ack': 'ack',
+    'subscribe': 'subscribe',
+    'unsubscribe': 'subscribe',
+}
+
+DEFAULT_LIMITS = {
+    # frames per second and burst, per socket and per user
+    'chat': {'RATE': 2, 'BURST': 10, 'USER_RATE': 4, 'USER_BURST': 20},
+    # keystroke frames; the typing tracker only needs one per MIN_INTERVAL
+    'typing': {'RATE': 10, 'BURST': 20, 'USER_RATE': 20, 'USER_BURST': 40},
+    # receipts are coalesced server side; one ack per conversation per message received is plenty
+    'ack': {'RATE': 20, 'BURST': 100, 'USER_RATE': 40, 'USER_BURST': 200},
+    # a multiplexed socket subscribes to all its conversations at once
+    'subscribe': {'RATE': 50, 'BURST': 500, 'USER_RATE': 100, 'USER_BURST': 1000},
+    'other': {'RATE': 10, 'BURST': 30, 'USER_RATE': 20, 'USER_BURST': 60},
+}
+
+
+def get_options():
+    options = getattr(settings, 'CHAT_FLOW_CONTROL', {})
+    limits = {kind: dict(values) for kind, values in DEFAULT_LIMITS.items()}
+    for kind, values in options.get('LIMITS', {}).items():
+        limits.setdefault(kind, {}).update(values)
+    return {
+        'LIMITS': limits,
+        'DISCONNECT_AFTER': options.get('DISCONNECT_AFTER', 200),
+        'DISCONNECT_WINDOW': options.get('DISCONNECT_WINDOW', 10),
+        'MAX_FRAME_BYTES': options.get('MAX_FRAME_BYTES', 64 * 1024),
+        'OUTBOUND_BUFFER': options.get('OUTBOUND_BUFFER', 1024),
+        'OUTBOUND_OVERFLOW': options.get('OUTBOUND_OVERFLOW', 'disconnect'),
+    }
+
+
+def frame_kind(event_type):
+    return FRAME_KINDS.get(event_type, 'other')
+
+
+def low_priority(payload):
+    # frames a client can miss without losing anything it cannot get back:
+    # typing expires on its own, the next presence snapshot corrects the list,
+    # receipts carry absolute watermarks that the next one repeats
+    frame_type = payload['type']
+    return (frame_type in ('typing', 'receipts')
+            or (frame_type == 'online_status' and payload.get('status') != 'snapshot'))
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return self.tokens
+
+    def retry_after(self):
+        # seconds until the next token
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate else None
+
+
+class UserBuckets:
+    """
+    The per-user buckets of every user with a socket in this worker. An
+    entry outlives its last socket until its buckets have refilled, so
+    reconnecting does not hand out a fresh burst.
+    """
+    sweep_every = 256
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.users = {}  # user_id -> [sockets, {kind: TokenBucket}]
+        self.releases = 0
+
+    def acquire(self, user_id):
+        entry = self.users.get(user_id)
+        if entry is None:
+            now = time.monotonic()
+            entry = self.users[user_id] = [0, {
+                kind: TokenBucket(limit['USER_RATE'], limit['USER_BURST'], now)
+                for kind, limit in self.limits.items()
+            }]
+        entry[0] += 1
+        return entry[1]
+
+    def release(self, user_id):
+        entry = self.users.get(user_id)
+        if entry is not None:
+            entry[0] -= 1
+        self.releases += 1
+        if self.releases % self.sweep_every == 0:
+            self.sweep()
+
+    def sweep(self):
+        now = time.monotonic()
+        for user_id, (sockets, buckets) in list(self.users.items()):
+            if sockets <= 0 and all(bucket.refill(now) >= bucket.burst for bucket in buckets.values()):
+                del self.users[user_id]
+
+
+class FrameLimiter:
+    """
+    The buckets one socket's inbound frames draw from. A socket that has
+    more than ``disconnect_after`` frames refused within ``window`` seconds
+    is ``abusive``: it keeps sending well past its limits.
+    """
+
+    def __init__(self, user_id, user_buckets, limits, disconnect_after=200, window=10):
+        now = time.monotonic()
+        self.user_id = user_id
+        self.user_registry = user_buckets
+        self.user_buckets = user_buckets.acquire(user_id)
+        self.buckets = {kind: TokenBucket(limit['RATE'], limit['BURST'], now) for kind, limit in limits.items()}
+        self.disconnect_after = disconnect_after
+        self.window = window
+        # frames refused since the last one that passed, and within the current window
+        self.dropped = 0
+        self.window_dropped = 0
+        self.window_started = now
+        self.released = False
+
+    def check(self, kind):
+        """None if a frame of ``kind`` may pass (its tokens are taken), else the scope that refused it."""
+        now = time.monotonic()
+        bucket = self.buckets.get(kind)
+        user_bucket = self.user_buckets.get(kind)
+        if bucket is not None and bucket.refill(now) < 1:
+            scope = 'connection'
+        elif user_bucket is not None and user_bucket.refill(now) < 1:
+            scope = 'user'
+        else:
+            if bucket is not None:
+                bucket.tokens -= 1
+            if user_bucket is not None:
+                user_bucket.tokens -= 1
+            self.dropped = 0
+            return None
+        self.dropped += 1
+        if now - self.window_started >= self.window:
+            self.window_started = now
+            self.window_dropped = 0
+        self.window_dropped += 1
+        return scope
+
+    @property
+    def abusive(self):
+        return self.window_dropped > self.disconnect_after
+
+    def retry_after(self, kind):
+        waits = [bucket.retry_after() for bucket in (self.buckets.get(kind), self.user_buckets.get(kind))
+                 if bucket is not None]
+        return max((wait for wait in waits if wait is not None), default=0.0)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.user_registry.release(self.user_id)
+
+
+class OutboundBuffer:
+    """
+    Frames waiting to be written to one socket, in order, by a task that
+    only exists while there is something to write.
+
+    ``push`` queues a live group event without waiting: past ``max_frames``
+    it drops the oldest low-priority frame (or the new frame, if that is
+    low priority) and returns False when only high-priority frames are
+    waiting. ``put`` is for the socket's own replies and replays, and waits
+    for room instead.
+    """
+
+    def __init__(self, write, max_frames):
+        self.write = write
+        self.max_frames = max_frames
+        self.frames = deque()  # (frame, frame_type, low_priority)
+        self.task = None
+        self.room = asyncio.Event()
+        self.closed = False
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, frame, frame_type, low_priority=False):
+        if self.closed:
+            return True
+        if len(self.frames) >= self.max_frames:
+            if low_priority:
+                metrics.ws_outbound_dropped.inc(type=frame_type)
+                return True
+            victim = next((entry for entry in self.frames if entry[2]), None)
+            if victim is None:
+                return False
+            self.frames.remove(victim)
+            metrics.ws_outbound_dropped.inc(type=victim[1])
+        self.frames.append((frame, frame_type, low_priority))
+        self._start()
+        return True
+
+    async def put(self, frame, frame_type, low_priority=False):
+        while len(self.frames) >= self.max_frames and not self.closed:
+            self.room.clear()
+            await self.room.wait()
+        if self.closed:
+            return
+        self.frames.append((frame, frame_type, low_priority))
+        self._start()
+
+    def _start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            while self.frames:
+                frame, frame_type, _ = self.frames.popleft()
+                self.room.set()
+                await self.write(frame, frame_type)
+        except Exception:
+            # the socket is gone; disconnect() closes the buffer
+            logger.debug('Dropping %d outbound frames after a failed write', len(self.frames), exc_info=True)
+            self.frames.clear()
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self.room.set()
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+
+_user_buckets = None
+
+
+def get_user_buckets():
+    global _user_buckets
+    if _user_buckets is None:
+        _user_buckets = UserBuckets(get_options()['LIMITS'])
+    return _user_buckets
+
+
+@receiver(setting_changed)
+def reset_user_buckets(setting, **kwargs):
+    global _user_buckets
+    if setting == 'CHAT_FLOW_CONTROL':
+        _user_buckets = None
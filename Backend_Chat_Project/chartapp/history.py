@@ -0,0 +1,271 @@
+"""
+Streaming export and import of conversation history.
+
+An export is a stream of records: a ``conversation`` record (id, name,
+is_group, participants, created_at; a group's participants carry their
+role) followed by that conversation's ``message``
+records in seq order, archived messages included. Records are NDJSON lines
+or consecutive MessagePack maps. Messages are read as ``values()`` rows in
+keyset chunks and encoded as they go, so memory does not grow with the
+history; the export views do that on the database pool (``aencode_export``).
+"""
+import json
+
+import msgpack
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from . import archive, data, inbox
+
+CHUNK_SIZE = 2000
+# records are gathered into writes of about this many bytes
+WRITE_SIZE = 64 * 1024
+
+
+class NDJSONCodec:
+    name = 'ndjson'
+    content_type = 'application/x-ndjson'
+    extension = 'ndjson'
+
+    def encode(self, record):
+        return (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+
+    def decode(self, stream):
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+    extension = 'msgpack'
+
+    def encode(self, record):
+        return msgpack.packb(record, use_bin_type=True)
+
+    def decode(self, stream):
+        yield from msgpack.Unpacker(stream, raw=False)
+
+
+CODECS = {codec.name: codec for codec in (NDJSONCodec(), MsgpackCodec())}
+
+
+class HistoryImportError(Exception):
+    pass
+
+
+def conversation_batches(conversation):
+    """
+    Records of one conversation in batches: its header, then every message
+    by seq, an archive block or ``CHUNK_SIZE`` rows at a time. Each batch is
+    fetched with its own keyset query and no cursor is held open in
+    between, so consecutive batches may be fetched on different threads.
+    """
+    from .models import Message
+
+    participants = [{'id': user.id, 'username': user.username} for user in conversation.participants.all()]
+    usernames = {user['id']: user['username'] for user in participants}
+    if conversation.is_group:
+        roles = dict(conversation.participant_states.values_list('user_id', 'role'))
+        for participant in participants:
+            participant['role'] = roles.get(participant['id'])
+    yield [{
+        'type': 'conversation',
+        'id': conversation.id,
+        'name': conversation.name,
+        'is_group': conversation.is_group,
+        'participants': participants,
+        'created_at': conversation.created_at.isoformat(),
+    }]
+
+    def message_records(rows):
+        # senders who have left the conversation are not in the participant list
+        missing = {row['sender_id'] for row in rows} - usernames.keys()
+        if missing:
+            usernames.update(User.objects.filter(id__in=missing).values_list('id', 'username'))
+        return [{
+            'type': 'message',
+            'conversation': conversation.id,
+            'id': row['id'],
+            'seq': row['seq'],
+            'sender': row['sender_id'],
+            'sender_username': usernames.get(row['sender_id']),
+            'content': row['content'],
+            # full microseconds, so an import keeps the exact order
+            'timestamp': row['timestamp'].isoformat(),
+        } for row in rows]
+
+    last_seq = 0
+    while last_seq < conversation.archived_seq:
+        blocks = list(conversation.archive_blocks.filter(first_seq__gt=last_seq).order_by('first_seq')[:100])
+        if not blocks:
+            break
+        for block in blocks:
+            yield message_records(archive.read_block(block))
+        last_seq = blocks[-1].first_seq
+
+    last_seq = conversation.archived_seq
+    while True:
+        rows = list(Message.objects
+                    .filter(conversation_id=conversation.id, seq__gt=last_seq)
+                    .order_by('seq')
+                    .values(*archive.FIELDS)[:CHUNK_SIZE])
+        if rows:
+            yield message_records(rows)
+        if len(rows) < CHUNK_SIZE:
+            break
+        last_seq = rows[-1]['seq']
+
+
+def conversation_records(conversation):
+    """Records of one conversation: its header, then every message by seq."""
+    for batch in conversation_batches(conversation):
+        yield from batch
+
+
+def export_batches(conversations):
+    for conversation in conversations:
+        yield from conversation_batches(conversation)
+
+
+def export_records(conversations):
+    for batch in export_batches(conversations):
+        yield from batch
+
+
+def encode_stream(records, codec):
+    """Encoded records, gathered into chunks of about WRITE_SIZE bytes."""
+    buffer = []
+    size = 0
+    for record in records:
+        data = codec.encode(record)
+        buffer.append(data)
+        size += len(data)
+        if size >= WRITE_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+
+async def aencode_export(conversations, codec):
+    """
+    ``encode_stream(export_records(conversations))`` for async responses:
+    each batch is fetched and encoded by ``data.run``, off the event loop,
+    and sent before the next one is read.
+    """
+    batches = export_batches(conversations)
+
+    def next_chunk():
+        batch = next(batches, None)
+        return None if batch is None else b''.join(map(codec.encode, batch))
+
+    while True:
+        chunk = await data.run(next_chunk)
+        if chunk is None:
+            return
+        yield chunk
+
+class HistoryImporter:
+    """
+    Loads an export into this database. Direct conversations are matched
+    (or created) by their participants' usernames; groups have no such key
+    and are always created, with their name and roles. Messages are appended
+    with their original timestamps and senders, ``batch_size`` rows per
+    ``bulk_create``. Imported history counts as read, like history that
+    existed before the inbox did.
+    """
+
+    def __init__(self, create_users=False, batch_size=1000):
+        self.create_users = create_users
+        self.batch_size = batch_size
+        self.user_ids = {}  # username -> id
+        self.conversations = {}  # exported conversation id -> Conversation
+        self.pending = []
+        self.messages = 0
+
+    def run(self, records):
+        for record in records:
+            record_type = record.get('type')
+            if record_type == 'conversation':
+                self.add_conversation(record)
+            elif record_type == 'message':
+                self.add_message(record)
+            else:
+                raise HistoryImportError(f'Unknown record type {record_type!r}')
+        self.flush()
+        for conversation in self.conversations.values():
+            for user in conversation.participants.all():
+                inbox.mark_read(user.id, conversation.id)
+        return {'conversations': len(self.conversations), 'messages': self.messages}
+
+    def resolve_user(self, username):
+        user_id = self.user_ids.get(username)
+        if user_id is None:
+            user_id = User.objects.filter(username=username).values_list('id', flat=True).first()
+            if user_id is None:
+                if not self.create_users:
+                    raise HistoryImportError(f'User {username!r} does not exist')
+                user_id = User.objects.create_user(username=username).id
+            self.user_ids[username] = user_id
+        return user_id
+
+    def add_conversation(self, record):
+        from .models import Conversation, ParticipantState
+        self.flush()
+        self.flush()
+        user_ids = [self.resolve_user(participant['username']) for participant in record['participants']]
+        users = list(User.objects.filter(id__in=user_ids).only('id', 'username'))
+        if not record.get('is_group'):
+            conversation, _ = Conversation.objects.get_or_create_for_participants(users)
+            self.conversations[record['id']] = conversation
+            return
+        roles = {}
+        for user_id, participant in zip(user_ids, record['participants']):
+            roles.setdefault(participant.get('role') or ParticipantState.MEMBER, []).append(user_id)
+        if len(roles.get(ParticipantState.OWNER, ())) != 1:
+            raise HistoryImportError(f'Group {record["id"]} needs exactly one owner')
+        owner = next(user for user in users if user.id == roles[ParticipantState.OWNER][0])
+        with transaction.atomic():
+            conversation = Conversation.objects.create_group(record.get('name') or '', owner, users)
+            if roles.get(ParticipantState.ADMIN):
+                (ParticipantState.objects
+                 .filter(conversation=conversation, user_id__in=roles[ParticipantState.ADMIN])
+                 .update(role=ParticipantState.ADMIN))
+        self.conversations[record['id']] = conversation
+
+    def add_message(self, record):
+        from .models import Message
+        conversation = self.conversations.get(record['conversation'])
+        if conversation is None:
+            raise HistoryImportError(f'Message {record.get("id")} comes before its conversation record')
+        if not record.get('sender_username'):
+            raise HistoryImportError(f'Message {record.get("id")} has no sender username')
+        timestamp = record['timestamp']
+        if isinstance(timestamp, str):
+            timestamp = parse_datetime(timestamp)
+        self.pending.append(Message(
+            conversation=conversation,
+            sender_id=self.resolve_user(record['sender_username']),
+            content=record['content'],
+            timestamp=timestamp,
+        ))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        from .models import Message
+        from .signals import messages_created
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        with transaction.atomic():
+            Message.objects.bulk_create(batch)
+            # bulk_create sends no post_save; keep the inbox summary current
+            messages_created.send(sender=Message, messages=batch)
+        self.messages += len(batch)
@@ -0,0 +1,184 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import DateTimeField, F, Q, Value
+from django.db.models.functions import Greatest
+
+PREVIEW_LENGTH = 140
+
+
+class ForeignMessage(Exception):
+    """A read receipt named a message of another conversation."""
+
+
+def record_messages(messages):
+    """
+    Fold newly stored messages into the denormalized inbox: the
+    conversation's last-message summary, each member's activity time and
+    unread counter, and the sender's read watermark (sending a message marks
+    the conversation read up to it). Costs a fixed number of UPDATEs per
+    conversation and sender, whatever the batch size.
+    """
+    from .models import Conversation, ParticipantState
+
+    by_conversation = defaultdict(list)
+    for message in messages:
+        by_conversation[message.conversation_id].append(message)
+
+    for conversation_id, batch in by_conversation.items():
+        newest = max(batch, key=lambda message: (message.timestamp, message.pk))
+        activity = Greatest('last_activity_at', Value(newest.timestamp, output_field=DateTimeField()))
+        with transaction.atomic():
+            Conversation.objects.filter(
+                Q(last_message_at__isnull=True)
+                | Q(last_message_at__lt=newest.timestamp)
+                | Q(last_message_at=newest.timestamp, last_message_id__lt=newest.pk),
+                pk=conversation_id,
+            ).update(
+                last_message=newest.pk,
+                last_message_preview=newest.content[:PREVIEW_LENGTH],
+                last_message_at=newest.timestamp,
+                last_message_sender=newest.sender_id,
+            )
+
+            states = ParticipantState.objects.filter(conversation_id=conversation_id)
+            by_sender = defaultdict(list)
+            for message in batch:
+                by_sender[message.sender_id].append(message.pk)
+            for sender_id, message_ids in by_sender.items():
+                states.exclude(user_id=sender_id).update(
+                    unread_count=F('unread_count') + len(message_ids),
+                    last_activity_at=activity,
+                )
+            for sender_id, message_ids in by_sender.items():
+                # writing a message means having read the conversation up to it
+                newest_own = max(message_ids)
+                states.filter(user_id=sender_id).update(
+                    read_watermark=Greatest('read_watermark', Value(newest_own)),
+                    delivered_watermark=Greatest('delivered_watermark', Value(newest_own)),
+                    unread_count=sum(1 for message in batch
+                                     if message.sender_id != sender_id and message.pk > newest_own),
+                    last_activity_at=activity,
+                )
+
+
+def record_deleted_message(message):
+    from .models import Conversation, ParticipantState
+
+    with transaction.atomic():
+        # members who had not read it yet lose one unread message
+        (ParticipantState.objects
+         .filter(conversation_id=message.conversation_id, read_watermark__lt=message.pk, unread_count__gt=0)
+         .exclude(user_id=message.sender_id)
+         .update(unread_count=F('unread_count') - 1))
+        if Conversation.objects.filter(pk=message.conversation_id, last_message_id=message.pk).exists():
+            refresh_summary(message.conversation_id)
+
+
+def refresh_summary(conversation_id):
+    """Recompute a conversation's last-message summary from the message table."""
+    from .models import Conversation, Message
+
+    last = (Message.objects.filter(conversation_id=conversation_id)
+            .order_by('-timestamp', '-id').first())
+    Conversation.objects.filter(pk=conversation_id).update(
+        last_message=last.pk if last else None,
+        last_message_preview=last.content[:PREVIEW_LENGTH] if last else '',
+        last_message_at=last.timestamp if last else None,
+        last_message_sender=last.sender_id if last else None,
+    )
+
+
+def mark_read(user_id, conversation_id, message_id=None):
+    """
+    Move a member's read watermark forward (to the newest message when
+    ``message_id`` is None), and the delivered watermark with it, and
+    recount what is still unread after it. Like ``advance_watermarks``,
+    never past the conversation's last message. Returns the updated
+    ParticipantState, or None for non-members; raises ForeignMessage if
+    ``message_id`` belongs to another conversation.
+    """
+    from .models import Conversation, Message, ParticipantState
+
+    with transaction.atomic():
+        state = (ParticipantState.objects.select_for_update()
+                 .filter(conversation_id=conversation_id, user_id=user_id).first())
+        if state is None:
+            return None
+        last_id = (Conversation.objects.filter(pk=conversation_id)
+                   .values_list('last_message_id', flat=True).first()) or 0
+        if message_id is None:
+            message_id = last_id
+        else:
+            # ids of deleted or archived messages are fine, other conversations' are not
+            owner = Message.objects.filter(pk=message_id).values_list('conversation_id', flat=True).first()
+            if owner is not None and owner != conversation_id:
+                raise ForeignMessage(message_id)
+            message_id = min(message_id, last_id)
+        if message_id <= state.read_watermark:
+            return state
+        state.read_watermark = message_id
+        state.delivered_watermark = max(state.delivered_watermark, message_id)
+        state.unread_count = (Message.objects
+                              .filter(conversation_id=conversation_id, id__gt=message_id)
+                              .exclude(sender_id=user_id).count())
+        state.save(update_fields=['read_watermark', 'delivered_watermark', 'unread_count'])
+    return state
+
+
+def advance_watermarks(acks):
+    """
+    Apply coalesced receipts, ``{(conversation_id, user_id): (delivered, read)}``
+    (message ids, 0 for none), in one transaction. Watermarks only move
+    forward and never past the conversation's last message; reading moves
+    the delivered watermark along and recounts the unread messages.
+    Returns the ParticipantStates that changed.
+    """
+    from .models import Conversation, Message, ParticipantState
+
+    conversation_ids = {conversation_id for conversation_id, _ in acks}
+    user_ids = {user_id for _, user_id in acks}
+    changed = []
+    with transaction.atomic():
+        last_ids = dict(Conversation.objects.filter(pk__in=conversation_ids).values_list('id', 'last_message_id'))
+        states = (ParticipantState.objects.select_for_update()
+                  .filter(conversation_id__in=conversation_ids, user_id__in=user_ids)
+                  .only('id', 'conversation_id', 'user_id', 'delivered_watermark', 'read_watermark', 'unread_count'))
+        for state in states:
+            ack = acks.get((state.conversation_id, state.user_id))
+            if ack is None:
+                continue  # another member of the conversation, acked by someone else's entry
+            last_id = last_ids.get(state.conversation_id) or 0
+            read = max(state.read_watermark, min(ack[1], last_id))
+            delivered = max(state.delivered_watermark, min(ack[0], last_id), read)
+            if read == state.read_watermark and delivered == state.delivered_watermark:
+                continue
+            if read != state.read_watermark:
+                state.read_watermark = read
+                state.unread_count = (Message.objects
+                                      .filter(conversation_id=state.conversation_id, id__gt=read)
+                                      .exclude(sender_id=state.user_id).count())
+            state.delivered_watermark = delivered
+            changed.append(state)
+        ParticipantState.objects.bulk_update(changed, ['delivered_watermark', 'read_watermark', 'unread_count'])
+    return changed
+
+
+def sync_members(conversation, user_ids=None):
+    """Create the ParticipantState rows missing for ``conversation``'s members."""
+    from .models import ParticipantState
+
+    if user_ids is None:
+        user_ids = conversation.participants.values_list('id', flat=True)
+    ParticipantState.objects.bulk_create(
+        [
+            ParticipantState(
+                conversation=conversation,
+                user_id=user_id,
+                last_activity_at=conversation.last_message_at or conversation.created_at,
+                read_watermark=conversation.last_message_id or 0,
+            )
+            for user_id in user_ids
+        ],
+        ignore_conflicts=True,
+    )
@@ -0,0 +1,38 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+_shutdown_callbacks = []
+
+
+def on_shutdown(callback):
+    """
+    Register an async callable to run when the ASGI server shuts down.
+    Usable as a decorator.
+    """
+    _shutdown_callbacks.append(callback)
+    return callback
+
+
+async def run_shutdown_callbacks():
+    for callback in _shutdown_callbacks:
+        try:
+            await callback()
+        except Exception:
+            logger.exception('Shutdown callback %r failed', callback)
+
+
+async def lifespan_app(scope, receive, send):
+    """
+    ASGI ``lifespan`` handler. Servers that speak the lifespan protocol
+    (uvicorn, hypercorn) give us a chance to drain per-process buffers
+    before the worker exits.
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await run_shutdown_callbacks()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
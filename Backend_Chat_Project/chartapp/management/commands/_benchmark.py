@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from chartapp.benchmark import test_databases
+
+
+class BenchmarkCommand(BaseCommand):
+    """
+    Base of the benchmark commands: ``benchmark(options)`` runs against a
+    throwaway test database and its report is printed or written as JSON.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def benchmark(self, options):
+        raise NotImplementedError
+
+    def handle(self, *args, **options):
+        # never touch real data: the same test database a test run would use
+        with test_databases():
+            report = self.benchmark(options)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f'Benchmark report written to {options["output"]}'))
+        else:
+            self.stdout.write(output)
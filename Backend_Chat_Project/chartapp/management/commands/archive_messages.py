@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from chartapp.archive import archive_old_messages, get_options
+
+
+class Command(BaseCommand):
+    help = ('Move messages older than CHAT_ARCHIVE["AGE_DAYS"] into compressed archive segments. '
+            'Safe to interrupt and run again; it resumes where it stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--age-days', type=int, help='Archive messages older than this many days')
+        parser.add_argument('--conversation', type=int, action='append', dest='conversations',
+                            help='Only archive this conversation (repeatable)')
+        parser.add_argument('--max-blocks', type=int,
+                            help='Stop each conversation after this many blocks (to spread the work out)')
+
+    def handle(self, *args, **options):
+        age_days = options['age_days'] if options['age_days'] is not None else get_options()['AGE_DAYS']
+        results = archive_old_messages(age_days, options['conversations'], options['max_blocks'])
+        for conversation_id, count in results.items():
+            self.stdout.write(f'Conversation {conversation_id}: {count} messages archived')
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {sum(results.values())} messages older than {age_days} days '
+            f'from {len(results)} conversations'
+        ))
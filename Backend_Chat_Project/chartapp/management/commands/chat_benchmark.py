@@ -0,0 +1,37 @@
+from chartapp.benchmark import run_benchmark
+from chartapp.management.commands._benchmark import BenchmarkCommand
+
+
+class Command(BenchmarkCommand):
+    help = ('Load-test the chat WebSocket consumer in-process against a throwaway test database '
+            'and print latency, throughput, query and memory figures as JSON')
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--conversations', type=int, default=100,
+                            help='Two-person conversations, one socket per participant')
+        parser.add_argument('--messages', type=int, default=2000, help='Chat messages to send')
+        parser.add_argument('--rate', type=float, default=100,
+                            help='Messages per second to send (0: as fast as possible)')
+        parser.add_argument('--typing-frames', type=int, default=20,
+                            help='Keystroke frames each typing user sends back to back')
+        parser.add_argument('--abusers', type=int, default=0,
+                            help='Sockets flooding frames during a repeat of the chat traffic')
+        parser.add_argument('--abuse-rate', type=float, default=1000,
+                            help='Frames per second each abusing socket sends')
+        parser.add_argument('--layer', choices=['memory', 'redis'], default='memory',
+                            help='In-memory channel layer, or the configured CHANNEL_LAYERS (Redis)')
+        parser.add_argument('--persistence', choices=['sync', 'write_behind'], default='sync',
+                            help='CHAT_MESSAGE_PERSISTENCE for the run')
+
+    def benchmark(self, options):
+        return run_benchmark(
+            layer=options['layer'],
+            persistence=options['persistence'],
+            conversations=options['conversations'],
+            messages=options['messages'],
+            rate=options['rate'],
+            typing_frames=options['typing_frames'],
+            abusers=options['abusers'],
+            abuse_rate=options['abuse_rate'],
+        )
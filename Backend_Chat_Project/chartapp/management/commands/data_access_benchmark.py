@@ -0,0 +1,27 @@
+from chartapp.benchmark import run_data_access_benchmark
+from chartapp.data import MODES
+from chartapp.management.commands._benchmark import BenchmarkCommand
+
+
+class Command(BenchmarkCommand):
+    help = ('Compare the CHAT_DB_EXECUTOR modes (thread pool, native async ORM, sync_to_async wrappers) '
+            'on concurrent consumer database work against a throwaway test database')
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--sockets', type=int, default=1000, help='Sockets doing their database work at once')
+        parser.add_argument('--rounds', type=int, default=3)
+        parser.add_argument('--workers', type=int, default=16, help='MAX_WORKERS for the pool mode')
+        parser.add_argument('--mode', choices=MODES, action='append', dest='modes',
+                            help='Only run this mode (repeatable; default: all)')
+        parser.add_argument('--db-latency-ms', type=float, default=0,
+                            help='Simulated database round trip added to every query')
+
+    def benchmark(self, options):
+        return run_data_access_benchmark(
+            sockets=options['sockets'],
+            rounds=options['rounds'],
+            workers=options['workers'],
+            modes=options['modes'],
+            db_latency_ms=options['db_latency_ms'],
+        )
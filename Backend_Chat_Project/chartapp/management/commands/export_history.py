@@ -0,0 +1,39 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chartapp.history import CODECS, encode_stream, export_records
+from chartapp.models import Conversation
+
+
+class Command(BaseCommand):
+    help = ('Stream the history of conversations (archived messages included) as NDJSON or MessagePack, '
+            'to a file or stdout.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conversation', type=int, action='append', dest='conversations',
+                            help='Export this conversation (repeatable)')
+        parser.add_argument('--user', help='Export every conversation of this username')
+        parser.add_argument('--encoding', choices=sorted(CODECS), default='ndjson')
+        parser.add_argument('--output', help='File to write (default: stdout)')
+
+    def handle(self, *args, **options):
+        conversations = Conversation.objects.order_by('id')
+        if options['conversations']:
+            conversations = conversations.filter(id__in=options['conversations'])
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f'User {options["user"]!r} does not exist')
+            conversations = conversations.filter(participants=user)
+
+        chunks = encode_stream(export_records(conversations), CODECS[options['encoding']])
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+        else:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
@@ -0,0 +1,25 @@
+from chartapp.benchmark import run_group_benchmark
+from chartapp.fanout import STRATEGIES
+from chartapp.management.commands._benchmark import BenchmarkCommand
+
+
+class Command(BenchmarkCommand):
+    help = ('Send messages in one large group with every member online, in-process against a throwaway '
+            'test database, and report how long each took to reach all members per CHAT_FANOUT strategy')
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--members', type=int, default=5000, help='Group members, one socket each')
+        parser.add_argument('--messages', type=int, default=20, help='Messages to send, one at a time')
+        parser.add_argument('--strategy', choices=STRATEGIES, action='append', dest='strategies',
+                            help='Only run this fan-out strategy (repeatable; default: all)')
+        parser.add_argument('--layer', choices=['memory', 'redis'], default='memory',
+                            help='In-memory channel layer, or the configured CHANNEL_LAYERS (Redis)')
+
+    def benchmark(self, options):
+        return run_group_benchmark(
+            layer=options['layer'],
+            members=options['members'],
+            messages=options['messages'],
+            strategies=options['strategies'],
+        )
@@ -0,0 +1,34 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chartapp.history import CODECS, HistoryImporter, HistoryImportError
+
+
+class Command(BaseCommand):
+    help = ('Load an export_history file. Conversations are matched by participant usernames and '
+            'messages keep their timestamps and senders; importing the same file twice adds the messages twice.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="Export file, or '-' for stdin")
+        parser.add_argument('--encoding', choices=sorted(CODECS),
+                            help='Defaults to msgpack for .msgpack files and ndjson otherwise')
+        parser.add_argument('--create-users', action='store_true',
+                            help='Create missing users (with unusable passwords) instead of failing')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        encoding = options['encoding'] or ('msgpack' if options['file'].endswith('.msgpack') else 'ndjson')
+        codec = CODECS[encoding]
+        importer = HistoryImporter(create_users=options['create_users'], batch_size=options['batch_size'])
+        try:
+            if options['file'] == '-':
+                results = importer.run(codec.decode(sys.stdin.buffer))
+            else:
+                with open(options['file'], 'rb') as source:
+                    results = importer.run(codec.decode(source))
+        except HistoryImportError as exc:
+            raise CommandError(f'{exc} ({importer.messages} messages were imported before the error)')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {results["messages"]} messages into {results["conversations"]} conversations'
+        ))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chartapp.search import SearchNotSupported, get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text message search index from the message table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database alias to rebuild')
+
+    def handle(self, *args, **options):
+        try:
+            backend = get_search_backend(options['database'])
+        except SearchNotSupported as exc:
+            raise CommandError(str(exc))
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
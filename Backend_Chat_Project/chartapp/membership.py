@@ -0,0 +1,235 @@
+"""
+Conversation members and their roles, cached per worker process.
+
+A group can have thousands of members, so nothing on the message path
+loads them from the database: sockets and views ask ``get_member_cache()``,
+which keeps one shared ``Members`` object per conversation and checks it
+against a version token in the Django cache (one cache read). Membership
+changes bump the token, so every worker reloads on its next lookup. That
+only works when the token is in a shared cache (Redis, see ``CACHE_URL``
+in settings): with a per-process cache (local memory, dummy) another
+worker's change would go unseen, so every lookup reads the members from the
+database instead.
+
+Changes made through the functions below are also announced to the
+conversation's sockets as one ``members_changed`` event, which carries the
+new version so sockets update their copy without a reload.
+"""
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+
+from . import metrics
+from .wire import new_event_id
+
+logger = logging.getLogger(__name__)
+
+
+def get_options():
+    options = getattr(settings, 'CHAT_GROUPS', {})
+    return {
+        'MAX_MEMBERS': options.get('MAX_MEMBERS', 10000),
+        'CACHED_CONVERSATIONS': options.get('CACHED_CONVERSATIONS', 10000),
+    }
+
+
+def versions_shared():
+    """True when version tokens live in a cache every worker process sees."""
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (LocMemCache, DummyCache))
+
+
+def version_key(conversation_id):
+    return f'chat:members:{conversation_id}:version'
+
+
+def get_version(conversation_id):
+    version = cache.get(version_key(conversation_id))
+    if version is None:
+        cache.add(version_key(conversation_id), uuid.uuid4().hex, None)
+        version = cache.get(version_key(conversation_id))
+    return version
+
+
+def bump_version(conversation_id):
+    version = uuid.uuid4().hex
+    cache.set(version_key(conversation_id), version, None)
+    return version
+
+
+def invalidate(conversation_id):
+    # after commit: a worker reloading before then would cache the old rows under the new version
+    transaction.on_commit(lambda: bump_version(conversation_id))
+
+
+class Members:
+    """The member ids and roles of one conversation at one version; never changed in place."""
+    __slots__ = ('conversation_id', 'version', 'roles')
+
+    def __init__(self, conversation_id, version, roles):
+        self.conversation_id = conversation_id
+        self.version = version
+        self.roles = roles  # user_id -> role
+
+    def __contains__(self, user_id):
+        return user_id in self.roles
+
+    def __iter__(self):
+        return iter(self.roles)
+
+    def __len__(self):
+        return len(self.roles)
+
+    def role(self, user_id):
+        return self.roles.get(user_id)
+
+    def changed(self, changes, version):
+        # changes: [(user_id, role or None for removed)]
+        roles = dict(self.roles)
+        for user_id, role in changes:
+            if role is None:
+                roles.pop(user_id, None)
+            else:
+                roles[user_id] = role
+        return Members(self.conversation_id, version, roles)
+
+
+class MemberCache:
+    """Least recently used ``Members`` of up to ``max_conversations`` conversations."""
+
+    def __init__(self, max_conversations=10000):
+        self.max_conversations = max_conversations
+        self.entries = OrderedDict()
+        # lookups run on the database pool's threads as well as the event loop
+        self.lock = threading.Lock()
+
+    def get(self, conversation_id):
+        from .models import ParticipantState
+        if not versions_shared():
+            # nothing tells this process about other workers' changes: a removed
+            # member or demoted admin must not keep access through a stale copy
+            roles = ParticipantState.objects.filter(conversation_id=conversation_id).values_list('user_id', 'role')
+            return Members(conversation_id, None, dict(roles))
+        # the version is read first: a change racing with the load below makes the next lookup reload
+        version = get_version(conversation_id)
+        with self.lock:
+            members = self.entries.get(conversation_id)
+            if members is not None and members.version == version:
+                self.entries.move_to_end(conversation_id)
+                return members
+        roles = dict(ParticipantState.objects.filter(conversation_id=conversation_id).values_list('user_id', 'role'))
+        return self.store(Members(conversation_id, version, roles))
+
+    def apply(self, members, changes, version):
+        """The ``Members`` after a ``members_changed`` event, computed once per process."""
+        with self.lock:
+            current = self.entries.get(members.conversation_id)
+            if current is not None and current.version == version:
+                return current
+        return self.store(members.changed(changes, version))
+
+    def store(self, members):
+        with self.lock:
+            self.entries[members.conversation_id] = members
+            self.entries.move_to_end(members.conversation_id)
+            while len(self.entries) > self.max_conversations:
+                self.entries.popitem(last=False)
+        return members
+
+
+def announce(conversation_id, changes):
+    """
+    Tell the conversation's sockets about ``changes`` once the transaction
+    commits: a list of ``(user, role)`` pairs, role None for removed members.
+    """
+    def send():
+        from channels.layers import get_channel_layer
+        # the change is committed: a cache or channel layer outage must not turn it into an error
+        try:
+            version = bump_version(conversation_id)
+            channel_layer = get_channel_layer()
+            if channel_layer is None:
+                return
+            async_to_sync(metrics.group_send)(channel_layer, f'chat_{conversation_id}', {
+                'type': 'members_changed',
+                'event_id': new_event_id(),
+                'conversation': conversation_id,
+                'version': version,
+                'changes': [{'user': {'id': user.id, 'username': user.username}, 'role': role}
+                            for user, role in changes],
+            })
+        except Exception:
+            logger.exception('Announcing member changes of conversation %s failed', conversation_id)
+    transaction.on_commit(send)
+
+
+def add_members(conversation, users, role=None):
+    """Add ``users`` to a group (existing members keep their role). Returns the users added."""
+    from .models import ParticipantState
+    role = role or ParticipantState.MEMBER
+    with transaction.atomic():
+        existing = set(ParticipantState.objects
+                       .filter(conversation=conversation, user__in=users)
+                       .values_list('user_id', flat=True))
+        added = [user for user in users if user.id not in existing]
+        if not added:
+            return []
+        # post_add creates their ParticipantState rows
+        conversation.participants.add(*added)
+        if role != ParticipantState.MEMBER:
+            ParticipantState.objects.filter(conversation=conversation, user__in=added).update(role=role)
+        announce(conversation.id, [(user, role) for user in added])
+    return added
+
+
+def remove_member(conversation, user):
+    with transaction.atomic():
+        # post_remove deletes the ParticipantState row
+        conversation.participants.remove(user)
+        announce(conversation.id, [(user, None)])
+
+
+def set_role(conversation, user, role):
+    """
+    Change a member's role. Making someone the owner hands ownership over:
+    the previous owner becomes an admin.
+    """
+    from django.contrib.auth.models import User
+    from .models import ParticipantState
+    with transaction.atomic():
+        states = ParticipantState.objects.select_for_update().filter(conversation=conversation)
+        changes = []
+        if role == ParticipantState.OWNER:
+            previous = list(states.filter(role=ParticipantState.OWNER).exclude(user=user).values_list('user_id', flat=True))
+            states.filter(user_id__in=previous).update(role=ParticipantState.ADMIN)
+            changes += [(previous_owner, ParticipantState.ADMIN)
+                        for previous_owner in User.objects.filter(id__in=previous).only('id', 'username')]
+        states.filter(user=user).update(role=role)
+        changes.append((user, role))
+        announce(conversation.id, changes)
+
+
+_member_cache = None
+
+
+def get_member_cache():
+    global _member_cache
+    if _member_cache is None:
+        _member_cache = MemberCache(get_options()['CACHED_CONVERSATIONS'])
+    return _member_cache
+
+
+@receiver(setting_changed)
+def reset_member_cache(setting, **kwargs):
+    global _member_cache
+    if setting == 'CHAT_GROUPS':
+        _member_cache = None
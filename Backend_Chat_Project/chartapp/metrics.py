@@ -0,0 +1,308 @@
+"""
+Process-local metrics with Prometheus text exposition.
+
+Every metric keeps one shard per thread. Recording only touches the
+calling thread's shard (a dict update, no lock), and a scrape sums the
+shards. Consumers all run on the event loop thread and share one shard;
+sync views and ``sync_to_async`` work get one per worker thread.
+
+Each worker process serves its own numbers on the metrics endpoint, so
+scrape every worker (or run one worker per scrape target). Only staff
+users and the scrapers allowed by ``CHAT_METRICS`` can read it.
+"""
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = self._shards.get(threading.get_ident())
+        if shard is None:
+            # only a thread's first sample takes the lock
+            with self._lock:
+                shard = self._shards.setdefault(threading.get_ident(), {})
+        return shard
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _merged(self):
+        raise NotImplementedError
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            '{}="{}"'.format(name, value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+            for name, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._merged().get(self._key(labels), 0)
+
+    def _merged(self):
+        totals = {}
+        for shard in list(self._shards.values()):
+            for key, value in list(shard.items()):
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def _samples(self):
+        return [f'{self.name}{self._format_labels(key)} {value}' for key, value in sorted(self._merged().items())]
+
+
+class Gauge(Counter):
+    """A counter that can go down; per-thread deltas sum to the current value."""
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        # per bucket counts (non-cumulative), then +Inf, then sum
+        row = shard.get(key)
+        if row is None:
+            row = shard[key] = [0] * (len(self.buckets) + 2)
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _merged(self):
+        totals = {}
+        for shard in list(self._shards.values()):
+            for key, row in list(shard.items()):
+                total = totals.get(key)
+                if total is None:
+                    totals[key] = list(row)
+                else:
+                    for index, value in enumerate(row):
+                        total[index] += value
+        return totals
+
+    def _samples(self):
+        lines = []
+        for key, row in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), row):
+                cumulative += count
+                le = bound if bound == '+Inf' else repr(float(bound))
+                lines.append(f'{self.name}_bucket{self._format_labels(key, [("le", le)])} {cumulative}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {row[-1]}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {cumulative}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# REST API
+http_requests = registry.register(Counter(
+    'chat_http_requests_total', 'HTTP requests by route, method and status.', ('route', 'method', 'status')))
+http_request_duration = registry.register(Histogram(
+    'chat_http_request_duration_seconds', 'HTTP request latency by route.', ('route', 'method')))
+http_db_queries = registry.register(Histogram(
+    'chat_http_db_queries', 'Database queries per HTTP request by route.', ('route',), QUERY_COUNT_BUCKETS))
+http_db_duration = registry.register(Histogram(
+    'chat_http_db_duration_seconds', 'Time spent in database queries per HTTP request by route.', ('route',)))
+
+# HTTP event fallback (chartapp.events)
+event_listeners = registry.register(Gauge(
+    'chat_event_listeners', 'Open SSE streams and waiting long polls in this worker.',
+    ('transport',)))
+
+# WebSockets
+ws_active_sockets = registry.register(Gauge(
+    'chat_ws_active_sockets', 'Open WebSocket connections in this worker.', ('consumer',)))
+ws_auth_failures = registry.register(Counter(
+    'chat_ws_auth_failures_total', 'Rejected WebSocket handshakes by close code '
+    '(4000 expired token, 4001 invalid token, 4002 missing token).', ('code',)))
+ws_frames_received = registry.register(Counter(
+    'chat_ws_frames_received_total', 'Frames received from clients by type.', ('type',)))
+ws_frames_sent = registry.register(Counter(
+    'chat_ws_frames_sent_total', 'Frames sent to clients by type.', ('type',)))
+ws_rate_limited = registry.register(Counter(
+    'chat_ws_rate_limited_total', 'Client frames dropped by rate limits, by frame kind and the limit '
+    '(connection or user) that refused them.', ('type', 'scope')))
+ws_outbound_dropped = registry.register(Counter(
+    'chat_ws_outbound_dropped_total', 'Frames dropped from full outbound buffers by type.', ('type',)))
+ws_forced_closes = registry.register(Counter(
+    'chat_ws_forced_closes_total', 'Sockets closed by the server for misbehaving '
+    '(rate_limit, slow_consumer, frame_too_large).', ('reason',)))
+ws_auth_cache = registry.register(Counter(
+    'chat_ws_auth_cache_total', 'WebSocket handshake token lookups by result (hit or miss).', ('result',)))
+receipt_acks = registry.register(Counter(
+    'chat_receipt_acks_total', 'Delivery and read acks received from clients.'))
+receipt_rows_written = registry.register(Counter(
+    'chat_receipt_rows_written_total', 'Member watermarks moved by receipt flushes.'))
+group_send_duration = registry.register(Histogram(
+    'chat_group_send_duration_seconds', 'Channel layer group_send latency by event type.', ('type',)))
+
+
+async def group_send(channel_layer, group, event):
+    """``channel_layer.group_send`` with its latency recorded."""
+    started = time.perf_counter()
+    try:
+        await channel_layer.group_send(group, event)
+    finally:
+        group_send_duration.observe(time.perf_counter() - started, type=event.get('type', ''))
+
+
+class QueryTimer:
+    """Counts the queries of one request and the time they took."""
+    __slots__ = ('count', 'duration')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+
+# the timer of the request being served; context variables follow the request
+# into sync_to_async threads and the chartapp.data pool
+current_query_timer = ContextVar('chat_query_timer', default=None)
+
+
+def _time_query(execute, sql, params, many, context):
+    queries = current_query_timer.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries.count += 1
+        queries.duration += time.perf_counter() - started
+
+
+def install_query_timer(connection):
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+@receiver(connection_created)
+def _on_connection_created(sender, connection, **kwargs):
+    install_query_timer(connection)
+
+
+class MetricsMiddleware:
+    """
+    Records latency, status and database work of every HTTP request,
+    labelled by URL route pattern (not the raw path, which would make one
+    series per conversation id). Works in sync and async middleware chains.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        from django.db import connections
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        for connection in connections.all(initialized_only=True):
+            install_query_timer(connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = QueryTimer()
+        token = current_query_timer.set(queries)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_query_timer.reset(token)
+        self.record(request, response, time.perf_counter() - started, queries)
+        return response
+
+    async def __acall__(self, request):
+        queries = QueryTimer()
+        token = current_query_timer.set(queries)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_query_timer.reset(token)
+        self.record(request, response, time.perf_counter() - started, queries)
+        return response
+
+    def record(self, request, response, elapsed, queries):
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None else 'unmatched'
+        http_requests.inc(route=route, method=request.method, status=response.status_code)
+        http_request_duration.observe(elapsed, route=route, method=request.method)
+        http_db_queries.observe(queries.count, route=route)
+        http_db_duration.observe(queries.duration, route=route)
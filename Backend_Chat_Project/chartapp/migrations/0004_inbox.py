@@ -0,0 +1,83 @@
+# Generated by Django 5.2.6 on 2026-10-18 15:35
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_inbox(apps, schema_editor):
+    # existing history is treated as read: unread counters start at zero
+    Conversation = apps.get_model('chartapp', 'Conversation')
+    Message = apps.get_model('chartapp', 'Message')
+    ParticipantState = apps.get_model('chartapp', 'ParticipantState')
+    Membership = Conversation.participants.through
+
+    for conversation in Conversation.objects.iterator():
+        last = (Message.objects.filter(conversation_id=conversation.id)
+                .order_by('-timestamp', '-id').first())
+        if last is not None:
+            conversation.last_message_id = last.id
+            conversation.last_message_preview = last.content[:140]
+            conversation.last_message_at = last.timestamp
+            conversation.last_message_sender_id = last.sender_id
+            conversation.save(update_fields=[
+                'last_message', 'last_message_preview', 'last_message_at', 'last_message_sender'
+            ])
+        member_ids = Membership.objects.filter(conversation_id=conversation.id).values_list('user_id', flat=True)
+        ParticipantState.objects.bulk_create([
+            ParticipantState(
+                conversation_id=conversation.id,
+                user_id=user_id,
+                last_activity_at=last.timestamp if last else conversation.created_at,
+                read_watermark=last.id if last else 0,
+            )
+            for user_id in member_ids
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chartapp', '0003_message_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='chartapp.message'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=140),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='ParticipantState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('read_watermark', models.BigIntegerField(default=0)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participant_states', to='chartapp.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'last_activity_at', 'conversation'], name='participant_inbox_idx')],
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'user'), name='participant_state_unique')],
+            },
+        ),
+        migrations.RunPython(backfill_inbox, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,67 @@
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE chartapp_message_fts USING fts5(
+        content,
+        content='chartapp_message',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """,
+    # keep the index in step with the table, bulk inserts and cascades included
+    """
+    CREATE TRIGGER chartapp_message_fts_insert AFTER INSERT ON chartapp_message BEGIN
+        INSERT INTO chartapp_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chartapp_message_fts_delete AFTER DELETE ON chartapp_message BEGIN
+        INSERT INTO chartapp_message_fts(chartapp_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chartapp_message_fts_update AFTER UPDATE OF content ON chartapp_message BEGIN
+        INSERT INTO chartapp_message_fts(chartapp_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chartapp_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    "INSERT INTO chartapp_message_fts(chartapp_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS chartapp_message_fts_update',
+    'DROP TRIGGER IF EXISTS chartapp_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chartapp_message_fts_insert',
+    'DROP TABLE IF EXISTS chartapp_message_fts',
+]
+
+POSTGRES_FORWARD = [
+    "CREATE INDEX chartapp_message_content_fts ON chartapp_message USING GIN (to_tsvector('simple', content))",
+]
+
+POSTGRES_BACKWARD = [
+    'DROP INDEX IF EXISTS chartapp_message_content_fts',
+]
+
+
+def _run(statements_by_vendor):
+    def run(apps, schema_editor):
+        for statement in statements_by_vendor.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chartapp', '0004_inbox'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            _run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            _run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.6 on 2026-10-18 15:38
+
+from django.db import migrations, models
+
+
+def backfill_participant_key(apps, schema_editor):
+    # duplicate pairs created before the key existed keep the oldest
+    # conversation as the canonical one; later duplicates stay unkeyed
+    Conversation = apps.get_model('chartapp', 'Conversation')
+    Membership = Conversation.participants.through
+
+    members = {}
+    for conversation_id, user_id in Membership.objects.values_list('conversation_id', 'user_id').iterator():
+        members.setdefault(conversation_id, []).append(user_id)
+
+    seen = set()
+    for conversation_id in Conversation.objects.order_by('id').values_list('id', flat=True).iterator():
+        user_ids = sorted(set(members.get(conversation_id, ())))
+        if not user_ids:
+            continue
+        key = ':'.join(str(user_id) for user_id in user_ids)
+        if key in seen:
+            continue
+        seen.add(key)
+        Conversation.objects.filter(id=conversation_id).update(participant_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chartapp', '0005_message_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='participant_key',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(backfill_participant_key, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='conversation',
+            name='participant_key',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
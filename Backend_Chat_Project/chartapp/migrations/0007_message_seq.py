@@ -0,0 +1,54 @@
+# Generated by Django 5.2.6 on 2026-10-18 15:45
+
+from django.db import migrations, models
+
+
+def backfill_seq(apps, schema_editor):
+    # number existing history in display order, conversation by conversation
+    Conversation = apps.get_model('chartapp', 'Conversation')
+    Message = apps.get_model('chartapp', 'Message')
+
+    rows = (Message.objects.order_by('conversation_id', 'timestamp', 'id')
+            .values_list('id', 'conversation_id').iterator(chunk_size=2000))
+    batch = []
+    last_seq = {}
+    for message_id, conversation_id in rows:
+        seq = last_seq[conversation_id] = last_seq.get(conversation_id, 0) + 1
+        batch.append(Message(id=message_id, seq=seq))
+        if len(batch) >= 1000:
+            Message.objects.bulk_update(batch, ['seq'])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ['seq'])
+    for conversation_id, seq in last_seq.items():
+        Conversation.objects.filter(id=conversation_id).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chartapp', '0006_conversation_participant_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('conversation', 'seq'), name='message_conv_seq_unique'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.6 on 2026-10-18 16:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # auth_user belongs to django.contrib.auth, so the index behind the user
+    # directory's case-insensitive prefix search is created here
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chartapp', '0007_message_seq'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX chartapp_user_username_lower_idx ON auth_user (LOWER(username), id)',
+            'DROP INDEX chartapp_user_username_lower_idx',
+        ),
+    ]
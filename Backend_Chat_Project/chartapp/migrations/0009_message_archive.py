@@ -0,0 +1,39 @@
+# Generated by Django 5.2.6 on 2026-10-18 15:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chartapp', '0008_user_username_lower_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='archived_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ArchiveBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.CharField(max_length=64)),
+                ('offset', models.BigIntegerField()),
+                ('length', models.PositiveIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('first_seq', models.BigIntegerField()),
+                ('last_seq', models.BigIntegerField()),
+                ('min_id', models.BigIntegerField()),
+                ('max_id', models.BigIntegerField()),
+                ('min_timestamp', models.DateTimeField()),
+                ('max_timestamp', models.DateTimeField()),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_blocks', to='chartapp.conversation')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['conversation', 'last_seq'], name='archive_block_conv_seq_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-18 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chartapp', '0009_message_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='is_group',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='name',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='participantstate',
+            name='role',
+            field=models.CharField(choices=[('owner', 'Owner'), ('admin', 'Admin'), ('member', 'Member')], default='member', max_length=16),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.6 on 2026-10-18 16:52
+
+from django.db import migrations, models
+
+
+def backfill_delivered(apps, schema_editor):
+    # whatever was read had been delivered
+    ParticipantState = apps.get_model('chartapp', 'ParticipantState')
+    ParticipantState.objects.update(delivered_watermark=models.F('read_watermark'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chartapp', '0010_group_conversations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participantstate',
+            name='delivered_watermark',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_delivered, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+from django.db import migrations
+
+# On SQLite, 0007 and 0012 rebuilt chartapp_message to alter it, which drops
+# the triggers 0005 put on it: messages stopped reaching the FTS5 index.
+# Any later migration that rebuilds the table must restore them the same way.
+SQLITE_FORWARD = [
+    'DROP TRIGGER IF EXISTS chartapp_message_fts_insert',
+    'DROP TRIGGER IF EXISTS chartapp_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chartapp_message_fts_update',
+    """
+    CREATE TRIGGER chartapp_message_fts_insert AFTER INSERT ON chartapp_message BEGIN
+        INSERT INTO chartapp_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chartapp_message_fts_delete AFTER DELETE ON chartapp_message BEGIN
+        INSERT INTO chartapp_message_fts(chartapp_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chartapp_message_fts_update AFTER UPDATE OF content ON chartapp_message BEGIN
+        INSERT INTO chartapp_message_fts(chartapp_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chartapp_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    # index the messages written while the triggers were missing
+    "INSERT INTO chartapp_message_fts(chartapp_message_fts) VALUES ('rebuild')",
+]
+
+
+def restore_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return  # the PostgreSQL index is an expression index on the table itself
+    for statement in SQLITE_FORWARD:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chartapp', '0012_message_client_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(restore_triggers, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,7 @@
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
 from django.contrib.auth.models import User
-from django.db.models import Prefetch
+from django.db.models import Prefetch, Q
+from django.utils import timezone
 
 
 
@@ -10,12 +11,115 @@ class ConversationManager(models.Manager):
             Prefetch('participants', queryset=User.objects.only('id', 'username'))
         )
 
+    def get_or_create_for_participants(self, users):
+        """
+        Return ``(conversation, created)`` for exactly these users, found by
+        the unique participant key in one indexed lookup. A concurrent
+        create of the same pair loses on the unique constraint and gets the
+        winner's conversation.
+        """
+        key = Conversation.participant_key_for(user.id for user in users)
+        conversation = self.filter(participant_key=key).first()
+        if conversation is not None:
+            return conversation, False
+        try:
+            with transaction.atomic():
+                conversation = self.create(participant_key=key)
+                conversation.participants.set(users)
+        except IntegrityError:
+            return self.get(participant_key=key), False
+        return conversation, True
+
+    def create_group(self, name, owner, users):
+        """
+        Create a group conversation of ``users`` (``owner`` included) with
+        ``owner`` as its owner. Groups have no participant key: any number
+        of groups may share the same members.
+        """
+        with transaction.atomic():
+            conversation = self.create(name=name, is_group=True)
+            conversation.participants.set(users)
+            ParticipantState.objects.filter(conversation=conversation, user=owner).update(role=ParticipantState.OWNER)
+        return conversation
+
+    def allocate_seqs(self, conversation_id, count):
+        """
+        Reserve ``count`` sequence numbers in a conversation and return the
+        first. Must run inside the transaction that inserts the messages:
+        the counter row stays locked until commit, so messages of one
+        conversation become visible in sequence order.
+        """
+        self.filter(id=conversation_id).update(last_seq=models.F('last_seq') + count)
+        last_seq = self.filter(id=conversation_id).values_list('last_seq', flat=True).get()
+        return last_seq - count + 1
+
+
+class MessageQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        # number messages without a seq in order, per conversation, in the inserting transaction
+        objs = list(objs)
+        with transaction.atomic(using=self.db, savepoint=False):
+            unnumbered = {}
+            for message in objs:
+                if message.seq is None:
+                    unnumbered.setdefault(message.conversation_id, []).append(message)
+            for conversation_id, messages in unnumbered.items():
+                first = Conversation.objects.db_manager(self.db).allocate_seqs(conversation_id, len(messages))
+                for offset, message in enumerate(messages):
+                    message.seq = first + offset
+            return super().bulk_create(objs, *args, **kwargs)
+
+    def send(self, conversation, sender, content, client_id=None):
+        """
+        Return ``(message, created)``. A send repeating a ``client_id`` the
+        sender already used in the conversation (a client retrying after a
+        lost reply) gets the stored message back instead of a duplicate; a
+        concurrent retry loses on the unique constraint the same way.
+        """
+        if not client_id:
+            return self.create(conversation=conversation, sender=sender, content=content), True
+        # look on the primary: a replica may not have the first attempt yet
+        using = router.db_for_write(self.model)
+        lookup = {'conversation': conversation, 'sender': sender, 'client_id': client_id}
+        message = self.using(using).filter(**lookup).first()
+        if message is not None:
+            return message, False
+        try:
+            with transaction.atomic(using=using):
+                return self.using(using).create(content=content, **lookup), True
+        except IntegrityError:
+            return self.using(using).get(**lookup), False
+
 
 class Conversation(models.Model):
     participants = models.ManyToManyField(User, related_name='conversations')
     created_at = models.DateTimeField(auto_now_add=True)
+    # sorted participant ids ("3:17"); makes "the conversation between these users" unique.
+    # None for groups, whose members change
+    participant_key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    # groups have any number of members with roles (ParticipantState.role) and may be named
+    is_group = models.BooleanField(default=False)
+    name = models.CharField(max_length=100, blank=True, default='')
+
+    # denormalized summary of the newest message, maintained by inbox.record_messages()
+    last_message = models.ForeignKey(
+        'Message', null=True, blank=True, on_delete=models.DO_NOTHING,
+        db_constraint=False, related_name='+'
+    )
+    last_message_preview = models.CharField(max_length=140, blank=True, default='')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_sender = models.ForeignKey(
+        User, null=True, blank=True, on_delete=models.SET_NULL, related_name='+'
+    )
+    # highest Message.seq handed out in this conversation
+    last_seq = models.BigIntegerField(default=0)
+    # messages up to this seq live in archive segments, not in the message table
+    archived_seq = models.BigIntegerField(default=0)
     objects = ConversationManager()
 
+    @staticmethod
+    def participant_key_for(user_ids):
+        return ':'.join(str(user_id) for user_id in sorted(set(int(user_id) for user_id in user_ids)))
 
     def __str__(self):
         participant_names = " ,".join([user.username for user in self.participants.all()])
@@ -26,8 +130,101 @@ class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # set in Python (not auto_now_add) so write-behind batches keep the broadcast time
+    timestamp = models.DateTimeField(default=timezone.now)
+    # position in the conversation (1, 2, 3, ...), assigned on insert; clients resume from it
+    seq = models.BigIntegerField(editable=False)
+    # optional id the sending client picked; makes retried sends idempotent (see MessageQuerySet.send)
+    client_id = models.CharField(max_length=64, null=True, blank=True)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # also the index behind "messages after seq N" (replay and delta sync)
+            models.UniqueConstraint(fields=['conversation', 'seq'], name='message_conv_seq_unique'),
+            models.UniqueConstraint(
+                fields=['sender', 'conversation', 'client_id'], condition=Q(client_id__isnull=False),
+                name='message_sender_client_id_unique',
+            ),
+        ]
+        indexes = [
+            # keyset pagination of a conversation's history (see pagination.MessageCursorPagination)
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conv_ts_id_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.seq is None and self._state.adding:
+            using = kwargs.get('using') or router.db_for_write(Message, instance=self)
+            with transaction.atomic(using=using):
+                self.seq = Conversation.objects.db_manager(using).allocate_seqs(self.conversation_id, 1)
+                super().save(*args, **kwargs)
+            return
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f'Message from {self.sender.username} in {self.content[:20]}'
+
+
+class ParticipantState(models.Model):
+    """
+    One row per conversation member: where the conversation sorts in the
+    member's inbox, how many messages they have not read, the ids of the
+    last messages delivered to and read by them (their watermarks) and
+    their role. Receipts are these two watermarks, so they cost one row per
+    member rather than one per message and member.
+    """
+    OWNER = 'owner'
+    ADMIN = 'admin'
+    MEMBER = 'member'
+    ROLES = [(OWNER, 'Owner'), (ADMIN, 'Admin'), (MEMBER, 'Member')]
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='participant_states')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversation_states')
+    # copy of the conversation's latest activity so the inbox sorts on this table's index alone
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    unread_count = models.PositiveIntegerField(default=0)
+    read_watermark = models.BigIntegerField(default=0)
+    # never behind read_watermark: a message that was read was delivered
+    delivered_watermark = models.BigIntegerField(default=0)
+    # what the member may do in a group: owners manage admins, admins manage members
+    role = models.CharField(max_length=16, choices=ROLES, default=MEMBER)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'user'], name='participant_state_unique'),
+        ]
+        indexes = [
+            # the inbox: a user's conversations by recent activity (see views.InboxView)
+            models.Index(fields=['user', 'last_activity_at', 'conversation'], name='participant_inbox_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} in conversation {self.conversation_id}'
+
+
+class ArchiveBlock(models.Model):
+    """
+    Where one compressed block of archived messages lives: ``length``
+    bytes at ``offset`` in a conversation's segment file. Blocks of a
+    conversation cover consecutive seq ranges, oldest first.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='archive_blocks')
+    segment = models.CharField(max_length=64)
+    offset = models.BigIntegerField()
+    length = models.PositiveIntegerField()
+    message_count = models.PositiveIntegerField()
+    first_seq = models.BigIntegerField()
+    last_seq = models.BigIntegerField()
+    min_id = models.BigIntegerField()
+    max_id = models.BigIntegerField()
+    min_timestamp = models.DateTimeField()
+    max_timestamp = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'last_seq'], name='archive_block_conv_seq_idx'),
+        ]
 
     def __str__(self):
-        return f'Message from {self.sender.username} in {self.content[:20]}'
\ No newline at end of file
+        return f'Conversation {self.conversation_id} seq {self.first_seq}-{self.last_seq}'
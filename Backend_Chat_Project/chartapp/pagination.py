@@ -0,0 +1,254 @@
+import base64
+import json
+from datetime import datetime, timezone
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from . import archive
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a unique, indexed ordering key (``ordering``).
+
+    Pages are located with ``WHERE key < cursor`` / ``WHERE key > cursor``
+    instead of OFFSET, so every page costs one index range scan no matter
+    how deep the client has scrolled.
+
+    Without a cursor the newest page is returned (the oldest one with
+    ``from_start``). ``before`` walks towards older rows, ``after`` towards
+    newer ones. Rows inside a page are returned oldest first (newest first
+    with ``newest_first``); ``previous`` links to older rows, ``next`` to
+    newer ones.
+    """
+    ordering = ('id',)
+    # ordering fields holding datetimes; every other one is an integer
+    datetime_fields = ()
+    newest_first = False
+    from_start = False
+    # links without scheme and host, for pages shared between requests
+    relative_links = False
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    before_query_param = 'before'
+    after_query_param = 'after'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+        if before is not None and after is not None:
+            raise ValidationError(
+                f'Use either "{self.before_query_param}" or "{self.after_query_param}", not both.'
+            )
+
+        if after is not None or (before is None and self.from_start):
+            if after is not None:
+                queryset = queryset.filter(self.keyset_filter(after, newer=True))
+            rows = list(queryset.order_by(*self.ordering)[:self.page_size + 1])
+            rows = self.merge_rows(rows, after, newer=True)
+            self.has_newer = len(rows) > self.page_size
+            self.has_older = after is not None
+            rows = rows[:self.page_size]
+        else:
+            if before is not None:
+                queryset = queryset.filter(self.keyset_filter(before, newer=False))
+            rows = list(
+                queryset.order_by(*[f'-{field}' for field in self.ordering])[:self.page_size + 1]
+            )
+            rows = self.merge_rows(rows, before, newer=False)
+            self.has_older = len(rows) > self.page_size
+            self.has_newer = before is not None
+            rows = rows[:self.page_size]
+            rows.reverse()
+
+        self.page = rows
+        if self.newest_first:
+            return rows[::-1]
+        return rows
+
+    def merge_rows(self, rows, cursor, newer):
+        # hook for rows kept outside the queryset; gets and returns up to
+        # page_size + 1 rows in fetch order (ascending when ``newer``)
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        page_size = request.query_params.get(self.page_size_query_param)
+        if page_size is None:
+            return self.page_size
+        try:
+            page_size = int(page_size)
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: 'Must be an integer.'})
+        if page_size < 1:
+            raise ValidationError({self.page_size_query_param: 'Must be a positive integer.'})
+        return min(page_size, self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_newer or not self.page:
+            return None
+        return self.build_link(self.after_query_param, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.has_older or not self.page:
+            return None
+        return self.build_link(self.before_query_param, self.page[0])
+
+    def build_link(self, param, row):
+        url = self.request.get_full_path() if self.relative_links else self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, param, self.encode_cursor(row))
+
+    def keyset_filter(self, values, newer):
+        # (a, b) > (x, y)  <=>  a > x OR (a = x AND b > y), expanded for any key length
+        lookup = 'gt' if newer else 'lt'
+        condition = Q()
+        for position in reversed(range(len(self.ordering))):
+            field = self.ordering[position]
+            step = Q(**{f'{field}__{lookup}': values[position]})
+            if condition:
+                step |= Q(**{field: values[position]}) & condition
+            condition = step
+        return condition
+
+    def get_row_values(self, row):
+        if isinstance(row, dict):
+            return [row[field] for field in self.ordering]
+        return [getattr(row, field) for field in self.ordering]
+
+    def encode_cursor(self, row):
+        values = [
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in self.get_row_values(row)
+        ]
+        raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            values = json.loads(raw)
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError(cursor)
+            return [self.decode_value(field, value) for field, value in zip(self.ordering, values)]
+        except (ValueError, TypeError):
+            raise ValidationError('Invalid cursor.')
+
+    def decode_value(self, field, value):
+        if field in self.datetime_fields:
+            if not isinstance(value, str):
+                raise ValueError(value)
+            value = datetime.fromisoformat(value)
+            # cursors are issued in UTC; a naive one cannot be compared with stored datetimes
+            return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError(value)
+        return value
+
+
+class MessageCursorPagination(KeysetPagination):
+    """
+    Conversation history ordered by ``(timestamp, id)``; served by the
+    ``(conversation, timestamp, id)`` index on ``Message``.
+    """
+    ordering = ('timestamp', 'id')
+    datetime_fields = ('timestamp',)
+    page_size = 50
+    max_page_size = 200
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.conversation = getattr(view, 'conversation', None)
+        return super().paginate_queryset(queryset, request, view)
+
+    def merge_rows(self, rows, cursor, newer):
+        # history up to Conversation.archived_seq lives in archive segments
+        if self.conversation is None or not self.conversation.archived_seq:
+            return rows
+        return archive.read_page(self.conversation.id, cursor, newer, self.page_size + 1, rows)
+
+    def get_paginated_response_schema(self, schema):
+        # the list view adds the conversation and the users the page refers to
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['properties'] = {
+            'conversation': {'type': 'integer'},
+            'participants': {
+                'type': 'array',
+                'description': 'Both participants of a direct conversation; the senders on the page in a group',
+                'items': {
+                    'type': 'object',
+                    'properties': {'id': {'type': 'integer'}, 'username': {'type': 'string'}},
+                },
+            },
+            **response_schema['properties'],
+        }
+        return response_schema
+
+
+class InboxCursorPagination(KeysetPagination):
+    """
+    A user's conversations by recent activity, newest first; served by the
+    ``(user, last_activity_at, conversation)`` index on ``ParticipantState``.
+    """
+    ordering = ('last_activity_at', 'conversation_id')
+    datetime_fields = ('last_activity_at',)
+    newest_first = True
+    page_size = 30
+    max_page_size = 100
+
+
+class MemberPagination(KeysetPagination):
+    """
+    A conversation's members by user id; served by the ``(conversation,
+    user)`` unique index on ``ParticipantState``.
+    """
+    ordering = ('user_id',)
+    from_start = True
+    page_size = 100
+    max_page_size = 1000
+
+
+class UserDirectoryPagination(KeysetPagination):
+    """
+    Users in case-insensitive username order, from the start of the
+    alphabet; served by the ``LOWER(username), id`` index on ``auth_user``.
+    Its links are relative because pages are cached for every client.
+    """
+    ordering = ('username_lower', 'id')
+    from_start = True
+    relative_links = True
+    page_size = 20
+    max_page_size = 100
+
+    def decode_value(self, field, value):
+        if field == 'username_lower':
+            if not isinstance(value, str):
+                raise ValueError(value)
+            return value
+        return super().decode_value(field, value)
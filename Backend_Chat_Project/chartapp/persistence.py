@@ -0,0 +1,178 @@
+import asyncio
+import atexit
+import logging
+import os
+import signal
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+from . import data
+from .lifespan import on_shutdown
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+    Write-behind buffer for chat messages.
+
+    Consumers broadcast a message first and hand the unsaved ``Message`` to
+    the writer, which inserts buffered messages with ``bulk_create`` once
+    ``batch_size`` messages are waiting or ``flush_interval`` seconds have
+    passed, whichever comes first. One writer exists per worker process.
+
+    Messages still buffered when the process stops are lost, and they were
+    already broadcast. The buffer is drained on ASGI lifespan shutdown
+    (uvicorn, hypercorn), on SIGTERM and at interpreter exit; daphne speaks
+    no lifespan, so there only the last two apply, and a SIGKILL or crash
+    loses up to ``max_pending`` messages without a trace. Keep
+    ``CHAT_MESSAGE_PERSISTENCE`` at ``'sync'`` where that is not acceptable.
+    """
+
+    def __init__(self, batch_size=200, flush_interval=0.05, max_pending=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = []
+        self.written = 0
+        self.failed = 0
+        self._loop = None
+        self._task = None
+        self._has_pending = None
+        self._batch_full = None
+
+    async def enqueue(self, message):
+        self._ensure_running()
+        if len(self.pending) >= self.max_pending:
+            # the database is not keeping up; make the producer wait for it
+            await self.flush()
+        self.pending.append(message)
+        self._has_pending.set()
+        if len(self.pending) >= self.batch_size:
+            self._batch_full.set()
+
+    async def flush(self):
+        while self.pending:
+            batch = self.pending[:self.batch_size]
+            del self.pending[:self.batch_size]
+            await data.run(self._write, batch)
+        if self._has_pending is not None:
+            self._has_pending.clear()
+            self._batch_full.clear()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def flush_sync(self):
+        """Drain the buffer from synchronous code (interpreter exit)."""
+        while self.pending:
+            batch = self.pending[:self.batch_size]
+            del self.pending[:self.batch_size]
+            self._write(batch)
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self._loop = loop
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        if self.pending:
+            self._has_pending.set()
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Write-behind flush failed')
+
+    def _write(self, batch):
+        from .models import Message
+        from .signals import messages_created
+        try:
+            # its own savepoint: a failed batch must not poison a surrounding transaction
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+        except Exception:
+            logger.exception('Bulk insert of %d messages failed, retrying one by one', len(batch))
+        else:
+            self.written += len(batch)
+            # bulk_create sends no post_save; let the inbox (and friends) catch up
+            for receiver, error in messages_created.send_robust(sender=Message, messages=batch):
+                if error is not None:
+                    logger.error('messages_created receiver %r failed', receiver, exc_info=error)
+            return
+
+        # isolate the rows that cannot be stored so the rest of the batch survives
+        for message in batch:
+            # the failed batch's sequence numbers were rolled back with it
+            message.pk = None
+            message.seq = None
+            try:
+                message.save(force_insert=True)
+                self.written += 1
+            except Exception:
+                self.failed += 1
+                logger.exception(
+                    'Dropped message from user %s in conversation %s',
+                    message.sender_id, message.conversation_id
+                )
+
+
+_writer = None
+
+
+def get_message_writer():
+    global _writer
+    if _writer is None:
+        options = getattr(settings, 'CHAT_WRITE_BEHIND', {})
+        _writer = MessageWriter(
+            batch_size=options.get('BATCH_SIZE', 200),
+            flush_interval=options.get('FLUSH_INTERVAL', 0.05),
+            max_pending=options.get('MAX_PENDING', 10000),
+        )
+        atexit.register(_writer.flush_sync)
+        flush_on_sigterm(_writer)
+    return _writer
+
+
+def flush_on_sigterm(writer):
+    """Drain ``writer`` before the previous SIGTERM handler (or the default) stops the process."""
+    if threading.current_thread() is not threading.main_thread():
+        return  # signal handlers can only be set from the main thread
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle(signum, frame):
+        # runs on the event loop's thread, where Django refuses synchronous queries
+        flusher = threading.Thread(target=writer.flush_sync, name='chat-write-behind-flush')
+        flusher.start()
+        flusher.join()
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    signal.signal(signal.SIGTERM, handle)
+
+
+def write_behind_enabled():
+    return getattr(settings, 'CHAT_MESSAGE_PERSISTENCE', 'sync') == 'write_behind'
+
+
+@on_shutdown
+async def close_message_writer():
+    if _writer is not None:
+        await _writer.close()
@@ -0,0 +1,342 @@
+import asyncio
+import json
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .lifespan import on_shutdown
+from . import metrics
+from .wire import new_event_id
+
+
+class BasePresenceRegistry:
+    """
+    Tracks which users have at least one live socket in a conversation.
+
+    Every socket is registered under ``(conversation, user, channel_name)``
+    with an expiry ``ttl`` seconds ahead, and heartbeats push that expiry
+    forward. A user stays online while any of their sockets is unexpired,
+    so a second tab or a dropped duplicate socket does not change presence.
+    ``join`` and ``leave`` return True only when the user's presence flips.
+
+    Joining sockets get at most ``snapshot_limit`` online users (None: all),
+    so joins stay cheap in groups with thousands of members online.
+    """
+
+    def __init__(self, ttl=60, snapshot_limit=None):
+        self.ttl = ttl
+        self.snapshot_limit = snapshot_limit
+
+    async def join(self, conversation_id, user_data, channel_name):
+        raise NotImplementedError
+
+    async def leave(self, conversation_id, user_id, channel_name):
+        raise NotImplementedError
+
+    async def snapshot(self, conversation_id, limit=None):
+        """Serialized users currently online in the conversation, at most ``limit`` of them."""
+        raise NotImplementedError
+
+    async def expire(self, conversation_id):
+        """Drop users whose sockets all missed their heartbeat; returns them."""
+        raise NotImplementedError
+
+    async def heartbeat(self, conversation_id, user_data, channel_name):
+        # re-registering a socket only moves its expiry forward; it reports a
+        # transition if the socket had already been expired by a sweep
+        return await self.join(conversation_id, user_data, channel_name)
+
+
+class InMemoryPresenceRegistry(BasePresenceRegistry):
+    """
+    Process-local registry for tests and single-process development
+    servers (pairs with ``InMemoryChannelLayer``).
+    """
+
+    def __init__(self, ttl=60, snapshot_limit=None):
+        super().__init__(ttl, snapshot_limit)
+        # conversation_id -> {user_id: {'user': user_data, 'sockets': {channel_name: expires_at}}}
+        self.rooms = {}
+
+    async def join(self, conversation_id, user_data, channel_name):
+        now = time.time()
+        room = self.rooms.setdefault(conversation_id, {})
+        entry = room.setdefault(user_data['id'], {'user': user_data, 'sockets': {}})
+        was_online = self._prune(entry, now)
+        entry['user'] = user_data
+        entry['sockets'][channel_name] = now + self.ttl
+        return not was_online
+
+    async def leave(self, conversation_id, user_id, channel_name):
+        room = self.rooms.get(conversation_id, {})
+        entry = room.get(user_id)
+        if entry is None:
+            return False
+        entry['sockets'].pop(channel_name, None)
+        if self._prune(entry, time.time()):
+            return False
+        self._discard(conversation_id, user_id)
+        return True
+
+    async def snapshot(self, conversation_id, limit=None):
+        now = time.time()
+        users = []
+        for entry in self.rooms.get(conversation_id, {}).values():
+            if limit is not None and len(users) >= limit:
+                break
+            if self._prune(entry, now):
+                users.append(entry['user'])
+        return users
+
+    async def expire(self, conversation_id):
+        now = time.time()
+        room = self.rooms.get(conversation_id, {})
+        expired = [user_id for user_id, entry in room.items() if not self._prune(entry, now)]
+        return [self._discard(conversation_id, user_id)['user'] for user_id in expired]
+
+    def _prune(self, entry, now):
+        sockets = entry['sockets']
+        for channel_name in [name for name, expires_at in sockets.items() if expires_at <= now]:
+            del sockets[channel_name]
+        return bool(sockets)
+
+    def _discard(self, conversation_id, user_id):
+        room = self.rooms[conversation_id]
+        entry = room.pop(user_id)
+        if not room:
+            del self.rooms[conversation_id]
+        return entry
+
+
+# KEYS: user sockets zset, room online zset, room users hash
+# ARGV: channel, expires_at, now, user_id, user json, key ttl (ms)
+JOIN_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+local live = redis.call('ZCARD', KEYS[1])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+local current = redis.call('ZSCORE', KEYS[2], ARGV[4])
+if not current or tonumber(current) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[4])
+end
+redis.call('HSET', KEYS[3], ARGV[4], ARGV[5])
+for i = 1, 3 do
+    redis.call('PEXPIRE', KEYS[i], ARGV[6])
+end
+if live == 0 then
+    return 1
+end
+return 0
+"""
+
+# KEYS: user sockets zset, room online zset, room users hash
+# ARGV: channel, now, user_id
+LEAVE_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+if last[2] then
+    redis.call('ZADD', KEYS[2], last[2], ARGV[3])
+    return 0
+end
+local removed = redis.call('ZREM', KEYS[2], ARGV[3])
+redis.call('HDEL', KEYS[3], ARGV[3])
+return removed
+"""
+
+# KEYS: room online zset, room users hash
+# ARGV: now, limit (-1: all)
+SNAPSHOT_SCRIPT = """
+local users = {}
+for i, user_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf', 'LIMIT', 0, ARGV[2])) do
+    users[i] = redis.call('HGET', KEYS[2], user_id) or '{}'
+end
+return users
+"""
+
+# KEYS: room online zset, room users hash
+# ARGV: now
+EXPIRE_SCRIPT = """
+local users = {}
+for i, user_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])) do
+    users[i] = redis.call('HGET', KEYS[2], user_id) or '{}'
+    redis.call('ZREM', KEYS[1], user_id)
+    redis.call('HDEL', KEYS[2], user_id)
+end
+return users
+"""
+
+
+class RedisPresenceRegistry(BasePresenceRegistry):
+    """
+    Registry shared by all workers, stored in the channel layer's Redis.
+
+    Per conversation it keeps a sorted set of online user ids scored by
+    their latest socket expiry, a hash of serialized users for snapshots,
+    and one sorted set of sockets per user. Every transition is a single
+    Lua script, so concurrent joins and leaves from different workers
+    cannot both claim the same transition.
+    """
+
+    def __init__(self, ttl=60, snapshot_limit=None, hosts=None, prefix='presence'):
+        super().__init__(ttl, snapshot_limit)
+        from channels_redis.utils import decode_hosts
+        if hosts is None:
+            hosts = settings.CHANNEL_LAYERS['default'].get('CONFIG', {}).get('hosts')
+        self.host = decode_hosts(hosts)[0]
+        self.prefix = prefix
+        # redis.asyncio connections are bound to the loop that created them
+        self._scripts = {}
+
+    async def join(self, conversation_id, user_data, channel_name):
+        now = time.time()
+        came_online = await self._script('join')(
+            keys=self._user_keys(conversation_id, user_data['id']),
+            args=[channel_name, now + self.ttl, now, user_data['id'],
+                  json.dumps(user_data), int(self.ttl * 2000)],
+        )
+        return bool(came_online)
+
+    async def leave(self, conversation_id, user_id, channel_name):
+        went_offline = await self._script('leave')(
+            keys=self._user_keys(conversation_id, user_id),
+            args=[channel_name, time.time(), user_id],
+        )
+        return bool(went_offline)
+
+    async def snapshot(self, conversation_id, limit=None):
+        users = await self._script('snapshot')(
+            keys=self._room_keys(conversation_id), args=[time.time(), -1 if limit is None else limit]
+        )
+        return [json.loads(user) for user in users]
+
+    async def expire(self, conversation_id):
+        users = await self._script('expire')(
+            keys=self._room_keys(conversation_id), args=[time.time()]
+        )
+        return [json.loads(user) for user in users]
+
+    def _room_keys(self, conversation_id):
+        # the hash tag keeps all keys of one conversation on the same cluster slot
+        base = f'{self.prefix}:{{{conversation_id}}}'
+        return [f'{base}:online', f'{base}:users']
+
+    def _user_keys(self, conversation_id, user_id):
+        base = f'{self.prefix}:{{{conversation_id}}}'
+        return [f'{base}:u:{user_id}'] + self._room_keys(conversation_id)
+
+    def _script(self, name):
+        loop = asyncio.get_running_loop()
+        scripts = self._scripts.get(loop)
+        if scripts is None:
+            from channels_redis.utils import create_pool
+            from redis.asyncio import Redis
+            client = Redis(connection_pool=create_pool(self.host))
+            scripts = self._scripts[loop] = {
+                'join': client.register_script(JOIN_SCRIPT),
+                'leave': client.register_script(LEAVE_SCRIPT),
+                'snapshot': client.register_script(SNAPSHOT_SCRIPT),
+                'expire': client.register_script(EXPIRE_SCRIPT),
+            }
+        return scripts[name]
+
+
+class PresenceBroadcaster:
+    """
+    Coalesces presence transitions into at most one ``online_status`` diff
+    per conversation every ``window`` seconds. A user who goes offline and
+    comes back inside the window (a reconnect) produces no event at all.
+    """
+
+    def __init__(self, window=0.25):
+        self.window = window
+        self.pending = {}  # conversation_id -> {user_id: (status, user_data)}
+        self._tasks = {}
+
+    def publish(self, channel_layer, conversation_id, user_data, status):
+        changes = self.pending.get(conversation_id)
+        if changes is None:
+            changes = self.pending[conversation_id] = {}
+            self._tasks[conversation_id] = asyncio.get_running_loop().create_task(
+                self._flush_later(channel_layer, conversation_id)
+            )
+        previous = changes.get(user_data['id'])
+        if previous is not None and previous[0] != status:
+            del changes[user_data['id']]
+        else:
+            changes[user_data['id']] = (status, user_data)
+
+    async def flush(self, channel_layer, conversation_id):
+        self._tasks.pop(conversation_id, None)
+        changes = self.pending.pop(conversation_id, None)
+        if not changes:
+            return
+        await metrics.group_send(
+            channel_layer,
+            f'chat_{conversation_id}',
+            {
+                'type': 'online_status',
+                'event_id': new_event_id(),
+                'status': 'diff',
+                'conversation': conversation_id,
+                'online_users': [user for status, user in changes.values() if status == 'online'],
+                'offline_users': [user for status, user in changes.values() if status == 'offline'],
+            }
+        )
+
+    async def close(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        from channels.layers import get_channel_layer
+        for conversation_id in list(self.pending):
+            await self.flush(get_channel_layer(), conversation_id)
+
+    async def _flush_later(self, channel_layer, conversation_id):
+        await asyncio.sleep(self.window)
+        await self.flush(channel_layer, conversation_id)
+
+
+_registry = None
+_broadcaster = None
+
+
+def get_presence_registry():
+    global _registry
+    if _registry is None:
+        options = getattr(settings, 'CHAT_PRESENCE', {})
+        backend = options.get('BACKEND')
+        if backend is None:
+            # follow the channel layer: Redis in production, in-memory in tests
+            layer_backend = settings.CHANNEL_LAYERS['default']['BACKEND']
+            if layer_backend.startswith('channels_redis.'):
+                backend = 'chartapp.presence.RedisPresenceRegistry'
+            else:
+                backend = 'chartapp.presence.InMemoryPresenceRegistry'
+        _registry = import_string(backend)(
+            ttl=options.get('TTL', 60), snapshot_limit=options.get('SNAPSHOT_LIMIT', 200), **options.get('OPTIONS', {})
+        )
+    return _registry
+
+
+def get_presence_broadcaster():
+    global _broadcaster
+    if _broadcaster is None:
+        options = getattr(settings, 'CHAT_PRESENCE', {})
+        _broadcaster = PresenceBroadcaster(window=options.get('COALESCE_WINDOW', 0.25))
+    return _broadcaster
+
+
+@receiver(setting_changed)
+def reset_presence(setting, **kwargs):
+    global _registry, _broadcaster
+    if setting in ('CHAT_PRESENCE', 'CHANNEL_LAYERS'):
+        _registry = None
+        _broadcaster = None
+
+
+@on_shutdown
+async def flush_presence():
+    if _broadcaster is not None:
+        await _broadcaster.close()
@@ -0,0 +1,163 @@
+"""
+Delivery and read receipts as per-member watermarks.
+
+A client acknowledges the newest message delivered to it and the newest it
+has read with one frame, ``{"type": "ack", "delivered": <id>, "read": <id>}``
+(either may be left out). Receipts are not stored per message: each member
+has a delivered and a read watermark on its ``ParticipantState``.
+
+Acks are coalesced per member in a per-process ``ReceiptBuffer``, where only
+the highest ids survive, and written every ``FLUSH_INTERVAL`` seconds in one
+transaction. Each flush then sends one ``receipts`` event per conversation
+with the watermarks that moved, as ``[user_id, delivered, read]`` triples,
+so a burst of acks costs one write and one broadcast per interval.
+"""
+import asyncio
+import logging
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+
+from . import data, inbox, metrics
+from .lifespan import on_shutdown
+from .wire import new_event_id
+
+logger = logging.getLogger(__name__)
+
+
+def get_options():
+    options = getattr(settings, 'CHAT_RECEIPTS', {})
+    return {
+        'FLUSH_INTERVAL': options.get('FLUSH_INTERVAL', 0.5),
+        'MAX_PENDING': options.get('MAX_PENDING', 10000),
+    }
+
+
+def receipt_event(conversation_id, states):
+    return {
+        'type': 'receipts',
+        'event_id': new_event_id(),
+        'conversation': conversation_id,
+        'receipts': [[state.user_id, state.delivered_watermark, state.read_watermark] for state in states],
+    }
+
+
+def announce(state):
+    """Broadcast one member's watermarks once the transaction commits (the REST mark-read path)."""
+    def send():
+        from channels.layers import get_channel_layer
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        try:
+            async_to_sync(metrics.group_send)(
+                channel_layer, f'chat_{state.conversation_id}', receipt_event(state.conversation_id, [state])
+            )
+        except Exception:
+            # the watermarks are stored; sockets catch up with the next receipt
+            logger.exception('Broadcasting receipts of conversation %s failed', state.conversation_id)
+    transaction.on_commit(send)
+
+
+class ReceiptBuffer:
+    """
+    Acks waiting to be written, at most one entry per member. Flushes every
+    ``flush_interval`` seconds, or as soon as ``max_pending`` members have
+    acked.
+    """
+
+    def __init__(self, flush_interval=0.5, max_pending=10000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = {}  # (conversation_id, user_id) -> [delivered, read]
+        self._loop = None
+        self._task = None
+        self._has_pending = None
+        self._full = None
+
+    def ack(self, conversation_id, user_id, delivered=0, read=0):
+        self._ensure_running()
+        metrics.receipt_acks.inc()
+        entry = self.pending.get((conversation_id, user_id))
+        if entry is None:
+            self.pending[(conversation_id, user_id)] = [delivered, read]
+        else:
+            entry[0] = max(entry[0], delivered)
+            entry[1] = max(entry[1], read)
+        self._has_pending.set()
+        if len(self.pending) >= self.max_pending:
+            self._full.set()
+
+    async def flush(self):
+        if self._has_pending is not None:
+            self._has_pending.clear()
+            self._full.clear()
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        changed = await data.run(inbox.advance_watermarks, batch)
+        metrics.receipt_rows_written.inc(len(changed))
+        by_conversation = {}
+        for state in changed:
+            by_conversation.setdefault(state.conversation_id, []).append(state)
+        if not by_conversation:
+            return
+        from channels.layers import get_channel_layer
+        channel_layer = get_channel_layer()
+        for conversation_id, states in by_conversation.items():
+            await metrics.group_send(channel_layer, f'chat_{conversation_id}', receipt_event(conversation_id, states))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self._loop = loop
+        self._has_pending = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            try:
+                # later acks of the same members land in the same write
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Receipt flush failed')
+
+
+_buffer = None
+
+
+def get_receipt_buffer():
+    global _buffer
+    if _buffer is None:
+        options = get_options()
+        _buffer = ReceiptBuffer(flush_interval=options['FLUSH_INTERVAL'], max_pending=options['MAX_PENDING'])
+    return _buffer
+
+
+@receiver(setting_changed)
+def reset_receipt_buffer(setting, **kwargs):
+    global _buffer
+    if setting == 'CHAT_RECEIPTS':
+        _buffer = None
+
+
+@on_shutdown
+async def flush_receipts():
+    if _buffer is not None:
+        await _buffer.close()
@@ -0,0 +1,142 @@
+"""
+Read routing for a primary database with read replicas.
+
+Every alias besides ``default`` is a replica (settings makes one per
+``DB_REPLICAS`` entry). Reads go to a replica only while a GET, HEAD or
+OPTIONS request is served by a view marked ``read_from_replica``, and only
+if that client has not written lately: a POST, PUT, PATCH or DELETE pins
+the client's reads to the primary for ``CHAT_DB_ROUTING['STICKY_SECONDS']``,
+so replication lag never hides its own writes. Everything else (writes,
+consumers, management commands) uses the primary. Without replicas every
+query goes to ``default`` and nothing is pinned.
+
+A pin covers the authenticated user and the session cookie. A client with
+neither (an anonymous sign-up, say) is not pinned: its address could be
+shared by anyone behind the same proxy. Until authentication has run, a
+request's reads go to the primary. Pins are kept in the Django cache; use a
+shared cache backend when running more than one worker.
+"""
+import hashlib
+import random
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.functional import LazyObject, empty
+
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# the request being served, if any; follows it into sync_to_async threads
+current_request = ContextVar('chat_db_request', default=None)
+
+
+def get_options():
+    options = getattr(settings, 'CHAT_DB_ROUTING', {})
+    return {
+        'STICKY_SECONDS': options.get('STICKY_SECONDS', 5),
+    }
+
+
+def replica_aliases():
+    return [alias for alias in connections if alias != DEFAULT_DB_ALIAS]
+
+
+def resolved_user(request):
+    """The request's user once authentication has run, else None."""
+    user = getattr(request, 'user', None)
+    # AuthenticationMiddleware's lazy user would query through this router to resolve itself
+    if user is None or (isinstance(user, LazyObject) and user._wrapped is empty):
+        return None
+    return user
+
+
+def pin_keys(request):
+    # every identity the request carries; never the address, which unrelated clients share
+    identities = [request.COOKIES.get(settings.SESSION_COOKIE_NAME)]
+    user = resolved_user(request)
+    if user is not None and user.is_authenticated:
+        identities.append(f'user:{user.pk}')
+    return [f'chat:db_pin:{hashlib.md5(identity.encode("utf-8")).hexdigest()}' for identity in identities if identity]
+
+
+def read_database(request):
+    """The alias a request's reads use, or None while its view or user is not resolved yet."""
+    if request.method not in SAFE_METHODS:
+        return DEFAULT_DB_ALIAS
+    match = request.resolver_match
+    if match is None:
+        return None
+    view_class = getattr(match.func, 'view_class', None)
+    replicas = replica_aliases()
+    if not replicas or not getattr(view_class, 'read_from_replica', False):
+        return DEFAULT_DB_ALIAS
+    if resolved_user(request) is None:
+        return None
+    if cache.get_many(pin_keys(request)):
+        return DEFAULT_DB_ALIAS
+    return random.choice(replicas)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        request = current_request.get()
+        if request is None:
+            return DEFAULT_DB_ALIAS
+        # one replica per request, so its queries see one consistent copy
+        alias = getattr(request, '_chat_read_database', None)
+        if alias is None:
+            alias = read_database(request)
+            if alias is None:
+                return DEFAULT_DB_ALIAS
+            request._chat_read_database = alias
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema by replication
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReadYourWritesMiddleware:
+    """Makes the request visible to the router and pins clients that write."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = current_request.set(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        self.pin(request)
+        return response
+
+    async def __acall__(self, request):
+        token = current_request.set(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        self.pin(request)
+        return response
+
+    def pin(self, request):
+        if request.method not in SAFE_METHODS and replica_aliases():
+            keys = pin_keys(request)
+            if keys:
+                cache.set_many(dict.fromkeys(keys, True), get_options()['STICKY_SECONDS'])
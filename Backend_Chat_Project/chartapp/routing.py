@@ -3,4 +3,6 @@ from .import consumers
 
 websocket_urlpatterns = [
     path('ws/chat/<int:conversation_id>/', consumers.ChatConsumer.as_asgi()),
+    # one socket per user, multiplexing all of their conversations
+    path('ws/user/', consumers.UserChatConsumer.as_asgi()),
 ]
\ No newline at end of file
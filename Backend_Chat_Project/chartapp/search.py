@@ -0,0 +1,123 @@
+import html
+import re
+
+from django.db import connections
+
+# private-use markers around highlighted terms; the snippet is HTML-escaped
+# before they are turned into <mark> tags, so message text cannot inject markup
+_HIGHLIGHT_START = '\ue000'
+_HIGHLIGHT_END = '\ue001'
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def _render_snippet(snippet):
+    return (html.escape(snippet or '')
+            .replace(_HIGHLIGHT_START, '<mark>')
+            .replace(_HIGHLIGHT_END, '</mark>'))
+
+
+class SearchNotSupported(Exception):
+    pass
+
+
+class BaseSearchBackend:
+    """
+    Ranked full-text search over message content, limited to the
+    conversations a user participates in. The index itself is maintained
+    by the database (see migration 0005), so it follows every insert and
+    delete, bulk ones included.
+    """
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    def search(self, user_id, query, conversation_id=None, limit=20, offset=0):
+        """
+        Returns ``[(message_id, snippet_html, rank), ...]`` best match first,
+        or an empty list if ``query`` has no searchable words.
+        """
+        raise NotImplementedError
+
+    def rebuild(self):
+        raise NotImplementedError
+
+    def _fetch(self, sql, params):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(sql, params)
+            return [(row[0], _render_snippet(row[1]), row[2]) for row in cursor.fetchall()]
+
+    def _scope(self, user_id, conversation_id):
+        clause = ('m.conversation_id IN (SELECT conversation_id FROM chartapp_conversation_participants '
+                  'WHERE user_id = %s)')
+        params = [user_id]
+        if conversation_id is not None:
+            clause += ' AND m.conversation_id = %s'
+            params.append(conversation_id)
+        return clause, params
+
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    """SQLite FTS5 external-content table ``chartapp_message_fts``, ranked by bm25."""
+
+    def search(self, user_id, query, conversation_id=None, limit=20, offset=0):
+        words = _WORD.findall(query)
+        if not words:
+            return []
+        # every word must match, each as a prefix; quoting neutralises FTS5 syntax
+        match = ' AND '.join(f'"{word}"*' for word in words)
+        scope, params = self._scope(user_id, conversation_id)
+        return self._fetch(
+            f"""
+            SELECT m.id,
+                   snippet(chartapp_message_fts, 0, %s, %s, '…', 16),
+                   bm25(chartapp_message_fts) AS rank
+            FROM chartapp_message_fts
+            JOIN chartapp_message m ON m.id = chartapp_message_fts.rowid
+            WHERE chartapp_message_fts MATCH %s AND {scope}
+            ORDER BY rank, m.id DESC
+            LIMIT %s OFFSET %s
+            """,
+            [_HIGHLIGHT_START, _HIGHLIGHT_END, match, *params, limit, offset],
+        )
+
+    def rebuild(self):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute("INSERT INTO chartapp_message_fts(chartapp_message_fts) VALUES ('rebuild')")
+            cursor.execute("INSERT INTO chartapp_message_fts(chartapp_message_fts) VALUES ('optimize')")
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """GIN expression index on ``to_tsvector('simple', content)``, ranked by ts_rank."""
+
+    def search(self, user_id, query, conversation_id=None, limit=20, offset=0):
+        words = _WORD.findall(query)
+        if not words:
+            return []
+        tsquery = ' & '.join(f'{word}:*' for word in words)
+        scope, params = self._scope(user_id, conversation_id)
+        return self._fetch(
+            f"""
+            SELECT m.id,
+                   ts_headline('simple', m.content, q, %s),
+                   ts_rank(to_tsvector('simple', m.content), q) AS rank
+            FROM chartapp_message m, to_tsquery('simple', %s) q
+            WHERE to_tsvector('simple', m.content) @@ q AND {scope}
+            ORDER BY rank DESC, m.id DESC
+            LIMIT %s OFFSET %s
+            """,
+            [f'StartSel={_HIGHLIGHT_START}, StopSel={_HIGHLIGHT_END}, MaxWords=32, MinWords=8',
+             tsquery, *params, limit, offset],
+        )
+
+    def rebuild(self):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('REINDEX INDEX chartapp_message_content_fts')
+
+
+def get_search_backend(using='default'):
+    vendor = connections[using].vendor
+    if vendor == 'sqlite':
+        return SQLiteSearchBackend(using)
+    if vendor == 'postgresql':
+        return PostgresSearchBackend(using)
+    raise SearchNotSupported(f'Message search is not available on {vendor}')
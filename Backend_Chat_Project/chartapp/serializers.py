@@ -21,11 +21,22 @@ class UserListSerializer(serializers.ModelSerializer):
         fields = ('id', 'username')
 
 
+def direct_participants(conversation):
+    # a group can have thousands of members: they are paged through conversations/<id>/members/
+    if conversation.is_group:
+        return None
+    return UserListSerializer(conversation.participants.all(), many=True).data
+
+
 class ConversationSerializer(serializers.ModelSerializer):
-    participants = UserListSerializer(many=True, read_only=True)
+    # null for groups
+    participants = serializers.SerializerMethodField()
     class Meta:
         model = Conversation
-        fields = ('id', 'participants', 'created_at')
+        fields = ('id', 'name', 'is_group', 'participants', 'created_at')
+
+    def get_participants(self, obj):
+        return direct_participants(obj)
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
@@ -36,13 +47,109 @@ class MessageSerializer(serializers.ModelSerializer):
     participants = serializers.SerializerMethodField()
     class Meta:
         model = Message
-        fields = ('id', 'conversation', 'sender', 'content', 'timestamp', 'participants')
+        fields = ('id', 'conversation', 'seq', 'sender', 'content', 'timestamp', 'client_id', 'participants')
 
     def get_participants(self, obj):
-        return UserListSerializer(obj.conversation.participants.all(), many=True).data
+        # null for groups
+        return direct_participants(obj.conversation)
+
+
+class CompactMessageSerializer(serializers.ModelSerializer):
+    """
+    A conversation history row. The sender is referred to by id; the list
+    endpoint names the users once, next to the page.
+    """
+    class Meta:
+        model = Message
+        fields = ('id', 'seq', 'sender', 'content', 'timestamp')
+        read_only_fields = fields
+
+    # columns read by the fast path
+    values_fields = ('id', 'seq', 'sender_id', 'content', 'timestamp')
+
+    @classmethod
+    def to_rows(cls, rows):
+        # same output as the serializer, built from .values() rows without per-field overhead
+        timestamp = serializers.DateTimeField()
+        return [
+            {
+                'id': row['id'],
+                'seq': row['seq'],
+                'sender': row['sender_id'],
+                'content': row['content'],
+                'timestamp': timestamp.to_representation(row['timestamp']),
+            }
+            for row in rows
+        ]
 
 
 class CreateMessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ('conversation', 'content')
\ No newline at end of file
+        fields = ('conversation', 'content', 'client_id')
+        # uniqueness of client_id is what makes a retry return the stored message, not a 400
+        validators = []
+
+
+class MessageContentSerializer(serializers.ModelSerializer):
+    # the async create view takes the conversation from the URL, so validation needs no query
+    class Meta:
+        model = Message
+        fields = ('content', 'client_id')
+        validators = []
+
+
+class InboxSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='conversation_id')
+    name = serializers.CharField(source='conversation.name')
+    is_group = serializers.BooleanField(source='conversation.is_group')
+    # null for groups
+    participants = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ParticipantState
+        fields = ('id', 'name', 'is_group', 'participants', 'last_message', 'last_activity_at', 'unread_count',
+                  'delivered_watermark', 'read_watermark', 'role')
+
+    def get_participants(self, obj):
+        return direct_participants(obj.conversation)
+
+    def get_last_message(self, obj):
+        conversation = obj.conversation
+        if conversation.last_message_id is None:
+            return None
+        sender = conversation.last_message_sender
+        return {
+            'id': conversation.last_message_id,
+            'preview': conversation.last_message_preview,
+            'timestamp': serializers.DateTimeField().to_representation(conversation.last_message_at),
+            'sender': {'id': sender.id, 'username': sender.username} if sender else None,
+        }
+
+
+class MarkReadSerializer(serializers.Serializer):
+    message = serializers.IntegerField(required=False, min_value=1,
+                                       help_text='Last message read (defaults to the newest one)')
+
+
+class MemberSerializer(serializers.Serializer):
+    """A conversation member with their role."""
+    id = serializers.IntegerField(source='user_id')
+    username = serializers.CharField(source='user__username')
+    role = serializers.CharField()
+
+    # columns read for each member row
+    values_fields = ('user_id', 'user__username', 'role')
+
+
+class AddMembersSerializer(serializers.Serializer):
+    users = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=1000,
+                                  help_text='Ids of the users to add')
+    role = serializers.ChoiceField(choices=[ParticipantState.ADMIN, ParticipantState.MEMBER],
+                                   default=ParticipantState.MEMBER)
+
+
+class MemberRoleSerializer(serializers.Serializer):
+    role = serializers.ChoiceField(choices=ParticipantState.ROLES,
+                                   help_text='Making someone the owner makes the current owner an admin')
@@ -0,0 +1,74 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from . import archive, directory, inbox, membership
+from .models import Conversation, Message, ParticipantState
+
+# Sent with ``messages`` (a list of saved Message instances) whenever new
+# messages are stored. Single saves are relayed from post_save; bulk paths
+# (write-behind batches, imports) send it themselves since bulk_create
+# does not send post_save.
+messages_created = Signal()
+
+
+@receiver(post_save, sender=Message)
+def relay_message_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        messages_created.send(sender=Message, messages=[instance])
+
+
+@receiver(messages_created)
+def update_inbox(sender, messages, **kwargs):
+    inbox.record_messages(messages)
+
+
+@receiver(post_delete, sender=Message)
+def update_inbox_on_delete(sender, instance, **kwargs):
+    inbox.record_deleted_message(instance)
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def sync_participant_states(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            conversation_ids = pk_set if action != 'post_clear' else [
+                state.conversation_id for state in ParticipantState.objects.filter(user=instance).only('conversation_id')
+            ]
+        else:
+            conversation_ids = [instance.pk]
+        for conversation_id in conversation_ids:
+            membership.invalidate(conversation_id)
+    if reverse:
+        # user.conversations.add(...): instance is the user, pk_set are conversations
+        if action == 'post_add':
+            for conversation in Conversation.objects.filter(pk__in=pk_set):
+                inbox.sync_members(conversation, [instance.pk])
+        elif action == 'post_remove':
+            ParticipantState.objects.filter(user=instance, conversation_id__in=pk_set).delete()
+        elif action == 'post_clear':
+            ParticipantState.objects.filter(user=instance).delete()
+        return
+    if action == 'post_add':
+        inbox.sync_members(instance, pk_set)
+    elif action == 'post_remove':
+        ParticipantState.objects.filter(conversation=instance, user_id__in=pk_set).delete()
+    elif action == 'post_clear':
+        ParticipantState.objects.filter(conversation=instance).delete()
+
+
+@receiver(post_save, sender=User)
+def invalidate_directory_on_save(sender, instance, created, update_fields=None, **kwargs):
+    # logins only touch last_login, which the directory does not show
+    if created or update_fields is None or 'username' in update_fields:
+        directory.bump_version()
+
+
+@receiver(post_delete, sender=User)
+def invalidate_directory_on_delete(sender, instance, **kwargs):
+    directory.bump_version()
+
+
+@receiver(post_delete, sender=Conversation)
+def discard_archive_segments(sender, instance, **kwargs):
+    archive.get_segment_store().discard(instance.pk)
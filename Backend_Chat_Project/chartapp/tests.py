@@ -1,3 +1,1143 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import shutil
+import signal
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.test import (AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from . import archive, events, fanout, flow_control, history, inbox, metrics, routers, search, wire, ws_auth
+from .consumers import BaseChatConsumer
+from .models import Conversation, Message, ParticipantState
+from .persistence import MessageWriter, flush_on_sigterm
+from .receipts import ReceiptBuffer
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+async def open_socket(path, user, query='', subprotocols=None):
+    from chat_system.asgi import application
+    communicator = WebsocketCommunicator(application, f'{path}?token={AccessToken.for_user(user)}{query}',
+                                         subprotocols=subprotocols)
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+async def receive_frames(communicator, timeout=0.3):
+    # everything the server sends until it has been quiet for ``timeout`` seconds
+    frames = []
+    while not await communicator.receive_nothing(timeout):
+        output = await communicator.receive_output()
+        if output['type'] != 'websocket.send':
+            continue
+        if output.get('bytes') is not None:
+            frames.append(msgpack.unpackb(output['bytes'], raw=False))
+        else:
+            frames.append(json.loads(output['text']))
+    return frames
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class UserChatConsumerTests(TransactionTestCase):
+    # sockets reach the database from other threads, so test data must be committed
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+
+    async def test_bad_requests_are_answered_with_4005(self):
+        socket = await open_socket('/ws/user/', self.alice)
+        await socket.send_to(text_data=json.dumps({'type': 'subscribe'}))
+        await socket.send_to(text_data=json.dumps({'type': 'typing', 'conversation': self.conversation.id}))
+        errors = [frame for frame in await receive_frames(socket) if frame['type'] == 'error']
+        self.assertEqual([error['code'] for error in errors], [4005, 4005])
+        await socket.disconnect()
+
+    async def test_subscribe_to_a_foreign_conversation_is_refused(self):
+        carol = await User.objects.acreate(username='carol')
+        socket = await open_socket('/ws/user/', carol)
+        await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'conversation': self.conversation.id}))
+        errors = [frame for frame in await receive_frames(socket) if frame['type'] == 'error']
+        self.assertEqual([error['code'] for error in errors], [4003])
+        await socket.disconnect()
+
+    async def test_malformed_frames_get_an_error_and_keep_the_socket(self):
+        socket = await open_socket('/ws/user/', self.alice)
+        for frame in ('{not json', '1', '[]'):
+            await socket.send_to(text_data=frame)
+        await socket.send_to(bytes_data=b'\xc1')
+        await socket.send_to(bytes_data=msgpack.packb([1, 2]))
+        errors = [frame for frame in await receive_frames(socket) if frame['type'] == 'error']
+        self.assertEqual([(error['code'], error['detail']) for error in errors], [(4005, 'Malformed frame')] * 5)
+        await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'conversation': self.conversation.id}))
+        self.assertIn('subscribed', [frame['type'] for frame in await receive_frames(socket)])
+        await socket.disconnect()
+
+    async def test_ids_must_be_integers(self):
+        socket = await open_socket('/ws/user/', self.alice)
+        # 1e400 is inf, and 3.7 must not quietly become conversation 3
+        for frame in ('{"type": "subscribe", "conversation": 1e400}', '{"type": "subscribe", "conversation": 3.7}',
+                      '{"type": "subscribe", "conversation": true}'):
+            await socket.send_to(text_data=frame)
+        await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'conversation': str(self.conversation.id)}))
+        frames = await receive_frames(socket)
+        self.assertEqual([frame['code'] for frame in frames if frame['type'] == 'error'], [4005] * 3)
+        self.assertIn('subscribed', [frame['type'] for frame in frames])
+        for frame in ('{"type": "typing", "conversation": %d, "receiver": 1e400}',
+                      '{"type": "ack", "conversation": %d, "read": 1e400}',
+                      '{"type": "ack", "conversation": %d, "delivered": -1}'):
+            await socket.send_to(text_data=frame % self.conversation.id)
+        errors = [frame for frame in await receive_frames(socket) if frame['type'] == 'error']
+        self.assertEqual([error['code'] for error in errors], [4005] * 3)
+        await socket.disconnect()
+
+    async def test_message_content_must_be_a_string(self):
+        sender = await open_socket('/ws/user/', self.alice, subprotocols=['chat.msgpack'])
+        receiver = await open_socket('/ws/user/', self.bob)
+        for socket in (sender, receiver):
+            await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'conversation': self.conversation.id}))
+        await receive_frames(receiver, 0.1)
+        for content in (b'raw bytes', None, 7, {'a': 1}, '', 'x' * (BaseChatConsumer.max_message_length + 1)):
+            await sender.send_to(bytes_data=msgpack.packb(
+                {'type': 'chat_message', 'conversation': self.conversation.id, 'message': content}, use_bin_type=True
+            ))
+        errors = [frame for frame in await receive_frames(sender) if frame['type'] == 'error']
+        self.assertEqual([error['code'] for error in errors], [4005] * 6)
+        self.assertNotIn('chat_message', [frame['type'] for frame in await receive_frames(receiver)])
+        self.assertEqual(await Message.objects.acount(), 0)
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    @override_settings(CHAT_FLOW_CONTROL={'LIMITS': {'other': {'RATE': 1, 'BURST': 2}}})
+    async def test_malformed_frames_count_against_the_other_bucket(self):
+        socket = await open_socket('/ws/user/', self.alice)
+        for _ in range(4):
+            await socket.send_to(text_data='{not json')
+        codes = [frame['code'] for frame in await receive_frames(socket) if frame['type'] == 'error']
+        self.assertEqual(codes, [4005, 4005, 4008])
+        await socket.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class WireProtocolTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.carol = User.objects.create_user('carol', password='x')
+        self.group = Conversation.objects.create_group('team', self.alice, [self.alice, self.bob, self.carol])
+
+    async def test_the_first_offered_known_subprotocol_is_chosen(self):
+        from chat_system.asgi import application
+        for offered, chosen in ((['chat.v9', 'chat.msgpack', 'chat.json'], 'chat.msgpack'),
+                                (['chat.json'], 'chat.json'), (['chat.v9'], None), ([], None)):
+            socket = WebsocketCommunicator(application, f'/ws/user/?token={AccessToken.for_user(self.alice)}',
+                                           subprotocols=offered)
+            self.assertEqual(await socket.connect(), (True, chosen), offered)
+            await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'conversation': self.group.id}))
+            output = await socket.receive_output()
+            self.assertEqual(output.get('bytes') is not None, chosen == 'chat.msgpack', offered)
+            await socket.disconnect()
+
+    async def test_group_events_are_encoded_once_per_codec(self):
+        sockets = [await open_socket('/ws/user/', user, subprotocols=protocols)
+                   for user, protocols in ((self.alice, ['chat.msgpack']), (self.bob, ['chat.msgpack']),
+                                           (self.carol, None))]
+        for socket in sockets:
+            await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'conversation': self.group.id}))
+        for socket in sockets:
+            await receive_frames(socket)
+        cache = wire.FrameCache()
+        with mock.patch('chartapp.consumers.frame_cache', cache):
+            await sockets[0].send_to(bytes_data=msgpack.packb(
+                {'type': 'chat_message', 'conversation': self.group.id, 'message': 'hi'}
+            ))
+            received = [await receive_frames(socket) for socket in sockets]
+        for frames in received:
+            self.assertEqual([frame['message'] for frame in frames if frame['type'] == 'chat_message'], ['hi'])
+        # one MessagePack and one JSON encoding, reused by the second MessagePack socket
+        self.assertEqual((cache.misses, cache.hits), (2, 1))
+        for socket in sockets:
+            await socket.disconnect()
+
+
+class FrameCacheTests(SimpleTestCase):
+
+    def test_frames_are_cached_per_event_and_codec_and_evicted_oldest_first(self):
+        cache = wire.FrameCache(max_size=2)
+        payload = {'type': 'chat_message', 'message': 'hi'}
+        msgpack_codec, json_codec = wire.CODECS['chat.msgpack'], wire.CODECS['chat.json']
+        frame = cache.encode(msgpack_codec, payload, 'a')
+        self.assertIs(cache.encode(msgpack_codec, {'changed': True}, 'a'), frame)
+        self.assertEqual(json.loads(cache.encode(json_codec, payload, 'a')), payload)
+        # frames without an event id are never cached
+        cache.encode(json_codec, payload)
+        self.assertEqual((cache.misses, cache.hits), (2, 1))
+        cache.encode(msgpack_codec, payload, 'b')
+        self.assertEqual(list(cache.frames), [('a', 'chat.json'), ('b', 'chat.msgpack')])
+
+
+class OutboundBufferTests(SimpleTestCase):
+
+    async def make_buffer(self, max_frames):
+        # a client that reads nothing until ``reading`` is set
+        written = []
+        reading = asyncio.Event()
+
+        async def write(frame, frame_type):
+            await reading.wait()
+            written.append(frame)
+
+        return flow_control.OutboundBuffer(write, max_frames), written, reading
+
+    async def test_low_priority_frames_make_room_for_chat_frames(self):
+        buffer, written, reading = await self.make_buffer(2)
+        self.assertTrue(buffer.push('m1', 'chat_message'))
+        await asyncio.sleep(0)  # the writer takes m1 and waits on the client
+        self.assertTrue(buffer.push('t1', 'typing', low_priority=True))
+        self.assertTrue(buffer.push('m2', 'chat_message'))
+        # full: a typing frame is dropped rather than queued, a chat frame evicts t1
+        self.assertTrue(buffer.push('t2', 'typing', low_priority=True))
+        self.assertTrue(buffer.push('m3', 'chat_message'))
+        # only chat frames are waiting: the caller has to decide
+        self.assertFalse(buffer.push('m4', 'chat_message'))
+        reading.set()
+        await buffer.task
+        self.assertEqual(written, ['m1', 'm2', 'm3'])
+
+    async def test_replies_wait_for_room(self):
+        buffer, written, reading = await self.make_buffer(1)
+        buffer.push('m1', 'chat_message')
+        await asyncio.sleep(0)
+        buffer.push('m2', 'chat_message')
+        reply = asyncio.ensure_future(buffer.put('r1', 'subscribed'))
+        await asyncio.sleep(0.05)
+        self.assertFalse(reply.done())
+        reading.set()
+        await reply
+        await buffer.task
+        self.assertEqual(written, ['m1', 'm2', 'r1'])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class SlowConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+
+    async def send_messages_to_a_stalled_bob(self, count):
+        write_frame = BaseChatConsumer.write_frame
+
+        async def stalled_write_frame(consumer, frame, frame_type):
+            if consumer.user.id == self.bob.id and frame_type == 'chat_message':
+                await asyncio.Event().wait()  # bob stopped reading
+            await write_frame(consumer, frame, frame_type)
+
+        # sockets bind their writer when they connect
+        with mock.patch.object(BaseChatConsumer, 'write_frame', stalled_write_frame):
+            alice = await open_socket('/ws/user/', self.alice)
+            bob = await open_socket('/ws/user/', self.bob)
+            for socket in (alice, bob):
+                await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'conversation': self.conversation.id}))
+                await receive_frames(socket, 0.1)
+            for n in range(count):
+                await alice.send_to(text_data=json.dumps(
+                    {'type': 'chat_message', 'conversation': self.conversation.id, 'message': str(n)}
+                ))
+            alice_frames = await receive_frames(alice)
+            bob_output = []
+            while not await bob.receive_nothing(0.2):
+                bob_output.append(await bob.receive_output())
+        await alice.disconnect()
+        return alice_frames, bob_output
+
+    @override_settings(CHAT_FLOW_CONTROL={'OUTBOUND_BUFFER': 2})
+    async def test_a_client_that_stops_reading_is_closed_with_4009(self):
+        alice_frames, bob_output = await self.send_messages_to_a_stalled_bob(5)
+        self.assertEqual(bob_output, [{'type': 'websocket.close', 'code': 4009}])
+        # the sender is not held up by the slow reader
+        self.assertEqual(len([frame for frame in alice_frames if frame['type'] == 'chat_message']), 5)
+
+    @override_settings(CHAT_FLOW_CONTROL={'OUTBOUND_BUFFER': 2, 'OUTBOUND_OVERFLOW': 'drop'})
+    async def test_overflow_can_drop_frames_instead(self):
+        _, bob_output = await self.send_messages_to_a_stalled_bob(5)
+        self.assertEqual(bob_output, [])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_WS_AUTH={'CACHE_TTL': 60})
+class WebSocketAuthTests(TransactionTestCase):
+    # users are loaded on the database pool, so test data must be committed
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+
+    async def handshake(self, query):
+        from chat_system.asgi import application
+        socket = WebsocketCommunicator(application, f'/ws/user/{query}')
+        result = await socket.connect()
+        await socket.disconnect()
+        return result
+
+    async def test_refused_handshakes_close_with_their_code(self):
+        expired = AccessToken.for_user(self.alice)
+        expired.set_exp(lifetime=-timedelta(seconds=1))
+        for query, code in (('', 4002), ('?token=', 4002), ('?token=not.a.jwt', 4001),
+                            (f'?token={expired}', 4000), (f'?token={RefreshToken.for_user(self.alice)}', 4001)):
+            self.assertEqual(await self.handshake(query), (False, code), query)
+        self.assertEqual(await self.handshake(f'?token={AccessToken.for_user(self.alice)}'), (True, None))
+
+    async def test_known_tokens_skip_the_database_until_their_entry_expires(self):
+        token = AccessToken.for_user(self.alice)
+        with mock.patch.object(ws_auth, 'load_user', wraps=ws_auth.load_user) as load_user:
+            for _ in range(3):
+                self.assertEqual(await self.handshake(f'?token={token}'), (True, None))
+            self.assertEqual(load_user.call_count, 1)
+
+            # a deactivated user keeps the cached entry until CACHE_TTL has passed
+            await User.objects.filter(id=self.alice.id).aupdate(is_active=False)
+            self.assertEqual(await self.handshake(f'?token={token}'), (True, None))
+            with mock.patch.object(ws_auth.time, 'time', return_value=ws_auth.time.time() + 61):
+                self.assertEqual(await self.handshake(f'?token={token}'), (False, 4001))
+                # the refusal is cached too
+                self.assertEqual(await self.handshake(f'?token={token}'), (False, 4001))
+            self.assertEqual(load_user.call_count, 2)
+
+    async def test_entries_never_outlive_the_token(self):
+        token = AccessToken.for_user(self.alice)
+        token.set_exp(lifetime=timedelta(seconds=5))
+        cache = ws_auth.get_token_cache()
+        user, close_code = await cache.authenticate(str(token))
+        self.assertEqual((user.id, close_code), (self.alice.id, None))
+        self.assertEqual(cache.entries[token['jti']][1], token['exp'])
+        self.assertEqual(cache.get(token['jti'], token['exp']), (False, None))
+        self.assertNotIn(token['jti'], cache.entries)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_FANOUT={'STRATEGY': 'relay', 'GROUP_REFRESH': 0.05})
+class RelayFanoutTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+
+    async def test_relay_rejoins_its_groups_before_they_expire(self):
+        socket = await open_socket(f'/ws/chat/{self.conversation.id}/', self.alice)
+        await receive_frames(socket, 0.01)  # the join
+        relay = fanout.get_fanout()
+        members = relay.channel_layer.groups[fanout.group_name(self.conversation.id)]
+        joined_at = members[relay.channel_name]
+        await receive_frames(socket, 0.2)
+        self.assertGreater(members[relay.channel_name], joined_at)
+        await socket.disconnect()
+        self.assertNotIn(fanout.group_name(self.conversation.id), relay.channel_layer.groups)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_PRESENCE={'COALESCE_WINDOW': 0.1, 'SNAPSHOT_LIMIT': 200})
+class PresenceTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+
+    async def subscribe(self, user):
+        socket = await open_socket('/ws/user/', user)
+        await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'conversation': self.conversation.id}))
+        return socket
+
+    def presence(self, frames):
+        return [(frame['status'], sorted(user['username'] for user in frame['online_users']),
+                 sorted(user['username'] for user in frame.get('offline_users', ())))
+                for frame in frames if frame['type'] == 'online_status']
+
+    async def test_joining_socket_gets_a_snapshot_and_others_a_diff(self):
+        alice = await self.subscribe(self.alice)
+        # the diff announcing alice reaches her own socket too
+        self.assertEqual(self.presence(await receive_frames(alice)),
+                         [('snapshot', ['alice'], []), ('diff', ['alice'], [])])
+        bob = await self.subscribe(self.bob)
+        self.assertEqual(self.presence(await receive_frames(bob)),
+                         [('snapshot', ['alice', 'bob'], []), ('diff', ['bob'], [])])
+        self.assertEqual(self.presence(await receive_frames(alice)), [('diff', ['bob'], [])])
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_a_reconnect_inside_the_window_sends_no_diff(self):
+        alice = await self.subscribe(self.alice)
+        bob = await self.subscribe(self.bob)
+        await receive_frames(alice)
+        await bob.disconnect()
+        bob = await self.subscribe(self.bob)
+        self.assertEqual(self.presence(await receive_frames(alice)), [])
+        await bob.disconnect()
+        self.assertEqual(self.presence(await receive_frames(alice)), [('diff', [], ['bob'])])
+        await alice.disconnect()
+
+    @override_settings(CHAT_PRESENCE={'SNAPSHOT_LIMIT': 1})
+    async def test_large_snapshots_are_truncated(self):
+        alice = await self.subscribe(self.alice)
+        await receive_frames(alice)
+        bob = await self.subscribe(self.bob)
+        snapshot = next(frame for frame in await receive_frames(bob) if frame['type'] == 'online_status')
+        self.assertEqual((len(snapshot['online_users']), snapshot['truncated']), (1, True))
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_TYPING={'TIMEOUT': 0.4, 'MIN_INTERVAL': 0.1})
+class TypingTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+
+    async def open_pair(self):
+        sockets = []
+        for user in (self.alice, self.bob):
+            socket = await open_socket('/ws/user/', user)
+            await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'conversation': self.conversation.id}))
+            sockets.append(socket)
+        for socket in sockets:
+            await receive_frames(socket, 0.1)
+        return sockets
+
+    async def keystrokes(self, socket, count):
+        for _ in range(count):
+            await socket.send_to(text_data=json.dumps({'type': 'typing', 'conversation': self.conversation.id}))
+
+    def typing(self, frames):
+        return [frame['is_typing'] for frame in frames if frame['type'] == 'typing']
+
+    async def test_keystrokes_coalesce_into_one_start_and_one_stop(self):
+        alice, bob = await self.open_pair()
+        await self.keystrokes(alice, 20)
+        self.assertEqual(self.typing(await receive_frames(bob, 0.2)), [True])
+        # keystrokes keep pushing the expiry back, without further events
+        await self.keystrokes(alice, 5)
+        self.assertEqual(self.typing(await receive_frames(bob, 0.2)), [])
+        self.assertEqual(self.typing(await receive_frames(bob, 0.5)), [False])
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_sending_a_message_ends_typing_silently(self):
+        alice, bob = await self.open_pair()
+        await self.keystrokes(alice, 3)
+        await alice.send_to(text_data=json.dumps(
+            {'type': 'chat_message', 'conversation': self.conversation.id, 'message': 'hi'}
+        ))
+        frames = await receive_frames(bob, 0.6)
+        self.assertEqual(self.typing(frames), [True])
+        self.assertIn('chat_message', [frame['type'] for frame in frames])
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_closing_the_socket_ends_typing(self):
+        alice, bob = await self.open_pair()
+        await self.keystrokes(alice, 1)
+        await alice.disconnect()
+        self.assertEqual(self.typing(await receive_frames(bob, 0.2)), [True, False])
+        await bob.disconnect()
+
+
+class MembershipTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.group = Conversation.objects.create_group('team', self.alice, [self.alice, self.bob])
+
+    def test_committed_changes_survive_a_channel_layer_outage(self):
+        carol = User.objects.create_user('carol', password='x')
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        with mock.patch.object(metrics, 'group_send', side_effect=OSError('layer down')), \
+                self.assertLogs('chartapp.membership', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+            response = client.post(f'/chat/conversations/{self.group.id}/members/', {'users': [carol.id]},
+                                   format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(ParticipantState.objects.filter(conversation=self.group, user=carol).exists())
+
+
+    def test_per_process_cache_does_not_keep_removed_members(self):
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        url = f'/chat/conversations/{self.group.id}/messages/'
+        self.assertEqual(client.get(url).status_code, 200)
+        # removed by another worker: this process's cache hears nothing of it
+        ParticipantState.objects.filter(conversation=self.group, user=self.bob).delete()
+        self.assertEqual(client.get(url).status_code, 403)
+
+
+class MessageHistoryTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+        for n in range(3):
+            Message.objects.create(conversation=self.conversation, sender=self.alice, content=str(n))
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        self.url = f'/chat/conversations/{self.conversation.id}/messages/'
+
+    def test_cursors_page_through_history(self):
+        first = self.client.get(self.url, {'page_size': 2})
+        self.assertEqual([message['content'] for message in first.data['results']], ['1', '2'])
+        older = self.client.get(first.data['previous'])
+        self.assertEqual([message['content'] for message in older.data['results']], ['0'])
+
+    def test_crafted_cursors_are_refused(self):
+        for values in ([1, 5], ['2024-01-01T00:00:00', '2024-01-01T00:00:00'], ['2024-01-01T00:00:00', True]):
+            cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+            response = self.client.get(self.url, {'before': cursor})
+            self.assertEqual(response.status_code, 400, values)
+        # a naive timestamp is read as UTC
+        cursor = base64.urlsafe_b64encode(json.dumps(['2999-01-01T00:00:00', 1]).encode()).decode()
+        self.assertEqual(len(self.client.get(self.url, {'before': cursor}).data['results']), 3)
+
+    def test_group_pages_name_only_their_senders(self):
+        carol = User.objects.create_user('carol', password='x')
+        members = [User.objects.create_user(f'member{n}', password='x') for n in range(5)]
+        group = Conversation.objects.create_group('team', self.alice, [self.alice, self.bob, carol, *members])
+        Message.objects.create(conversation=group, sender=self.bob, content='hi')
+        Message.objects.create(conversation=group, sender=carol, content='hello')
+        usernames = lambda data: [user['username'] for user in data['participants']]
+
+        page = self.client.get(f'/chat/conversations/{group.id}/messages/', {'page_size': 1})
+        self.assertEqual(usernames(page.data), ['carol'])
+        delta = self.client.get(f'/chat/conversations/{group.id}/messages/delta/', {'since': 0})
+        self.assertEqual(usernames(delta.data), ['bob', 'carol'])
+        # a direct conversation still names both participants
+        self.assertEqual(usernames(self.client.get(self.url).data), ['alice', 'bob'])
+
+        listed = {conversation['id']: conversation for conversation in self.client.get('/chat/conversations/').data}
+        self.assertIsNone(listed[group.id]['participants'])
+        self.assertEqual(len(listed[self.conversation.id]['participants']), 2)
+
+
+class MarkReadTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+        self.messages = [Message.objects.create(conversation=self.conversation, sender=self.alice, content=str(n))
+                         for n in range(3)]
+
+    def state(self, user):
+        return ParticipantState.objects.get(conversation=self.conversation, user=user)
+
+    def test_unread_count_follows_the_watermark(self):
+        self.assertEqual(self.state(self.bob).unread_count, 3)
+        inbox.mark_read(self.bob.id, self.conversation.id, self.messages[0].id)
+        self.assertEqual(self.state(self.bob).unread_count, 2)
+        inbox.mark_read(self.bob.id, self.conversation.id)
+        state = self.state(self.bob)
+        self.assertEqual((state.read_watermark, state.unread_count), (self.messages[-1].id, 0))
+
+    def test_watermark_is_clamped_to_the_last_message(self):
+        state = inbox.mark_read(self.bob.id, self.conversation.id, 10 ** 12)
+        self.assertEqual(state.read_watermark, self.messages[-1].id)
+        Message.objects.create(conversation=self.conversation, sender=self.alice, content='new')
+        self.assertEqual(self.state(self.bob).unread_count, 1)
+        inbox.mark_read(self.bob.id, self.conversation.id)
+        self.assertEqual(self.state(self.bob).unread_count, 0)
+
+    def test_messages_of_other_conversations_are_refused(self):
+        carol = User.objects.create_user('carol', password='x')
+        other, _ = Conversation.objects.get_or_create_for_participants([self.bob, carol])
+        foreign = Message.objects.create(conversation=other, sender=carol, content='elsewhere')
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        response = client.post(f'/chat/conversations/{self.conversation.id}/read/', {'message': foreign.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.state(self.bob).read_watermark, 0)
+
+    def test_non_members_get_404(self):
+        carol = User.objects.create_user('carol', password='x')
+        client = APIClient()
+        client.force_authenticate(carol)
+        response = client.post(f'/chat/conversations/{self.conversation.id}/read/', {})
+        self.assertEqual(response.status_code, 404)
+
+
+class AdvanceWatermarksTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+        self.messages = [Message.objects.create(conversation=self.conversation, sender=self.alice, content=str(n))
+                         for n in range(3)]
+
+    def state(self, user):
+        return ParticipantState.objects.get(conversation=self.conversation, user=user)
+
+    def test_reading_moves_delivery_along_and_recounts_unread(self):
+        changed = inbox.advance_watermarks({(self.conversation.id, self.bob.id): (0, self.messages[1].id)})
+        self.assertEqual([state.user_id for state in changed], [self.bob.id])
+        state = self.state(self.bob)
+        self.assertEqual((state.delivered_watermark, state.read_watermark, state.unread_count),
+                         (self.messages[1].id, self.messages[1].id, 1))
+
+    def test_watermarks_are_clamped_and_never_move_back(self):
+        key = (self.conversation.id, self.bob.id)
+        inbox.advance_watermarks({key: (10 ** 12, self.messages[1].id)})
+        state = self.state(self.bob)
+        self.assertEqual((state.delivered_watermark, state.read_watermark), (self.messages[-1].id, self.messages[1].id))
+        self.assertEqual(inbox.advance_watermarks({key: (self.messages[0].id, self.messages[0].id)}), [])
+        state = self.state(self.bob)
+        self.assertEqual((state.delivered_watermark, state.read_watermark), (self.messages[-1].id, self.messages[1].id))
+
+    def test_other_members_are_left_alone(self):
+        before = self.state(self.alice)
+        inbox.advance_watermarks({(self.conversation.id, self.bob.id): (self.messages[-1].id, 0)})
+        after = self.state(self.alice)
+        self.assertEqual((after.delivered_watermark, after.read_watermark),
+                         (before.delivered_watermark, before.read_watermark))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ReceiptBufferTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+        self.messages = [Message.objects.create(conversation=self.conversation, sender=self.alice, content=str(n))
+                         for n in range(3)]
+
+    async def test_acks_of_one_member_coalesce_into_one_write(self):
+        buffer = ReceiptBuffer(flush_interval=60)
+        buffer.ack(self.conversation.id, self.bob.id, delivered=self.messages[2].id)
+        buffer.ack(self.conversation.id, self.bob.id, delivered=self.messages[1].id, read=self.messages[0].id)
+        self.assertEqual(buffer.pending, {(self.conversation.id, self.bob.id): [self.messages[2].id,
+                                                                                 self.messages[0].id]})
+        await buffer.close()
+        state = await ParticipantState.objects.aget(conversation=self.conversation, user=self.bob)
+        self.assertEqual((state.delivered_watermark, state.read_watermark, state.unread_count),
+                         (self.messages[2].id, self.messages[0].id, 2))
+
+
+class MessageWriterTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+
+    def message(self, content):
+        return Message(conversation=self.conversation, sender=self.alice, content=content)
+
+    def test_batch_is_stored_in_order_with_sequence_numbers(self):
+        writer = MessageWriter(batch_size=2)
+        writer.pending = [self.message(str(n)) for n in range(5)]
+        writer.flush_sync()
+        self.assertEqual(writer.written, 5)
+        self.assertEqual(list(self.conversation.messages.order_by('seq').values_list('seq', 'content')),
+                         [(n + 1, str(n)) for n in range(5)])
+        # bulk inserts still reach the inbox
+        self.assertEqual(ParticipantState.objects.get(conversation=self.conversation, user=self.bob).unread_count, 5)
+
+    def test_a_bad_row_does_not_lose_the_rest_of_its_batch(self):
+        writer = MessageWriter()
+        writer.pending = [self.message('first'), self.message(None), self.message('last')]
+        with self.assertLogs('chartapp.persistence', 'ERROR'):
+            writer.flush_sync()
+        self.assertEqual((writer.written, writer.failed), (2, 1))
+        self.assertEqual(list(self.conversation.messages.order_by('seq').values_list('seq', 'content')),
+                         [(1, 'first'), (2, 'last')])
+
+
+class MessageSendTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+
+    def test_a_retry_returns_the_stored_message(self):
+        message, created = Message.objects.send(self.conversation, self.alice, 'hi', 'c-1')
+        retried, retry_created = Message.objects.send(self.conversation, self.alice, 'hi', 'c-1')
+        self.assertEqual((created, retry_created, retried.id), (True, False, message.id))
+        # client ids are per sender
+        other, other_created = Message.objects.send(self.conversation, self.bob, 'hi', 'c-1')
+        self.assertTrue(other_created)
+        self.assertEqual(self.conversation.messages.count(), 2)
+
+    def test_a_concurrent_retry_loses_on_the_unique_constraint(self):
+        message, _ = Message.objects.send(self.conversation, self.alice, 'hi', 'c-1')
+        # the retry's lookup ran before the first attempt committed
+        with mock.patch('django.db.models.QuerySet.first', return_value=None):
+            retried, created = Message.objects.send(self.conversation, self.alice, 'hi', 'c-1')
+        self.assertEqual((retried.id, created), (message.id, False))
+        self.assertEqual(self.conversation.messages.count(), 1)
+
+    def test_rest_retries_answer_200_with_the_same_message(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        url = f'/chat/conversations/{self.conversation.id}/messages/'
+        payload = {'conversation': self.conversation.id, 'content': 'hi', 'client_id': 'c-1'}
+        first = client.post(url, payload, format='json')
+        retry = client.post(url, payload, format='json')
+        self.assertEqual((first.status_code, retry.status_code), (201, 200))
+        self.assertEqual(first.data, retry.data)
+        self.assertEqual(self.conversation.messages.count(), 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class SocketRetryTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+
+    async def test_a_retried_send_is_confirmed_to_the_sender_only(self):
+        sender = await open_socket(f'/ws/chat/{self.conversation.id}/', self.alice)
+        receiver = await open_socket(f'/ws/chat/{self.conversation.id}/', self.bob)
+        await receive_frames(sender, 0.1)
+        for _ in range(2):
+            await sender.send_to(text_data=json.dumps({'type': 'chat_message', 'message': 'hi', 'client_id': 'c-1'}))
+        sent = [frame for frame in await receive_frames(sender) if frame['type'] == 'chat_message']
+        received = [frame for frame in await receive_frames(receiver) if frame['type'] == 'chat_message']
+        self.assertEqual([frame['client_id'] for frame in sent], ['c-1', 'c-1'])
+        self.assertEqual(sent[0]['id'], sent[1]['id'])
+        self.assertEqual([frame['id'] for frame in received], [sent[0]['id']])
+        self.assertEqual(await Message.objects.filter(conversation=self.conversation).acount(), 1)
+        await sender.disconnect()
+        await receiver.disconnect()
+
+
+class WriteBehindShutdownTests(TransactionTestCase):
+    # the flush runs on its own thread, so test data must be committed
+
+    def test_sigterm_drains_the_buffer_before_stopping(self):
+        alice = User.objects.create_user('alice', password='x')
+        bob = User.objects.create_user('bob', password='x')
+        conversation, _ = Conversation.objects.get_or_create_for_participants([alice, bob])
+        writer = MessageWriter()
+        writer.pending = [Message(conversation=conversation, sender=alice, content=str(n)) for n in range(2)]
+        previous = mock.Mock()
+        with mock.patch('signal.getsignal', return_value=previous), mock.patch('signal.signal') as set_handler:
+            flush_on_sigterm(writer)
+        handle = set_handler.call_args[0][1]
+        handle(signal.SIGTERM, None)
+        self.assertEqual(conversation.messages.count(), 2)
+        previous.assert_called_once_with(signal.SIGTERM, None)
+
+
+class SequenceTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+
+    def test_allocate_seqs_hands_out_consecutive_ranges(self):
+        first = Conversation.objects.allocate_seqs(self.conversation.id, 3)
+        second = Conversation.objects.allocate_seqs(self.conversation.id, 2)
+        self.assertEqual((first, second), (1, 4))
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_seq, 5)
+
+    def test_saves_and_bulk_inserts_share_one_sequence(self):
+        Message.objects.create(conversation=self.conversation, sender=self.alice, content='one')
+        Message.objects.bulk_create([Message(conversation=self.conversation, sender=self.bob, content=str(n))
+                                     for n in range(2)])
+        Message.objects.create(conversation=self.conversation, sender=self.alice, content='four')
+        self.assertEqual(list(self.conversation.messages.order_by('id').values_list('seq', flat=True)), [1, 2, 3, 4])
+
+    def test_sequences_are_per_conversation(self):
+        carol = User.objects.create_user('carol', password='x')
+        other, _ = Conversation.objects.get_or_create_for_participants([self.alice, carol])
+        Message.objects.create(conversation=self.conversation, sender=self.alice, content='a')
+        message = Message.objects.create(conversation=other, sender=self.alice, content='b')
+        self.assertEqual(message.seq, 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ResumeTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+        for n in range(5):
+            Message.objects.create(conversation=self.conversation, sender=self.alice, content=str(n))
+
+    async def test_reconnect_replays_missed_messages_then_live_ones(self):
+        communicator = await open_socket(f'/ws/chat/{self.conversation.id}/', self.bob, '&last_seq=3')
+        sender = await open_socket(f'/ws/chat/{self.conversation.id}/', self.alice)
+        await sender.send_to(text_data=json.dumps({'type': 'chat_message', 'message': 'live'}))
+        seqs = [frame['seq'] for frame in await receive_frames(communicator) if frame['type'] == 'chat_message']
+        self.assertEqual(seqs, [4, 5, 6])
+        await communicator.disconnect()
+        await sender.disconnect()
+
+    async def test_too_far_behind_gets_resync_required(self):
+        with mock.patch.object(BaseChatConsumer, 'max_replay', 2):
+            communicator = await open_socket(f'/ws/chat/{self.conversation.id}/', self.bob, '&last_seq=0')
+            frames = await receive_frames(communicator)
+        self.assertEqual([frame['type'] for frame in frames if frame['type'] != 'online_status'], ['resync_required'])
+        await communicator.disconnect()
+
+
+class MetricsViewTests(TestCase):
+    url = '/chat/metrics/'
+
+    def test_anonymous_clients_are_refused(self):
+        self.assertEqual(APIClient().get(self.url).status_code, 401)
+
+    def test_regular_users_are_refused(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('alice', password='x'))
+        self.assertEqual(client.get(self.url).status_code, 403)
+
+    def test_staff_users_can_read(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('admin', password='x', is_staff=True))
+        response = client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'chat_http_requests_total', response.content)
+
+    @override_settings(CHAT_METRICS={'TOKEN': 's3cret'})
+    def test_scrapers_with_the_token_can_read(self):
+        self.assertEqual(APIClient().get(self.url, HTTP_AUTHORIZATION='Metrics s3cret').status_code, 200)
+        self.assertEqual(APIClient().get(self.url, HTTP_AUTHORIZATION='Metrics wrong').status_code, 401)
+
+    @override_settings(CHAT_METRICS={'ALLOWED_IPS': ['127.0.0.1']})
+    def test_allowed_addresses_can_read(self):
+        self.assertEqual(APIClient().get(self.url, REMOTE_ADDR='127.0.0.1').status_code, 200)
+        self.assertEqual(APIClient().get(self.url, REMOTE_ADDR='10.0.0.9').status_code, 401)
+
+
+class UserDirectoryTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('viewer', password='x'))
+        for username in ('Émile', 'éric', 'Alice', 'alfred', 'bob'):
+            User.objects.create_user(username, password='x')
+
+    def usernames(self, prefix):
+        response = self.client.get('/chat/users/directory/', {'q': prefix})
+        return [user['username'] for user in response.data['results']]
+
+    def test_prefix_ignores_ascii_case(self):
+        self.assertEqual(self.usernames('AL'), ['alfred', 'Alice'])
+
+    def test_non_ascii_prefixes_match_their_own_case(self):
+        self.assertEqual(self.usernames('É'), ['Émile'])
+        self.assertEqual(self.usernames('é'), ['éric'])
+
+    def test_unchanged_directory_answers_304(self):
+        etag = self.client.get('/chat/users/directory/')['ETag']
+        version = etag[len('W/"'):-1]
+        for header in (etag, f'"other", {etag}', f'"{version}"'):
+            self.assertEqual(self.client.get('/chat/users/directory/', HTTP_IF_NONE_MATCH=header).status_code, 304)
+        # only whole tags match
+        for header in (f'W/"{version[:8]}"', f'"x{version}"', version):
+            self.assertEqual(self.client.get('/chat/users/directory/', HTTP_IF_NONE_MATCH=header).status_code, 200)
+        User.objects.create_user('zed', password='x')
+        self.assertEqual(self.client.get('/chat/users/directory/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_cached_pages_link_relatively(self):
+        response = self.client.get('/chat/users/directory/', {'page_size': 2}, HTTP_HOST='first.example')
+        self.assertTrue(response.data['next'].startswith('/chat/users/directory/?'))
+        cached = self.client.get('/chat/users/directory/', {'page_size': 2}, HTTP_HOST='second.example')
+        self.assertEqual(cached.data['next'], response.data['next'])
+
+
+class HistoryExportTests(TransactionTestCase):
+    # the export is read on the database pool, so test data must be committed
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+        for n in range(5):
+            Message.objects.create(conversation=self.conversation, sender=self.alice, content=str(n))
+
+    async def test_export_streams_keyset_chunks_asynchronously(self):
+        token = AccessToken.for_user(self.alice)
+        with mock.patch.object(history, 'CHUNK_SIZE', 2):
+            response = await AsyncClient().get(f'/chat/conversations/{self.conversation.id}/export/',
+                                               headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_async)
+            chunks = [chunk async for chunk in response.streaming_content]
+        # the header, then messages two at a time
+        self.assertEqual(len(chunks), 4)
+        records = [json.loads(line) for line in b''.join(chunks).decode().splitlines()]
+        self.assertEqual(records[0]['type'], 'conversation')
+        self.assertEqual([(record['seq'], record['content']) for record in records[1:]],
+                         [(n + 1, str(n)) for n in range(5)])
+
+    def test_groups_round_trip_with_their_name_and_roles(self):
+        carol = User.objects.create_user('carol', password='x')
+        members = [self.alice, self.bob, carol]
+        groups = [Conversation.objects.create_group(name, self.alice, members) for name in ('team', 'team-2')]
+        ParticipantState.objects.filter(conversation=groups[0], user=self.bob).update(role=ParticipantState.ADMIN)
+        Message.objects.create(conversation=groups[0], sender=carol, content='hi')
+        codec = history.CODECS['ndjson']
+        export = b''.join(history.encode_stream(history.export_records(groups), codec))
+
+        result = history.HistoryImporter().run(codec.decode(export.splitlines()))
+        self.assertEqual(result, {'conversations': 2, 'messages': 1})
+        # groups with the same members are not merged, neither with each other nor with the originals
+        imported = Conversation.objects.filter(is_group=True).exclude(id__in=[group.id for group in groups])
+        self.assertEqual(sorted(imported.values_list('name', flat=True)), ['team', 'team-2'])
+        team = imported.get(name='team')
+        self.assertEqual(dict(team.participant_states.values_list('user__username', 'role')),
+                         {'alice': ParticipantState.OWNER, 'bob': ParticipantState.ADMIN,
+                          'carol': ParticipantState.MEMBER})
+        self.assertEqual(list(team.messages.values_list('sender__username', 'content')), [('carol', 'hi')])
+
+
+class MessageSearchTests(TestCase):
+    # runs on the configured database: FTS5 on SQLite, the GIN index on PostgreSQL
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        carol = User.objects.create_user('carol', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+        other, _ = Conversation.objects.get_or_create_for_participants([self.bob, carol])
+        self.hello = Message.objects.create(conversation=self.conversation, sender=self.bob,
+                                            content='hello <b>world</b>')
+        Message.objects.create(conversation=other, sender=self.bob, content='hello carol')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def search(self, **params):
+        response = self.client.get('/chat/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data['results']
+
+    def test_prefix_search_is_scoped_to_the_users_conversations(self):
+        results = self.search(q='hel wor')
+        self.assertEqual([result['id'] for result in results], [self.hello.id])
+        self.assertEqual(results[0]['sender']['username'], 'bob')
+        self.assertIn('<mark>hello</mark>', results[0]['snippet'])
+        # message text is escaped, only the highlight is markup
+        self.assertIn('&lt;b&gt;', results[0]['snippet'])
+        self.assertEqual(self.search(q='carol'), [])
+
+    def test_index_follows_bulk_inserts_and_deletes(self):
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, sender=self.alice, content=f'bulk note {n}', seq=10 + n)
+            for n in range(3)
+        ])
+        self.assertEqual(len(self.search(q='note')), 3)
+        self.hello.delete()
+        self.assertEqual(self.search(q='hello'), [])
+
+    def test_query_syntax_is_treated_as_text(self):
+        for query in ('"hello', '(hello', 'hello*)', '^hello:'):
+            self.assertEqual([result['id'] for result in self.search(q=query)], [self.hello.id], query)
+        self.assertEqual(self.search(q='***'), [])
+
+
+class PostgresSearchBackendTests(SimpleTestCase):
+
+    def test_words_become_a_prefix_tsquery(self):
+        cursor = mock.MagicMock()
+        cursor.fetchall.return_value = [(7, f'{search._HIGHLIGHT_START}hel{search._HIGHLIGHT_END}lo <i>', 0.5)]
+        connection = mock.MagicMock(vendor='postgresql')
+        connection.cursor.return_value.__enter__.return_value = cursor
+        with mock.patch.object(search, 'connections', {'default': connection}):
+            backend = search.get_search_backend()
+            self.assertIsInstance(backend, search.PostgresSearchBackend)
+            hits = backend.search(3, 'hel" wor:*', conversation_id=9, limit=5, offset=10)
+        self.assertEqual(hits, [(7, '<mark>hel</mark>lo &lt;i&gt;', 0.5)])
+        sql, params = cursor.execute.call_args.args
+        self.assertIn("to_tsquery('simple', %s)", sql)
+        self.assertEqual(params[1:], ['hel:* & wor:*', 3, 9, 5, 10])
+
+
+@mock.patch.object(routers, 'replica_aliases', lambda: ['replica'])
+class ReadYourWritesTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+
+    def request(self, method, user, address='10.0.0.1'):
+        request = getattr(RequestFactory(), method)('/chat/users/directory/', REMOTE_ADDR=address)
+        request.resolver_match = resolve('/chat/users/directory/')
+        if user is not None:
+            request.user = user
+        return request
+
+    def write(self, user, address='10.0.0.1'):
+        routers.ReadYourWritesMiddleware(lambda request: None)(self.request('post', user, address))
+
+    def test_a_writer_reads_from_the_primary(self):
+        self.write(self.alice)
+        self.assertEqual(routers.read_database(self.request('get', self.alice, '10.0.0.2')), 'default')
+        self.assertEqual(routers.read_database(self.request('get', self.bob)), 'replica')
+
+    def test_clients_are_not_pinned_by_address(self):
+        self.write(AnonymousUser())
+        self.assertEqual(routers.pin_keys(self.request('post', AnonymousUser())), [])
+        self.assertEqual(routers.read_database(self.request('get', AnonymousUser())), 'replica')
+
+    def test_reads_wait_for_authentication(self):
+        self.assertIsNone(routers.read_database(self.request('get', None)))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class EventListenerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.carol = User.objects.create_user('carol', password='x')
+        self.first, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+        self.second, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.carol])
+
+    def live(self, conversation, message_id):
+        return {'type': 'chat_message', 'conversation': conversation.id, 'id': message_id, 'message': str(message_id)}
+
+    def queued_ids(self, listener):
+        return [json.loads(frame)['id'] for frame, message_id in listener.take() if message_id is not None]
+
+    async def test_live_messages_are_kept_whatever_their_id(self):
+        listener = events.EventListener(self.alice)
+        await listener.open()
+        # ids committed out of order across conversations
+        await listener.chat_message(self.live(self.first, 101))
+        await listener.chat_message(self.live(self.second, 100))
+        self.assertEqual(self.queued_ids(listener), [101, 100])
+        await listener.close()
+
+    async def test_catch_up_copies_are_not_sent_twice(self):
+        message = await Message.objects.acreate(conversation=self.first, sender=self.bob, content='missed')
+        listener = events.EventListener(self.alice)
+        await listener.open(last_id=0)
+        await listener.chat_message(self.live(self.first, message.id))
+        await listener.chat_message(self.live(self.second, message.id + 1))
+        self.assertEqual(self.queued_ids(listener), [message.id, message.id + 1])
+        await listener.close()
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        settings_override = override_settings(CHAT_ARCHIVE={'ROOT': self.root, 'BLOCK_SIZE': 2})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.alice = User.objects.create_user('alice', password='x')
+        self.bob = User.objects.create_user('bob', password='x')
+        self.conversation, _ = Conversation.objects.get_or_create_for_participants([self.alice, self.bob])
+        self.messages = [Message.objects.create(conversation=self.conversation, sender=self.alice, content=str(n))
+                         for n in range(5)]
+        long_ago = timezone.now() - timedelta(days=400)
+        for n, message in enumerate(self.messages[:4]):
+            Message.objects.filter(id=message.id).update(timestamp=long_ago + timedelta(seconds=n))
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_old_messages_move_to_segments_a_block_at_a_time(self):
+        self.assertEqual(archive.archive_old_messages(), {self.conversation.id: 4})
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.archived_seq, 4)
+        self.assertEqual(self.conversation.archive_blocks.count(), 2)
+        self.assertEqual(list(self.conversation.messages.values_list('content', flat=True)), ['4'])
+        # nothing left to do: archiving resumes where it stopped
+        self.assertEqual(archive.archive_old_messages(), {})
+
+    def test_history_pages_merge_archived_and_hot_rows(self):
+        archive.archive_old_messages()
+        url = f'/chat/conversations/{self.conversation.id}/messages/'
+        newest = self.client.get(url, {'page_size': 3})
+        self.assertEqual([message['content'] for message in newest.data['results']], ['2', '3', '4'])
+        older = self.client.get(newest.data['previous'])
+        self.assertEqual([message['content'] for message in older.data['results']], ['0', '1'])
+        self.assertIsNone(older.data['previous'])
+
+    def test_archived_messages_can_be_read_but_not_deleted(self):
+        archive.archive_old_messages()
+        url = f'/chat/conversations/{self.conversation.id}/messages/{self.messages[0].id}/'
+        response = self.client.get(url)
+        self.assertEqual((response.status_code, response.data['content']), (200, '0'))
+        self.assertEqual(self.client.delete(url).status_code, 404)
+
+
+class SegmentStoreTests(TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        # one open map: every read of the other segment evicts the one a neighbour may be slicing
+        self.store = archive.SegmentStore(root, max_open=1)
+        self.payloads = {segment: segment.encode() * 1000 for segment in ('a.seg', 'b.seg')}
+        for segment, payload in self.payloads.items():
+            self.store.append(1, segment, 0, payload)
+
+    def test_a_map_evicted_mid_read_is_closed_by_its_reader(self):
+        store = self.store
+        store.read(1, 'a.seg', 0, 1)
+        mapped = store._maps[store.path(1, 'a.seg')]
+        real = mapped.map
+
+        class EvictingMap:
+            # another thread reads the other segment while this one slices
+            def __len__(self):
+                return len(real)
+
+            def __getitem__(self, key):
+                store.read(1, 'b.seg', 0, 1)
+                self.open_while_slicing = not real.closed
+                return real[key]
+
+            def close(self):
+                real.close()
+
+        mapped.map = EvictingMap()
+        self.assertEqual(store.read(1, 'a.seg', 0, 3), b'a.s')
+        self.assertTrue(mapped.map.open_while_slicing)
+        self.assertTrue(real.closed)
+
+    def test_concurrent_reads_survive_eviction(self):
+        store, payloads = self.store, self.payloads
+        errors = []
+
+        def read(segment):
+            try:
+                for _ in range(300):
+                    if store.read(1, segment, 0, len(payloads[segment])) != payloads[segment]:
+                        errors.append(segment)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=read, args=(segment,)) for segment in payloads for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(store._maps), 1)
@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics
+from .wire import new_event_id
+
+
+class TypingState:
+    __slots__ = ('user', 'receiver', 'seen_at', 'expires_at', 'task')
+
+    def __init__(self, user, receiver, now, expires_at):
+        self.user = user
+        self.receiver = receiver
+        self.seen_at = now
+        self.expires_at = expires_at
+        self.task = None
+
+
+class TypingTracker:
+    """
+    Turns the keystroke ``typing`` frames clients emit into start/stop
+    transitions, per worker process.
+
+    Frames from one user in one conversation are processed at most once
+    per ``min_interval`` seconds; the rest are dropped without any work.
+    The first processed frame broadcasts ``is_typing: True``, later ones
+    only push a server-side expiry ``timeout`` seconds ahead. When the
+    expiry passes (or the socket closes) a single ``is_typing: False`` is
+    broadcast. Sending a message ends typing silently, since receivers
+    already clear the indicator on ``chat_message``.
+    """
+
+    def __init__(self, timeout=3.0, min_interval=0.5):
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.active = {}  # (conversation_id, user_id) -> TypingState
+
+    async def keystroke(self, channel_layer, conversation_id, user_data, receiver=None):
+        key = (conversation_id, user_data['id'])
+        now = time.monotonic()
+        state = self.active.get(key)
+        if state is not None:
+            if now - state.seen_at >= self.min_interval:
+                state.seen_at = now
+                state.expires_at = now + self.timeout
+            return
+
+        state = self.active[key] = TypingState(user_data, receiver, now, now + self.timeout)
+        state.task = asyncio.get_running_loop().create_task(self._expire(channel_layer, key, state))
+        await self._broadcast(channel_layer, conversation_id, state, True)
+
+    async def stop(self, channel_layer, conversation_id, user_id, notify=True):
+        state = self.active.pop((conversation_id, user_id), None)
+        if state is None:
+            return
+        state.task.cancel()
+        if notify:
+            await self._broadcast(channel_layer, conversation_id, state, False)
+
+    async def _expire(self, channel_layer, key, state):
+        delay = state.expires_at - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = state.expires_at - time.monotonic()
+        if self.active.get(key) is state:
+            del self.active[key]
+            await self._broadcast(channel_layer, key[0], state, False)
+
+    async def _broadcast(self, channel_layer, conversation_id, state, is_typing):
+        await metrics.group_send(
+            channel_layer,
+            f'chat_{conversation_id}',
+            {
+                'type': 'typing',
+                'event_id': new_event_id(),
+                'conversation': conversation_id,
+                'user': state.user,
+                'receiver': state.receiver,
+                'is_typing': is_typing,
+            }
+        )
+
+
+_tracker = None
+
+
+def get_typing_tracker():
+    global _tracker
+    if _tracker is None:
+        options = getattr(settings, 'CHAT_TYPING', {})
+        _tracker = TypingTracker(
+            timeout=options.get('TIMEOUT', 3.0),
+            min_interval=options.get('MIN_INTERVAL', 0.5),
+        )
+    return _tracker
+
+
+@receiver(setting_changed)
+def reset_typing_tracker(setting, **kwargs):
+    global _tracker
+    if setting == 'CHAT_TYPING':
+        _tracker = None
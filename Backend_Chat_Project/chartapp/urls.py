@@ -5,10 +5,24 @@ from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 urlpatterns = [
     path('auth/register/', CreateUserView.as_view(), name='register'),
     path('users/', UserListView.as_view(), name='user-list'),
+    path('users/directory/', UserDirectoryView.as_view(), name='user-directory'),
     path('auth/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('auth/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('conversations/', ConversationListCreateView.as_view(), name='conversation_list'),
+    path('conversations/with/<int:user_id>/', OpenConversationView.as_view(), name='conversation_open'),
+    path('inbox/', InboxView.as_view(), name='inbox'),
+    path('conversations/<int:conversation_id>/read/', MarkReadView.as_view(), name='conversation_read'),
+    path('conversations/<int:conversation_id>/members/', ConversationMembersView.as_view(), name='conversation_members'),
+    path('conversations/<int:conversation_id>/members/<int:user_id>/', ConversationMemberView.as_view(), name='conversation_member'),
     path('conversations/<int:conversation_id>/messages/', MessageListCreateView.as_view(), name='message_list_create'),
+    path('conversations/<int:conversation_id>/messages/async/', AsyncMessageListCreateView.as_view(), name='message_list_create_async'),
+    path('conversations/<int:conversation_id>/messages/delta/', MessageDeltaView.as_view(), name='message_delta'),
+    path('conversations/<int:conversation_id>/export/', ConversationExportView.as_view(), name='conversation_export'),
+    path('export/', UserExportView.as_view(), name='user_export'),
+    path('events/stream/', EventStreamView.as_view(), name='event_stream'),
+    path('events/poll/', EventPollView.as_view(), name='event_poll'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('search/', MessageSearchView.as_view(), name='message_search'),
     path('conversations/<int:conversation_id>/messages/<int:pk>/', MessageRetrieveDestroyView.as_view(), name='message_detail_destroy'),
     
 ]
\ No newline at end of file
@@ -1,13 +1,55 @@
-from rest_framework import generics, permissions, status
+from rest_framework import generics, permissions, serializers, status
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch, prefetch_related_objects
+from django.db.models.functions import Lower
+from django.utils.cache import patch_cache_control
 from django.shortcuts import get_object_or_404
 from .models import *
 from .serializers import *
-from rest_framework.exceptions import PermissionDenied
-from drf_yasg.utils import swagger_auto_schema
+from .pagination import InboxCursorPagination, MemberPagination, MessageCursorPagination, UserDirectoryPagination
+from . import archive, data, directory, events, history, inbox, membership, receipts, ws_auth
+from .search import SearchNotSupported, get_search_backend
+from rest_framework.exceptions import (
+    APIException, AuthenticationFailed, NotAuthenticated, NotFound, ParseError, PermissionDenied
+)
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+from drf_yasg.utils import no_body, swagger_auto_schema
 from drf_yasg import openapi
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from . import metrics
+import hmac
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def prefetch_direct_participants(conversations):
+    # groups are listed without their members (see serializers.direct_participants)
+    prefetch_related_objects([conversation for conversation in conversations if not conversation.is_group],
+                             Prefetch('participants', queryset=User.objects.only('id', 'username')))
+
+
+def page_users(conversation, rows):
+    """
+    ``[{'id', 'username'}]`` of the users a page of messages refers to: the
+    participants of a direct conversation, the page's senders in a group,
+    so a page of a large group costs no more than its rows.
+    """
+    if conversation.is_group:
+        users = User.objects.filter(id__in={row['sender_id'] for row in rows})
+    else:
+        users = conversation.participants.all()
+    return list(users.order_by('id').values('id', 'username'))
 
 
 class CreateUserView(generics.CreateAPIView):
@@ -33,6 +75,7 @@ class UserListView(generics.ListAPIView):
     """
     List all registered users (requires authentication)
     """
+    read_from_replica = True
     queryset = User.objects.all()
     serializer_class = UserListSerializer
     permission_classes = [IsAuthenticated]
@@ -45,23 +88,91 @@ class UserListView(generics.ListAPIView):
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
+class UserDirectoryView(generics.ListAPIView):
+    """
+    Page through users in username order, optionally filtered by a
+    username prefix. The prefix ignores case of ASCII letters only, as
+    SQLite's ``LOWER()`` does: ``é`` does not match ``É``. Pages are cached
+    server-side and carry an ETag, so an unchanged directory answers 304
+    Not Modified.
+    """
+    read_from_replica = True
+    serializer_class = UserListSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = UserDirectoryPagination
+
+    def get_queryset(self):
+        queryset = User.objects.annotate(username_lower=Lower('username')).only('id', 'username')
+        prefix = self.request.query_params.get('q', '').strip()
+        if prefix:
+            # a range scan on the LOWER(username), id index
+            lower, upper = directory.prefix_range(prefix)
+            queryset = queryset.filter(username_lower__gte=lower)
+            if upper is not None:
+                queryset = queryset.filter(username_lower__lt=upper)
+        return queryset
+
+    @swagger_auto_schema(
+        operation_summary="User directory",
+        operation_description="List users by username with optional prefix search and keyset pagination. "
+                              "Send the ETag back in If-None-Match to get 304 when nothing changed.",
+        manual_parameters=[
+            openapi.Parameter('q', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description='Username prefix, case-insensitive for ASCII letters'),
+            openapi.Parameter('after', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description='Cursor: users after this one'),
+            openapi.Parameter('before', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description='Cursor: users before this one'),
+            openapi.Parameter('page_size', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Users per page (capped at 100)'),
+        ],
+        tags=['Users']
+        )
+    def get(self, request, *args, **kwargs):
+        version = directory.get_version()
+        etag = f'W/"{version}"'
+        if directory.etag_matches(etag, request.headers.get('If-None-Match')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            key = directory.page_key(version, request.query_params)
+            page = cache.get(key)
+            if page is None:
+                page = super().get(request, *args, **kwargs).data
+                cache.set(key, page, directory.cache_timeout())
+            response = Response(page)
+        response['ETag'] = etag
+        # browsers keep the page but revalidate it every time
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
 class ConversationListCreateView(generics.ListCreateAPIView):
     """
     list:
-    Retrieve all conversations of the logged-in user.
+    Retrieve all conversations of the logged-in user. Groups come without
+    their participants (null); page through ``conversations/<id>/members/``.
 
     create:
     Create a new conversation with exactly two participants. 
     Validates duplicates and ensures the request user is included.
+    To get the conversation whether or not it exists, use
+    ``conversations/with/<user_id>/``.
+    With ``is_group`` (or more than two participants) it creates a group
+    instead, owned by the request user; members are then managed through
+    ``conversations/<id>/members/``.
     """
+    read_from_replica = True
 
     serializer_class = ConversationSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return (Conversation.objects
-                .filter(participants=self.request.user)
-                .prefetch_related('participants'))
+        return Conversation.objects.prefetch_related(None).filter(participants=self.request.user)
+
+    def list(self, request, *args, **kwargs):
+        conversations = list(self.get_queryset())
+        prefetch_direct_participants(conversations)
+        return Response(self.get_serializer(conversations, many=True).data)
     
     @swagger_auto_schema(
         operation_summary="List user conversations",
@@ -74,7 +185,9 @@ class ConversationListCreateView(generics.ListCreateAPIView):
     # create method
     @swagger_auto_schema(
         operation_summary="Create a conversation",
-        operation_description="Create a conversation with exactly two participants (request user included). Validates duplicates.",
+        operation_description="Create a conversation with exactly two participants (request user included). "
+                              "Validates duplicates. With is_group or more than two participants, create a "
+                              "group owned by the request user.",
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
             required=['participants'],
@@ -82,19 +195,24 @@ class ConversationListCreateView(generics.ListCreateAPIView):
                 'participants': openapi.Schema(
                     type=openapi.TYPE_ARRAY,
                     items=openapi.Items(type=openapi.TYPE_INTEGER),
-                    description='IDs of the two participants (must include request user)'
-                )
+                    description='IDs of the participants (must include request user)'
+                ),
+                'is_group': openapi.Schema(type=openapi.TYPE_BOOLEAN,
+                                           description='Create a group even with two participants'),
+                'name': openapi.Schema(type=openapi.TYPE_STRING, description='Group name'),
             }
         ),
         responses={
             201: ConversationSerializer,
-            400: 'Bad Request (invalid participants or conversation already exists)',
+            400: 'Bad Request (invalid participants, too many members or conversation already exists)',
             403: 'Forbidden (request user not included)'
         },
         tags=['Conversations']
     )
     def post(self, request, *args, **kwargs):
         participants_data = request.data.get('participants', [])
+        if request.data.get('is_group') or len(participants_data) > 2:
+            return self.create_group(request, participants_data)
      
     # Check exactly two participants
         if len(participants_data) != 2:
@@ -110,75 +228,166 @@ class ConversationListCreateView(generics.ListCreateAPIView):
                 status=status.HTTP_403_FORBIDDEN
             )
     # Fetch users from DB
-        users = User.objects.filter(id__in=participants_data)
-        if users.count() != 2:
+        users = list(User.objects.filter(id__in=participants_data).only('id', 'username'))
+        if len(users) != 2:
             return Response(
                 {'error': 'A conversation needs exactly two participants'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-    # Check if conversation already exists
-
-        existing_conversation = Conversation.objects.filter(
-            participants__id=participants_data[0]
-        ).filter(
-            participants__id=participants_data[1]
-        ).distinct()
-
-        if existing_conversation.exists():
+    # Look the pair up by its participant key (one unique index probe)
+        conversation, created = Conversation.objects.get_or_create_for_participants(users)
+        if not created:
             return Response(
                 {'error': 'A conversation already exists between these participants'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        conversation = Conversation.objects.create()
-        conversation.participants.set(users)
 
         #serialize the conversation
         serializer = self.get_serializer(conversation)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
-    
+
+    def create_group(self, request, participants_data):
+        try:
+            user_ids = {int(user_id) for user_id in participants_data}
+        except (TypeError, ValueError):
+            return Response({'error': 'participants must be user ids'}, status=status.HTTP_400_BAD_REQUEST)
+        if request.user.id not in user_ids:
+            return Response(
+                {'error': 'You are not a participant of this conversation'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        max_members = membership.get_options()['MAX_MEMBERS']
+        if len(user_ids) > max_members:
+            return Response({'error': f'A group can have at most {max_members} members'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        name = str(request.data.get('name') or '')
+        if len(name) > Conversation._meta.get_field('name').max_length:
+            return Response({'error': 'The group name is too long'}, status=status.HTTP_400_BAD_REQUEST)
+        users = list(User.objects.filter(id__in=user_ids).only('id', 'username'))
+        if len(users) != len(user_ids):
+            return Response({'error': 'Some participants do not exist'}, status=status.HTTP_400_BAD_REQUEST)
+
+        conversation = Conversation.objects.create_group(name, request.user, users)
+        serializer = self.get_serializer(conversation)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class OpenConversationView(generics.GenericAPIView):
+    """
+    Open the conversation between the logged-in user and another user,
+    creating it on first contact.
+    """
+    serializer_class = ConversationSerializer
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_summary="Open a conversation with a user",
+        operation_description="Return the existing conversation between the request user and the given user, "
+                              "or create it. Idempotent: repeated calls return the same conversation.",
+        request_body=no_body,
+        responses={
+            200: ConversationSerializer,
+            201: ConversationSerializer,
+            400: 'Bad Request (cannot open a conversation with yourself)',
+            404: 'User not found'
+        },
+        tags=['Conversations']
+    )
+    def post(self, request, user_id, *args, **kwargs):
+        if user_id == request.user.id:
+            return Response(
+                {'error': 'You cannot open a conversation with yourself'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        other = get_object_or_404(User.objects.only('id', 'username'), id=user_id)
+        conversation, created = Conversation.objects.get_or_create_for_participants([request.user, other])
+        serializer = self.get_serializer(conversation)
+        return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
 
-class MessageListCreateView(generics.ListCreateAPIView):
+class ConversationMemberMixin:
+    def get_conversation(self, conversation_id):
+        #check if user is a participant of the conversation, it helps to fetch the conversation and 
+        #validate the participants against the member cache (groups can be large)
+        conversation = get_object_or_404(Conversation.objects.prefetch_related(None), id=conversation_id)
+        self.members = membership.get_member_cache().get(conversation.id)
+        if self.request.user.id not in self.members:
+            raise PermissionDenied('You are not a participant of this conversation')
+        return conversation
+
+
+class MessageListCreateView(ConversationMemberMixin, generics.ListCreateAPIView):
     """
     list:
-    List all messages in a conversation.
+    List the messages of a conversation, one cursor page at a time
+    (newest page first, use the `previous` link to scroll back).
+    Messages refer to their sender by id; `participants` names them once
+    per page: both participants of a direct conversation, only the page's
+    senders in a group.
 
     create:
     Send a new message in a conversation. Only participants can send messages.
+    A retry carrying the same `client_id` returns the stored message (200)
+    instead of sending it twice.
     """
+    read_from_replica = True
     permission_classes = [IsAuthenticated]
+    pagination_class = MessageCursorPagination
 
     def get_queryset(self):
         conversation_id = self.kwargs['conversation_id']
-        conversation = self.get_conversation(conversation_id)
+        self.conversation = self.get_conversation(conversation_id)
 
-        return conversation.messages.order_by('timestamp')
+        # ordering is applied by the keyset paginator; rows are plain dicts
+        return self.conversation.messages.values(*CompactMessageSerializer.values_fields)
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
             return CreateMessageSerializer
-        return MessageSerializer
+        return CompactMessageSerializer
+
+    def list(self, request, *args, **kwargs):
+        # hot path: one query for the page, no per-message serializer or participant lookups
+        page = self.paginate_queryset(self.get_queryset())
+        response = self.get_paginated_response(CompactMessageSerializer.to_rows(page))
+        response.data = {
+            'conversation': self.conversation.id,
+            'participants': page_users(self.conversation, page),
+            **response.data,
+        }
+        return response
 
     def perform_create(self, serializer):
         #fetch conversation and validate user participation
-        print("Incoming conversation", self.request.data)
+        logger.debug('Incoming message for conversation %s', self.kwargs['conversation_id'])
         conversation_id = self.kwargs['conversation_id']
         conversation = self.get_conversation(conversation_id)
 
-        serializer.save(sender=self.request.user, conversation=conversation)
+        validated = serializer.validated_data
+        serializer.instance, self.created = Message.objects.send(
+            conversation, self.request.user, validated['content'], validated.get('client_id')
+        )
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        if not self.created:
+            # a retried send: nothing was stored or announced again
+            response.status_code = status.HTTP_200_OK
+        return response
 
-    def get_conversation(self, conversation_id):
-        #check if user is a participant of the conversation, it helps to fetch the conversation and 
-        #validate the participants
-        conversation = get_object_or_404(Conversation, id=conversation_id)
-        if self.request.user not in conversation.participants.all():
-            raise PermissionDenied('You are not a participant of this conversation')
-        return conversation
-    
     @swagger_auto_schema(
         operation_summary="List messages",
-        operation_description="List all messages for a conversation",
+        operation_description="List messages of a conversation using keyset pagination over (timestamp, id). "
+                              "Without a cursor the newest page is returned.",
+        manual_parameters=[
+            openapi.Parameter('before', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description='Cursor: return messages older than this one'),
+            openapi.Parameter('after', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description='Cursor: return messages newer than this one'),
+            openapi.Parameter('page_size', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Messages per page (capped at 200)'),
+        ],
         tags=['Messages']
     )
     def get(self, request, *args, **kwargs):
@@ -186,9 +395,11 @@ class MessageListCreateView(generics.ListCreateAPIView):
 
     @swagger_auto_schema(
         operation_summary="Send message",
-        operation_description="Send a new message in a conversation",
+        operation_description="Send a new message in a conversation. An optional `client_id` (unique per "
+                              "sender and conversation) makes retries safe: a repeated one returns the stored "
+                              "message with 200.",
         request_body=CreateMessageSerializer,
-        responses={201: MessageSerializer},
+        responses={201: MessageSerializer, 200: MessageSerializer},
         tags=['Messages']
     )
     def post(self, request, *args, **kwargs):
@@ -196,6 +407,263 @@ class MessageListCreateView(generics.ListCreateAPIView):
 
 
 
+class AsyncMessageListCreateView(View):
+    """
+    The message list and send endpoints as an async view, at
+    ``conversations/<id>/messages/async/``: same parameters, bodies and
+    responses as ``MessageListCreateView``. The request stays on the event
+    loop and its database work goes through ``chartapp.data``, so it does
+    not hold a thread while it waits.
+    """
+    read_from_replica = True
+    pagination_class = MessageCursorPagination
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # authenticated by token like the DRF views, which are csrf exempt too
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def authenticate(self, request):
+        for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+            result = await data.run(authenticator().authenticate, request)
+            if result is not None:
+                return result[0]
+        raise NotAuthenticated()
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            self.user = await self.authenticate(request)
+            return await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            # the same bodies DRF's exception handler produces
+            payload = exc.detail if isinstance(exc.detail, (dict, list)) else {'detail': exc.detail}
+            return JsonResponse(payload, status=exc.status_code, safe=False)
+
+    async def get_conversation(self, conversation_id):
+        conversation, members = await data.get_conversation_members(conversation_id)
+        if conversation is None:
+            raise NotFound('No Conversation matches the given query.')
+        if self.user.id not in members:
+            raise PermissionDenied('You are not a participant of this conversation')
+        return conversation
+
+    async def get(self, request, conversation_id):
+        self.conversation = await self.get_conversation(conversation_id)
+        paginator = self.pagination_class()
+        rows = self.conversation.messages.values(*CompactMessageSerializer.values_fields)
+        page = await data.run(paginator.paginate_queryset, rows, Request(request), self)
+        return JsonResponse({
+            'conversation': self.conversation.id,
+            'participants': await data.run(page_users, self.conversation, page),
+            **paginator.get_paginated_response(CompactMessageSerializer.to_rows(page)).data,
+        })
+
+    async def post(self, request, conversation_id):
+        conversation = await self.get_conversation(conversation_id)
+        try:
+            body = json.loads(request.body or b'{}')
+        except ValueError:
+            raise ParseError()
+        serializer = MessageContentSerializer(data=body)
+        serializer.is_valid(raise_exception=True)
+        message, created = await data.create_message(
+            conversation, self.user, serializer.validated_data['content'], serializer.validated_data.get('client_id')
+        )
+        # the participants are not prefetched (groups can be large): serialize off the event loop
+        payload = await data.run(lambda: MessageSerializer(message).data)
+        return JsonResponse(payload, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+
+class EventListenerView(View):
+    """
+    Base of the HTTP event endpoints (see ``chartapp.events``). Clients
+    authenticate like sockets, with an access token in the ``Authorization``
+    header or in ``?token=`` (EventSource cannot set headers), checked
+    through the WebSocket token cache so a poll costs no query for it.
+
+    Query parameters: ``conversations`` (comma separated ids, default all
+    of the user's) and ``last_id``, the last message id the client saw.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def authenticate(self, request):
+        from rest_framework_simplejwt.settings import api_settings as jwt_settings
+        header = request.headers.get('Authorization', '').split()
+        if len(header) == 2 and header[0] in jwt_settings.AUTH_HEADER_TYPES:
+            token = header[1]
+        else:
+            token = request.GET.get('token')
+        user, close_code = await ws_auth.get_token_cache().authenticate(token)
+        if user is None:
+            if close_code == 4002:
+                raise NotAuthenticated()
+            raise AuthenticationFailed('Token is invalid or expired')
+        return user
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            self.user = await self.authenticate(request)
+            return await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            payload = exc.detail if isinstance(exc.detail, (dict, list)) else {'detail': exc.detail}
+            return JsonResponse(payload, status=exc.status_code, safe=False)
+
+    def get_listener(self, request):
+        conversations = request.GET.get('conversations')
+        try:
+            conversation_ids = [int(value) for value in conversations.split(',')] if conversations else None
+            last_id = request.GET.get('last_id', request.headers.get('Last-Event-ID'))
+            last_id = int(last_id) if last_id not in (None, '') else None
+        except ValueError:
+            raise ParseError('conversations and last_id must be integers')
+        if last_id is not None and last_id < 0:
+            raise ParseError('last_id must not be negative')
+        options = events.get_options()
+        listener = events.EventListener(
+            self.user, buffer=options['BUFFER'], max_catch_up=options['MAX_CATCH_UP'],
+            max_conversations=options['MAX_CONVERSATIONS'],
+        )
+        return listener, conversation_ids, last_id
+
+
+class EventStreamView(EventListenerView):
+    """
+    Server-Sent Events for the user's conversations, at ``events/stream/``:
+    a ``subscribed`` event, then the frames a ``ws/user/`` socket would get,
+    one ``data:`` line each. Chat messages carry their id as the event id,
+    so a reconnecting EventSource resumes by itself (``Last-Event-ID``).
+    An idle stream sends a comment every ``KEEPALIVE`` seconds, which keeps
+    proxies from closing it and the user online. A client that falls
+    ``BUFFER`` frames behind is disconnected and resumes.
+    """
+
+    async def get(self, request):
+        listener, conversation_ids, last_id = self.get_listener(request)
+        try:
+            await listener.open(conversation_ids, last_id, presence=True)
+        except BaseException:
+            await listener.close()
+            raise
+        response = StreamingHttpResponse(self.stream(listener), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # nginx: pass events through as they come
+        return response
+
+    async def stream(self, listener):
+        keepalive = events.get_options()['KEEPALIVE']
+        metrics.event_listeners.inc(transport='sse')
+        try:
+            subscribed = {
+                'type': 'subscribed',
+                'conversations': sorted(listener.conversation_ids),
+                'last_id': listener.start_id,
+            }
+            yield f'retry: 3000\nid: {listener.start_id}\ndata: {json.dumps(subscribed)}\n\n'
+            while True:
+                if not await listener.wait(keepalive):
+                    await listener.refresh_presence()
+                    yield ': keepalive\n\n'
+                    continue
+                chunks = []
+                for frame, message_id in listener.take():
+                    if message_id is not None:
+                        chunks.append(f'id: {message_id}\n')
+                    chunks.append(f'data: {frame}\n\n')
+                yield ''.join(chunks)
+                if listener.overflowed:
+                    return # the client reconnects and resumes from its last event id
+                await listener.refresh_presence()
+        finally:
+            metrics.event_listeners.dec(transport='sse')
+            await listener.close()
+
+
+class EventPollView(EventListenerView):
+    """
+    Long polling for the user's conversations, at ``events/poll/``. Answers
+    as soon as there are events, or after ``timeout`` seconds (at most
+    ``POLL_TIMEOUT``), with ``{"events": [...], "last_id": N}``; send
+    ``last_id`` with the next poll. Typing and presence events between
+    polls are not kept; messages are, and the next poll catches up on them.
+    """
+
+    async def get(self, request):
+        listener, conversation_ids, last_id = self.get_listener(request)
+        poll_timeout = events.get_options()['POLL_TIMEOUT']
+        try:
+            timeout = min(max(float(request.GET.get('timeout', poll_timeout)), 0), poll_timeout)
+        except ValueError:
+            raise ParseError('timeout must be a number of seconds')
+        metrics.event_listeners.inc(transport='poll')
+        try:
+            await listener.open(conversation_ids, last_id)
+            await listener.wait(timeout)
+            frames = listener.take()
+        finally:
+            metrics.event_listeners.dec(transport='poll')
+            await listener.close()
+        # frames are already encoded JSON objects
+        body = '{"events":[%s],"last_id":%d}' % (','.join(frame for frame, message_id in frames), listener.last_id)
+        return HttpResponse(body, content_type='application/json')
+
+
+class MessageDeltaView(ConversationMemberMixin, generics.GenericAPIView):
+    """
+    Messages after a sequence number, oldest first: what a client missed
+    while it was offline. ``last_seq`` is the newest sequence number in
+    the conversation; call again from the last returned seq while
+    ``has_more`` is true.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = CompactMessageSerializer
+    default_limit = 200
+    max_limit = 500
+
+    @swagger_auto_schema(
+        operation_summary="Messages since a sequence number",
+        operation_description="Return the messages with seq greater than `since`, in order. "
+                              "Used to catch up after a reconnect instead of reloading the history.",
+        manual_parameters=[
+            openapi.Parameter('since', openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=True,
+                              description='Last seq the client has'),
+            openapi.Parameter('limit', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Messages to return (capped at 500)'),
+        ],
+        tags=['Messages']
+    )
+    def get(self, request, conversation_id, *args, **kwargs):
+        try:
+            since = int(request.query_params.get('since', ''))
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            return Response({'error': 'since and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        if since < 0 or limit < 1:
+            return Response({'error': 'since or limit out of range'}, status=status.HTTP_400_BAD_REQUEST)
+
+        conversation = self.get_conversation(conversation_id)
+        rows = []
+        if since < conversation.archived_seq:
+            # the start of the range has been moved to archive segments
+            rows = archive.read_after_seq(conversation.id, since, limit + 1)
+            since = conversation.archived_seq
+        if len(rows) <= limit:
+            # a range scan on the (conversation, seq) unique index
+            rows += list(conversation.messages
+                         .filter(seq__gt=since)
+                         .order_by('seq')
+                         .values(*CompactMessageSerializer.values_fields)[:limit + 1 - len(rows)])
+        return Response({
+            'conversation': conversation.id,
+            'participants': page_users(conversation, rows[:limit]),
+            'last_seq': conversation.last_seq,
+            'has_more': len(rows) > limit,
+            'results': CompactMessageSerializer.to_rows(rows[:limit]),
+        })
+
+
 class MessageRetrieveDestroyView(generics.RetrieveDestroyAPIView):
     """
     retrieve:
@@ -203,6 +671,7 @@ class MessageRetrieveDestroyView(generics.RetrieveDestroyAPIView):
 
     destroy:
     Delete a message if the request user is the sender.
+    Archived messages can be retrieved but not deleted.
     """
 
     permission_classes = [IsAuthenticated]
@@ -213,7 +682,22 @@ class MessageRetrieveDestroyView(generics.RetrieveDestroyAPIView):
         if getattr(self, 'swagger_fake_view', False):
             return Message.objects.none()
         conversation_id = self.kwargs['conversation_id']
-        return Message.objects.filter(conversation__id=conversation_id)
+        return (Message.objects
+                .filter(conversation__id=conversation_id)
+                # direct participants are read by the serializer; a group's are not listed
+                .select_related('sender', 'conversation'))
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            if self.request.method != 'GET':
+                raise
+            # not in the message table: it may have been archived
+            row = archive.get_message(self.kwargs['conversation_id'], self.kwargs['pk'])
+            if row is None:
+                raise
+            return Message(conversation_id=self.kwargs['conversation_id'], **row)
 
     def perform_destroy(self, instance):
         if instance.sender != self.request.user:
@@ -238,3 +722,370 @@ class MessageRetrieveDestroyView(generics.RetrieveDestroyAPIView):
     )
     def delete(self, request, *args, **kwargs):
         return super().delete(request, *args, **kwargs)
+
+
+
+class InboxView(generics.ListAPIView):
+    """
+    The logged-in user's conversations ordered by recent activity, each with
+    its last message preview and the user's unread count. Groups come
+    without their participants (null).
+    """
+    read_from_replica = True
+    serializer_class = InboxSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = InboxCursorPagination
+
+    def get_queryset(self):
+        # one indexed range scan over ParticipantState, plus one prefetch for direct participants' names
+        return (ParticipantState.objects
+                .filter(user=self.request.user)
+                .select_related('conversation', 'conversation__last_message_sender'))
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        prefetch_direct_participants([state.conversation for state in page])
+        return page
+
+    @swagger_auto_schema(
+        operation_summary="Inbox",
+        operation_description="List the user's conversations by recent activity with last message "
+                              "previews and unread counts (keyset paginated, newest first)",
+        manual_parameters=[
+            openapi.Parameter('before', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description='Cursor: conversations with older activity'),
+            openapi.Parameter('after', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description='Cursor: conversations with newer activity'),
+            openapi.Parameter('page_size', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Conversations per page (capped at 100)'),
+        ],
+        tags=['Conversations']
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+
+class MarkReadView(generics.GenericAPIView):
+    """
+    Move the user's read watermark in a conversation forward.
+    """
+    serializer_class = MarkReadSerializer
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_summary="Mark conversation read",
+        operation_description="Mark messages up to `message` (default: the newest) as read",
+        request_body=MarkReadSerializer,
+        responses={200: 'Updated unread count and watermarks', 400: 'Message of another conversation',
+                   404: 'Not a participant'},
+        tags=['Conversations']
+    )
+    def post(self, request, conversation_id, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            state = inbox.mark_read(request.user.id, conversation_id, serializer.validated_data.get('message'))
+        except inbox.ForeignMessage:
+            return Response({'error': 'Message is not in this conversation'}, status=status.HTTP_400_BAD_REQUEST)
+        if state is None:
+            return Response({'error': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
+        # the other members' sockets get it as a receipts event
+        receipts.announce(state)
+        return Response({
+            'id': conversation_id,
+            'unread_count': state.unread_count,
+            'delivered_watermark': state.delivered_watermark,
+            'read_watermark': state.read_watermark,
+        })
+
+
+class ConversationMembersView(ConversationMemberMixin, generics.GenericAPIView):
+    """
+    get:
+    List a conversation's members and their roles, by user id.
+
+    post:
+    Add users to a group. Owners and admins can add members; only the
+    owner can add admins.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = AddMembersSerializer
+    pagination_class = MemberPagination
+
+    @swagger_auto_schema(
+        operation_summary="List members",
+        operation_description="List the members of a conversation with their roles (keyset paginated by user id)",
+        manual_parameters=[
+            openapi.Parameter('after', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description='Cursor: members after this one'),
+            openapi.Parameter('page_size', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Members per page (capped at 1000)'),
+        ],
+        responses={200: MemberSerializer(many=True), 403: 'Not a participant'},
+        tags=['Conversations']
+    )
+    def get(self, request, conversation_id, *args, **kwargs):
+        conversation = self.get_conversation(conversation_id)
+        rows = (ParticipantState.objects
+                .filter(conversation=conversation)
+                .values(*MemberSerializer.values_fields))
+        page = self.paginate_queryset(rows)
+        return self.get_paginated_response(MemberSerializer(page, many=True).data)
+
+    @swagger_auto_schema(
+        operation_summary="Add members",
+        operation_description="Add users to a group conversation. Users who are already members are skipped.",
+        request_body=AddMembersSerializer,
+        responses={
+            201: UserListSerializer(many=True),
+            400: 'Not a group, unknown users or too many members',
+            403: 'Not an owner or admin of the group'
+        },
+        tags=['Conversations']
+    )
+    def post(self, request, conversation_id, *args, **kwargs):
+        conversation = self.get_conversation(conversation_id)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        role = serializer.validated_data['role']
+        if not conversation.is_group:
+            return Response({'error': 'Members can only be added to groups'}, status=status.HTTP_400_BAD_REQUEST)
+        caller_role = self.members.role(request.user.id)
+        if caller_role not in (ParticipantState.OWNER, ParticipantState.ADMIN):
+            return Response({'error': 'Only owners and admins can add members'}, status=status.HTTP_403_FORBIDDEN)
+        if role == ParticipantState.ADMIN and caller_role != ParticipantState.OWNER:
+            return Response({'error': 'Only the owner can add admins'}, status=status.HTTP_403_FORBIDDEN)
+
+        user_ids = set(serializer.validated_data['users'])
+        users = list(User.objects.filter(id__in=user_ids).only('id', 'username'))
+        if len(users) != len(user_ids):
+            return Response({'error': 'Some users do not exist'}, status=status.HTTP_400_BAD_REQUEST)
+        max_members = membership.get_options()['MAX_MEMBERS']
+        if len(user_ids - set(self.members)) + len(self.members) > max_members:
+            return Response({'error': f'A group can have at most {max_members} members'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        added = membership.add_members(conversation, users, role)
+        return Response(UserListSerializer(added, many=True).data, status=status.HTTP_201_CREATED)
+
+
+class ConversationMemberView(ConversationMemberMixin, generics.GenericAPIView):
+    """
+    partial_update:
+    Change a member's role. Only the owner can; making someone else the
+    owner hands ownership over.
+
+    destroy:
+    Remove a member from a group. Anyone can leave; admins can remove
+    members and the owner can remove anyone. The owner has to hand
+    ownership over before leaving a group that still has other members.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = MemberRoleSerializer
+
+    def get_member(self, conversation_id, user_id):
+        conversation = self.get_conversation(conversation_id)
+        if not conversation.is_group:
+            raise serializers.ValidationError({'error': 'Only group members can be changed'})
+        if user_id not in self.members:
+            raise NotFound('Not a member of this conversation')
+        return conversation, get_object_or_404(User.objects.only('id', 'username'), id=user_id)
+
+    @swagger_auto_schema(
+        operation_summary="Change a member's role",
+        operation_description="Set the role of a group member (owner only)",
+        request_body=MemberRoleSerializer,
+        responses={200: MemberSerializer, 400: 'Not a group', 403: 'Not the owner', 404: 'Not a member'},
+        tags=['Conversations']
+    )
+    def patch(self, request, conversation_id, user_id, *args, **kwargs):
+        conversation, user = self.get_member(conversation_id, user_id)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        role = serializer.validated_data['role']
+        if self.members.role(request.user.id) != ParticipantState.OWNER:
+            return Response({'error': 'Only the owner can change roles'}, status=status.HTTP_403_FORBIDDEN)
+        if user.id == request.user.id and role != ParticipantState.OWNER:
+            return Response({'error': 'Make another member the owner instead'}, status=status.HTTP_400_BAD_REQUEST)
+
+        membership.set_role(conversation, user, role)
+        return Response({'id': user.id, 'username': user.username, 'role': role})
+
+    @swagger_auto_schema(
+        operation_summary="Remove a member",
+        operation_description="Remove a member from a group, or leave it",
+        responses={204: 'Removed', 400: 'Not a group, or the owner leaving', 403: 'Not allowed', 404: 'Not a member'},
+        tags=['Conversations']
+    )
+    def delete(self, request, conversation_id, user_id, *args, **kwargs):
+        conversation, user = self.get_member(conversation_id, user_id)
+        caller_role = self.members.role(request.user.id)
+        target_role = self.members.role(user.id)
+        if user.id == request.user.id:
+            if caller_role == ParticipantState.OWNER and len(self.members) > 1:
+                return Response({'error': 'Make another member the owner before leaving'},
+                                status=status.HTTP_400_BAD_REQUEST)
+        elif not (caller_role == ParticipantState.OWNER
+                  or (caller_role == ParticipantState.ADMIN and target_role == ParticipantState.MEMBER)):
+            return Response({'error': 'You cannot remove this member'}, status=status.HTTP_403_FORBIDDEN)
+
+        membership.remove_member(conversation, user)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class MessageSearchView(APIView):
+    """
+    Full-text search over the messages of the logged-in user's conversations,
+    best match first, with highlighted snippets.
+    """
+    read_from_replica = True
+    permission_classes = [IsAuthenticated]
+    max_limit = 50
+    max_offset = 1000
+
+    @swagger_auto_schema(
+        operation_summary="Search messages",
+        operation_description="Ranked full-text search over the user's conversations. Every word must "
+                              "match (as a prefix); matches are wrapped in <mark> in `snippet`.",
+        manual_parameters=[
+            openapi.Parameter('q', openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True,
+                              description='Search text'),
+            openapi.Parameter('conversation', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Limit the search to one conversation'),
+            openapi.Parameter('limit', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Results per page (capped at 50)'),
+            openapi.Parameter('offset', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='Results to skip (at most 1000)'),
+        ],
+        tags=['Messages']
+    )
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'error': 'The q parameter is required'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            conversation_id = request.query_params.get('conversation')
+            conversation_id = int(conversation_id) if conversation_id else None
+            limit = min(int(request.query_params.get('limit', 20)), self.max_limit)
+            offset = int(request.query_params.get('offset', 0))
+        except ValueError:
+            return Response({'error': 'conversation, limit and offset must be integers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1 or not 0 <= offset <= self.max_offset:
+            return Response({'error': 'limit or offset out of range'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            backend = get_search_backend()
+        except SearchNotSupported as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_501_NOT_IMPLEMENTED)
+        hits = backend.search(request.user.id, query, conversation_id, limit + 1, offset)
+
+        # one extra row tells us whether there is a next page
+        has_next = len(hits) > limit
+        hits = hits[:limit]
+        messages = Message.objects.select_related('sender').in_bulk([message_id for message_id, _, _ in hits])
+        results = [
+            {
+                'id': message_id,
+                'conversation': messages[message_id].conversation_id,
+                'sender': UserListSerializer(messages[message_id].sender).data,
+                'timestamp': serializers.DateTimeField().to_representation(messages[message_id].timestamp),
+                'snippet': snippet,
+                'rank': rank,
+            }
+            for message_id, snippet, rank in hits
+            if message_id in messages
+        ]
+
+        url = request.build_absolute_uri()
+        next_link = previous_link = None
+        if has_next and offset + limit <= self.max_offset:
+            next_link = replace_query_param(url, 'offset', offset + limit)
+        if offset > 0:
+            previous_link = replace_query_param(url, 'offset', max(offset - limit, 0))
+        return Response({'next': next_link, 'previous': previous_link, 'results': results})
+
+
+class HistoryExportMixin:
+    encoding_parameter = openapi.Parameter(
+        'encoding', openapi.IN_QUERY, type=openapi.TYPE_STRING, enum=list(history.CODECS),
+        description='ndjson (default) or msgpack'
+    )
+
+    def stream_history(self, conversations, filename):
+        # `format` is taken by DRF content negotiation, hence `encoding`
+        codec = history.CODECS.get(self.request.query_params.get('encoding', 'ndjson'))
+        if codec is None:
+            return Response({'error': f'encoding must be one of {", ".join(history.CODECS)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # an async iterator: under ASGI a sync one would be read whole into memory first
+        response = StreamingHttpResponse(history.aencode_export(conversations, codec), content_type=codec.content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}.{codec.extension}"'
+        return response
+
+
+class ConversationExportView(HistoryExportMixin, ConversationMemberMixin, APIView):
+    """
+    Download the full history of a conversation, archived messages included.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_summary="Export a conversation",
+        operation_description="Stream a conversation record followed by every message in seq order, "
+                              "as NDJSON lines or consecutive MessagePack maps.",
+        manual_parameters=[HistoryExportMixin.encoding_parameter],
+        responses={200: 'Export stream'},
+        tags=['Messages']
+    )
+    def get(self, request, conversation_id, *args, **kwargs):
+        conversation = self.get_conversation(conversation_id)
+        return self.stream_history([conversation], f'conversation-{conversation.id}')
+
+
+class UserExportView(HistoryExportMixin, APIView):
+    """
+    Download the history of every conversation of the current user.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_summary="Export all my conversations",
+        operation_description="Stream every conversation of the current user, each one's record followed "
+                              "by its messages, as NDJSON lines or consecutive MessagePack maps.",
+        manual_parameters=[HistoryExportMixin.encoding_parameter],
+        responses={200: 'Export stream'},
+        tags=['Messages']
+    )
+    def get(self, request, *args, **kwargs):
+        conversations = Conversation.objects.filter(participants=request.user).order_by('id')
+        return self.stream_history(conversations, f'history-{request.user.username}')
+
+
+class CanScrapeMetrics(permissions.BasePermission):
+    """
+    Staff users, scrapers sending ``Authorization: Metrics <CHAT_METRICS['TOKEN']>``
+    and clients from ``CHAT_METRICS['ALLOWED_IPS']``. Nobody else, so with
+    neither setting only staff can read the metrics.
+    """
+
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+        options = getattr(settings, 'CHAT_METRICS', {})
+        token = options.get('TOKEN')
+        header = request.headers.get('Authorization', '').split()
+        if token and len(header) == 2 and header[0] == 'Metrics' and hmac.compare_digest(header[1], token):
+            return True
+        return request.META.get('REMOTE_ADDR') in options.get('ALLOWED_IPS', ())
+
+
+class MetricsView(APIView):
+    """
+    Prometheus text exposition of this worker's metrics.
+    """
+    permission_classes = [CanScrapeMetrics]
+
+    @swagger_auto_schema(auto_schema=None)
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.registry.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
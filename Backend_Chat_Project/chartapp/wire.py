@@ -0,0 +1,99 @@
+import json
+import uuid
+from collections import OrderedDict
+
+import msgpack
+
+
+class JSONCodec:
+    """UTF-8 JSON text frames; what clients get when they ask for nothing."""
+    subprotocol = 'chat.json'
+    binary = False
+
+    def encode(self, payload):
+        return json.dumps(payload, separators=(',', ':'))
+
+
+class MsgpackCodec:
+    """MessagePack binary frames, roughly a third smaller than JSON for chat events."""
+    subprotocol = 'chat.msgpack'
+    binary = True
+
+    def encode(self, payload):
+        return msgpack.packb(payload, use_bin_type=True)
+
+
+CODECS = {codec.subprotocol: codec for codec in (JSONCodec(), MsgpackCodec())}
+DEFAULT_CODEC = CODECS['chat.json']
+
+
+def negotiate(requested):
+    """
+    Pick the first subprotocol the client offered (``Sec-WebSocket-Protocol``)
+    that the server speaks. Returns ``(codec, subprotocol)``; ``subprotocol``
+    is None when the client offered nothing usable, which means plain JSON
+    and no protocol echoed back.
+    """
+    for subprotocol in requested:
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec, subprotocol
+    return DEFAULT_CODEC, None
+
+
+class MalformedFrame(ValueError):
+    """A client frame that does not decode to a map."""
+
+
+def decode_frame(text_data=None, bytes_data=None):
+    # the frame type says how it is encoded, whatever was negotiated
+    try:
+        if bytes_data is not None:
+            frame = msgpack.unpackb(bytes_data, raw=False)
+        else:
+            frame = json.loads(text_data)
+    except (ValueError, TypeError, msgpack.exceptions.UnpackException) as exc:
+        raise MalformedFrame(str(exc)) from exc
+    if not isinstance(frame, dict):
+        raise MalformedFrame(f'expected a map, got {type(frame).__name__}')
+    return frame
+
+
+def new_event_id():
+    return uuid.uuid4().hex
+
+
+class FrameCache:
+    """
+    Encoded frames of recent group events, keyed by ``(event_id, codec)``.
+
+    Every socket in a group receives its own copy of a group event, so
+    without this each recipient would encode the same payload again. The
+    first recipient in a worker process encodes it and the rest reuse the
+    bytes. Entries are only needed while one fan-out is being delivered,
+    so a small LRU is enough.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, codec, payload, event_id=None):
+        if event_id is None:
+            return codec.encode(payload)
+        key = (event_id, codec.subprotocol)
+        frame = self.frames.get(key)
+        if frame is not None:
+            self.hits += 1
+            self.frames.move_to_end(key)
+            return frame
+        self.misses += 1
+        frame = self.frames[key] = codec.encode(payload)
+        if len(self.frames) > self.max_size:
+            self.frames.popitem(last=False)
+        return frame
+
+
+frame_cache = FrameCache()
@@ -0,0 +1,150 @@
+"""
+JWT authentication for WebSocket handshakes.
+
+``JWTAuthMiddleware`` reads the access token from the ``?token=`` query
+parameter and puts the user in ``scope['user']`` before any consumer runs.
+It replaces Channels' ``AuthMiddlewareStack``, whose session and cookie
+lookups the chat sockets never used.
+
+Signature, expiry and token type are checked on every handshake; that is
+CPU work measured in microseconds. What costs a query, loading the user and
+checking the simplejwt blacklist, is cached per worker in a ``TokenCache``
+keyed by the token id (``jti``) for ``CACHE_TTL`` seconds, never past the
+token's expiry. A reconnect storm with tokens seen before costs no query at
+all; a token blacklisted or a user deactivated meanwhile is refused once
+its entry expires.
+
+A failed handshake leaves ``scope['user']`` anonymous and sets
+``scope['auth_close_code']``: 4000 for an expired token, 4001 for an invalid
+or revoked one, 4002 when there is no token.
+"""
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import data, metrics
+
+
+def get_options():
+    options = getattr(settings, 'CHAT_WS_AUTH', {})
+    return {
+        'CACHE_SIZE': options.get('CACHE_SIZE', 10000),
+        'CACHE_TTL': options.get('CACHE_TTL', 60),
+    }
+
+
+def token_from_scope(scope):
+    params = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+    return params.get('token', [None])[0]
+
+
+def load_user(user_id, jti):
+    """The active user a token names, or None if it is unknown, inactive or the token is blacklisted."""
+    from django.contrib.auth import get_user_model
+    from rest_framework_simplejwt.settings import api_settings
+
+    if 'rest_framework_simplejwt.token_blacklist' in settings.INSTALLED_APPS:
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+        if BlacklistedToken.objects.filter(token__jti=jti).exists():
+            return None
+    User = get_user_model()
+    user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+    if user is None or (api_settings.CHECK_USER_IS_ACTIVE and not user.is_active):
+        return None
+    return user
+
+
+class TokenCache:
+    """
+    Users of recently verified tokens by ``jti``, least recently used first.
+    Refused tokens are cached too (as None), so retrying a revoked token
+    does not reach the database either.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # jti -> (user or None, expires_at)
+        self.lock = threading.Lock()
+
+    def get(self, jti, now):
+        with self.lock:
+            entry = self.entries.get(jti)
+            if entry is None:
+                return False, None
+            if entry[1] <= now:
+                del self.entries[jti]
+                return False, None
+            self.entries.move_to_end(jti)
+            return True, entry[0]
+
+    def set(self, jti, user, expires_at):
+        with self.lock:
+            self.entries[jti] = (user, expires_at)
+            self.entries.move_to_end(jti)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    async def authenticate(self, token):
+        """``(user, None)`` for a valid access token, else ``(None, close code)``."""
+        from rest_framework_simplejwt.exceptions import TokenBackendError, TokenBackendExpiredToken
+        from rest_framework_simplejwt.settings import api_settings
+        from rest_framework_simplejwt.state import token_backend
+
+        if not token:
+            return None, 4002
+        try:
+            payload = token_backend.decode(token)
+        except TokenBackendExpiredToken:
+            return None, 4000
+        except TokenBackendError:
+            return None, 4001
+        jti = payload.get(api_settings.JTI_CLAIM)
+        user_id = payload.get(api_settings.USER_ID_CLAIM)
+        if payload.get(api_settings.TOKEN_TYPE_CLAIM) != 'access' or jti is None or user_id is None:
+            return None, 4001
+
+        now = time.time()
+        found, user = self.get(jti, now)
+        metrics.ws_auth_cache.inc(result='hit' if found else 'miss')
+        if not found:
+            user = await data.run(load_user, user_id, jti)
+            self.set(jti, user, min(now + self.ttl, payload.get('exp', now)))
+        if user is None:
+            return None, 4001
+        return user, None
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """Sets ``scope['user']`` from the handshake's ``?token=`` (see the module docstring)."""
+
+    async def __call__(self, scope, receive, send):
+        from django.contrib.auth.models import AnonymousUser
+
+        user, close_code = await get_token_cache().authenticate(token_from_scope(scope))
+        scope = dict(scope, user=user or AnonymousUser(), auth_close_code=close_code)
+        return await super().__call__(scope, receive, send)
+
+
+_token_cache = None
+
+
+def get_token_cache():
+    global _token_cache
+    if _token_cache is None:
+        options = get_options()
+        _token_cache = TokenCache(max_size=options['CACHE_SIZE'], ttl=options['CACHE_TTL'])
+    return _token_cache
+
+
+@receiver(setting_changed)
+def reset_token_cache(setting, **kwargs):
+    global _token_cache
+    if setting in ('CHAT_WS_AUTH', 'SIMPLE_JWT', 'INSTALLED_APPS'):
+        _token_cache = None
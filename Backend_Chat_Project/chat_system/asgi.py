@@ -11,14 +11,20 @@ import os
 
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_system.settings')
+# initialise Django before importing consumers (they import models)
+django_asgi_app = get_asgi_application()
+
+from chartapp.lifespan import lifespan_app
+from chartapp.ws_auth import JWTAuthMiddleware
 from chartapp.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter({
-    'http': get_asgi_application(),
-    'websocket': AuthMiddlewareStack(
+    'http': django_asgi_app,
+    'lifespan': lifespan_app,
+    # sockets authenticate with a JWT in the query string, verified once per handshake
+    'websocket': JWTAuthMiddleware(
         URLRouter(websocket_urlpatterns)
     ),
 })
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -54,6 +55,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chartapp.metrics.MetricsMiddleware',
+    'chartapp.routers.ReadYourWritesMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -88,12 +91,69 @@ ASGI_APPLICATION = "chat_system.asgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+#
+# Read from the environment, so one node and a primary with read replicas
+# run the same code:
+#   DB_ENGINE        sqlite (default), postgresql or mysql
+#   DB_NAME          database name, or the file for SQLite
+#   DB_USER, DB_PASSWORD, DB_HOST, DB_PORT   server databases only
+#   DB_REPLICAS      comma separated replica hosts (replica files for SQLite);
+#                    see chartapp.routers for what reads from them
+#   DB_CONN_MAX_AGE  seconds a connection is reused, 0 to close it after each request
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+
+# applied to every new SQLite connection
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # readers and the writer no longer block each other
+    'synchronous': 'NORMAL',  # fsync at checkpoints instead of every commit; durable with WAL
+    'cache_size': -32000,  # page cache per connection, in KiB when negative
+    'mmap_size': 256 * 1024 * 1024,  # read pages through a memory map
+    'busy_timeout': 5000,  # ms to wait for the write lock before "database is locked"
+    'temp_store': 'MEMORY',
+}
+
+if DB_ENGINE == 'sqlite':
+    PRIMARY_DATABASE = {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('DB_NAME', BASE_DIR / 'db.sqlite3'),
+        'OPTIONS': {
+            # take the write lock at BEGIN: a transaction that read first can
+            # otherwise fail with "database is locked" when it starts writing
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': ';'.join(f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items()),
+        },
     }
-}
+else:
+    PRIMARY_DATABASE = {
+        'ENGINE': f'django.db.backends.{DB_ENGINE}',
+        'NAME': os.environ.get('DB_NAME', 'chat'),
+        'USER': os.environ.get('DB_USER', ''),
+        'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+        'HOST': os.environ.get('DB_HOST', ''),
+        'PORT': os.environ.get('DB_PORT', ''),
+    }
+PRIMARY_DATABASE.update({
+    'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+    # reused connections are checked before each request instead of failing mid-request
+    'CONN_HEALTH_CHECKS': True,
+})
+
+DATABASES = {'default': PRIMARY_DATABASE}
+for number, replica in enumerate(filter(None, os.environ.get('DB_REPLICAS', '').split(',')), 1):
+    if DB_ENGINE == 'sqlite':
+        # a read-only copy (e.g. LiteFS or Litestream); it must not try to switch journal modes
+        DATABASES[f'replica_{number}'] = dict(PRIMARY_DATABASE, NAME=replica.strip(), OPTIONS={
+            'init_command': 'PRAGMA query_only=ON;' + ';'.join(
+                f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items() if name != 'journal_mode'
+            ),
+        })
+    else:
+        DATABASES[f'replica_{number}'] = dict(PRIMARY_DATABASE, HOST=replica.strip())
+    # tests run against the primary's test database
+    DATABASES[f'replica_{number}']['TEST'] = {'MIRROR': 'default'}
+
+DATABASE_ROUTERS = ['chartapp.routers.PrimaryReplicaRouter']
 
 
 # Password validation
@@ -169,6 +229,141 @@ CHANNEL_LAYERS = {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
             "hosts": [("127.0.0.1", 6379)],   
+            # the fan-out relay channel carries the events of every conversation in its worker
+            "channel_capacity": {"chat-relay*": 100000},
         },
     },
 }
+
+# Member versions, the user directory and read-your-writes pins live in the
+# cache, and every worker process must see the same one: set CACHE_URL (e.g.
+# redis://127.0.0.1:6379/1) when running more than one. Without it the cache
+# is per process, and membership is read from the database on every check.
+CACHE_URL = os.environ.get('CACHE_URL')
+if CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_URL,
+        },
+    }
+
+
+# Chat message persistence: 'sync' stores every message before it is broadcast,
+# 'write_behind' broadcasts first and inserts messages in batches per worker.
+# Buffered messages are flushed on SIGTERM and at exit (daphne has no ASGI
+# lifespan); a killed worker loses them, so 'sync' stays the default.
+CHAT_MESSAGE_PERSISTENCE = 'sync'
+CHAT_WRITE_BEHIND = {
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.05,  # seconds
+    'MAX_PENDING': 10000,
+}
+
+# Online presence. BACKEND defaults to Redis when the channel layer is
+# channels_redis and to a process-local registry otherwise.
+CHAT_PRESENCE = {
+    'TTL': 60,  # seconds a socket stays online without a heartbeat
+    'COALESCE_WINDOW': 0.25,  # seconds of presence changes merged into one diff
+    'SNAPSHOT_LIMIT': 200,  # online users listed to a joining socket (None: all)
+}
+
+# Typing indicators: keystroke frames are coalesced into start/stop events.
+CHAT_TYPING = {
+    'TIMEOUT': 3.0,  # seconds without a keystroke before 'stopped typing' is sent
+    'MIN_INTERVAL': 0.5,  # keystroke frames closer together than this are dropped
+}
+
+# User directory (users/directory/): serialized pages are cached for
+# CACHE_TIMEOUT seconds and dropped whenever a user is added or changed.
+# Use a shared cache backend when running more than one worker.
+CHAT_USER_DIRECTORY = {
+    'CACHE_TIMEOUT': 300,  # seconds
+}
+
+# Message archival (manage.py archive_messages): messages older than AGE_DAYS
+# move from the message table into compressed per-conversation segment files.
+CHAT_ARCHIVE = {
+    'ROOT': BASE_DIR / 'message_archive',
+    'AGE_DAYS': 180,
+    'BLOCK_SIZE': 256,  # messages per compressed block
+    'SEGMENT_BYTES': 64 * 1024 * 1024,  # start a new segment file past this size
+}
+
+# Database access from consumers and async views (chartapp.data).
+# MODE 'pool' runs queries on MAX_WORKERS threads with a connection each;
+# 'async_orm' and 'sync_to_async' share one thread per worker process.
+CHAT_DB_EXECUTOR = {
+    'MODE': 'pool',
+    'MAX_WORKERS': 16,  # keep below the database's connection limit per worker
+}
+
+# Read replicas (DB_REPLICAS): after a client writes, its reads stay on the
+# primary for STICKY_SECONDS so replication lag never hides its own writes.
+CHAT_DB_ROUTING = {
+    'STICKY_SECONDS': 5,
+}
+
+# WebSocket flow control (chartapp.flow_control). Client frames draw from
+# token buckets per socket and per user: RATE frames per second, bursts of
+# BURST (USER_* for all of a user's sockets in one worker).
+CHAT_FLOW_CONTROL = {
+    'LIMITS': {
+        'chat': {'RATE': 2, 'BURST': 10, 'USER_RATE': 4, 'USER_BURST': 20},
+        'typing': {'RATE': 10, 'BURST': 20, 'USER_RATE': 20, 'USER_BURST': 40},
+        'ack': {'RATE': 20, 'BURST': 100, 'USER_RATE': 40, 'USER_BURST': 200},
+        'subscribe': {'RATE': 50, 'BURST': 500, 'USER_RATE': 100, 'USER_BURST': 1000},
+        'other': {'RATE': 10, 'BURST': 30, 'USER_RATE': 20, 'USER_BURST': 60},
+    },
+    'DISCONNECT_AFTER': 200,  # frames dropped within DISCONNECT_WINDOW seconds before the socket is closed (4008)
+    'DISCONNECT_WINDOW': 10,
+    'MAX_FRAME_BYTES': 64 * 1024,  # larger client frames close the socket (1009)
+    'OUTBOUND_BUFFER': 1024,  # frames queued per socket for a slow client
+    'OUTBOUND_OVERFLOW': 'disconnect',  # or 'drop'; typing and presence frames are dropped first either way
+}
+
+# Group conversations (chartapp.membership). Members and roles are cached per
+# worker for up to CACHED_CONVERSATIONS conversations.
+CHAT_GROUPS = {
+    'MAX_MEMBERS': 10000,
+    'CACHED_CONVERSATIONS': 10000,
+}
+
+# How group events reach sockets (chartapp.fanout): 'relay' sends one copy per
+# worker process and delivers it locally, 'group' one copy per socket.
+CHAT_FANOUT = {
+    'STRATEGY': 'relay',
+    'GROUP_REFRESH': 3600,  # seconds between the relay's group re-joins; under group_expiry
+}
+
+# Delivery and read receipts (chartapp.receipts): acks from sockets are merged
+# per member and written, then broadcast, once every FLUSH_INTERVAL seconds.
+CHAT_RECEIPTS = {
+    'FLUSH_INTERVAL': 0.5,
+    'MAX_PENDING': 10000,  # members with unwritten acks before an early flush
+}
+
+# WebSocket handshakes (chartapp.ws_auth): users of verified tokens are cached
+# by token id, so a blacklisted token or deactivated user is refused within
+# CACHE_TTL seconds.
+CHAT_WS_AUTH = {
+    'CACHE_SIZE': 10000,
+    'CACHE_TTL': 60,
+}
+
+# HTTP fallback for clients that cannot use WebSockets (chartapp.events):
+# Server-Sent Events at /chat/events/stream/, long polling at /chat/events/poll/.
+CHAT_EVENTS = {
+    'POLL_TIMEOUT': 25,  # longest a poll waits for events, in seconds
+    'KEEPALIVE': 15,  # seconds between comments on an idle event stream
+    'BUFFER': 1024,  # frames queued per listener before it is cut off to resume
+    'MAX_CATCH_UP': 500,  # missed messages sent on resume; beyond that resync_required
+    'MAX_CONVERSATIONS': 500,  # conversations one listener follows
+}
+
+# Who may read /chat/metrics/ besides staff users: a scraper sending
+# 'Authorization: Metrics <TOKEN>', or these client addresses.
+CHAT_METRICS = {
+    'TOKEN': os.environ.get('CHAT_METRICS_TOKEN'),
+    'ALLOWED_IPS': [],
+}
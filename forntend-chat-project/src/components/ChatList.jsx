@@ -8,6 +8,7 @@ import { ACCESS_TOKEN } from "../token";
 const ChatList = () => {
   const [conversations, setConversations] = useState([]);
   const [users, setUsers] = useState([]);
+  const [userQuery, setUserQuery] = useState("");
   const [selectedUser, setSelectedUser] = useState(null);
   const [currentUserId, setCurrentUserId] = useState(null);
   const [activeConversation, setActiveConversation] = useState(null);
@@ -22,11 +23,9 @@ const ChatList = () => {
           setCurrentUserId(decodedToken.user_id);
         }
 
-        const userResponse = await api.get("users/");
-        setUsers(userResponse.data);
-
-        const conversationResponse = await api.get("conversations/");
-        setConversations(conversationResponse.data);
+        // inbox entries carry participants (null for groups), last message preview and unread count
+        const inboxResponse = await api.get("inbox/");
+        setConversations(inboxResponse.data.results);
       } catch (error) {
         console.error("Error initializing data:", error);
       }
@@ -35,13 +34,32 @@ const ChatList = () => {
     initializeData();
   }, []);
 
+  useEffect(() => {
+    // the directory is searched by username prefix, one small page at a time
+    const timer = setTimeout(async () => {
+      try {
+        const userResponse = await api.get("users/directory/", {
+          params: { q: userQuery.trim() || undefined, page_size: 20 },
+        });
+        setUsers(userResponse.data.results);
+      } catch (error) {
+        console.error("Error loading users:", error);
+      }
+    }, 250);
+    return () => clearTimeout(timer);
+  }, [userQuery]);
+
   const handleStartConversation = async () => {
     if (selectedUser && currentUserId) {
-      const participants = [selectedUser, currentUserId];
       try {
-        const response = await api.post("conversations/", { participants });
-        setConversations([...conversations, response.data]);
-        setActiveConversation(response.data);
+        // returns the existing conversation with this user (200) or a new one (201)
+        const response = await api.post(`conversations/with/${selectedUser}/`);
+        if (response.status === 201) {
+          setConversations([response.data, ...conversations]);
+        }
+        setActiveConversation(
+          conversations.find((conversation) => conversation.id === response.data.id) || response.data
+        );
         setErrorMessage("");
       } catch (error) {
         if (error.response?.data?.error) {
@@ -69,11 +87,17 @@ const ChatList = () => {
           <p>Connect with your friends instantly!</p>
         </header>
         <div className="user-selector">
+          <input
+            type="text"
+            placeholder="Search users"
+            value={userQuery}
+            onChange={(e) => setUserQuery(e.target.value)}
+          />
           <select onChange={(e) => setSelectedUser(e.target.value)} value={selectedUser || ""}>
             <option value="" disabled>
               Select a user to chat with
             </option>
-            {users.map((user) => (
+            {users.filter((user) => user.id !== currentUserId).map((user) => (
               <option key={user.id} value={user.id}>
                 {user.username}
               </option>
@@ -91,11 +115,18 @@ const ChatList = () => {
               onClick={() => handleSelectConversation(conversation)}
             >
               <p>
-                {conversation.participants
-                  .filter((user) => user.id !== currentUserId)
-                  .map((user) => user.username)
-                  .join(", ")}
+                {/* groups come without their (possibly long) member list */}
+                {conversation.is_group
+                  ? conversation.name || "Group"
+                  : (conversation.participants || [])
+                      .filter((user) => user.id !== currentUserId)
+                      .map((user) => user.username)
+                      .join(", ")}
+                {conversation.unread_count > 0 && ` (${conversation.unread_count})`}
               </p>
+              {conversation.last_message && (
+                <small>{conversation.last_message.preview}</small>
+              )}
             </div>
           ))}
         </div>
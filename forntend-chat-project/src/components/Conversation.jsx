@@ -23,18 +23,22 @@ const Conversation = ({ conversationId, currentUserId, onBack }) => {
       try {
         setLoading(true);
         const response = await api.get(`/conversations/${conversationId}/messages/`);
-        const messages = response.data || [];
+        // history is cursor-paginated: the first page holds the newest messages.
+        // Each message names its sender by id; `participants` names them once per page
+        // (both users of a direct conversation, only the page's senders in a group).
+        const participants = response.data?.participants || [];
+        const participantsById = Object.fromEntries(participants.map((user) => [user.id, user]));
+        const messages = (response.data?.results || []).map((message) => ({
+          ...message,
+          sender: participantsById[message.sender] || { id: message.sender },
+        }));
         setMessages(messages);
 
-        if (messages.length > 0) {
-          const participants = messages[0]?.participants || [];
-          const chatPartner = participants.find((user) => user.id !== currentUserId);
-
-          if (chatPartner) {
-            setChatPartner(chatPartner);
-          } else {
-            console.error("No valid chat partner found");
-          }
+        const chatPartner = participants.find((user) => user.id !== currentUserId);
+        if (chatPartner) {
+          setChatPartner(chatPartner);
+        } else {
+          console.error("No valid chat partner found");
         }
       } catch (error) {
         console.error("Error fetching conversation data:", error);
@@ -61,30 +65,43 @@ const Conversation = ({ conversationId, currentUserId, onBack }) => {
         const data = JSON.parse(event.data);
 
         if (data.type === "chat_message") {
-          const { message, user, timestamp } = data;
+          const { id, seq, message, user, timestamp } = data;
           setMessages((prevMessages) => [
             ...prevMessages,
-            { sender: user, content: message, timestamp },
+            { id, seq, sender: user, content: message, timestamp },
           ]);
           setTypingUser(null);
         } else if (data.type === "typing") {
-          const { user, receiver } = data;
+          const { user, receiver, is_typing } = data;
 
           if (typingTimeoutRef.current) {
             clearTimeout(typingTimeoutRef.current);
+            typingTimeoutRef.current = null;
           }
 
           // Only show typing indicator if the current user is the receiver
           if (receiver === currentUserId && user.id !== currentUserId) {
-            setTypingUser(user);
-            // Set new timeout and store the reference
-            typingTimeoutRef.current = setTimeout(() => {
+            if (is_typing) {
+              setTypingUser(user);
+              // the server sends is_typing: false when typing stops; this is only a safety net
+              typingTimeoutRef.current = setTimeout(() => {
+                setTypingUser(null);
+                typingTimeoutRef.current = null;
+              }, 10000);
+            } else {
               setTypingUser(null);
-              typingTimeoutRef.current = null;
-            }, 2000);
+            }
           }
         } else if (data.type === "online_status") {
-          if (data.status === "online") {
+          if (data.status === "snapshot") {
+            setOnlineUsers(data.online_users);
+          } else if (data.status === "diff") {
+            setOnlineUsers((prev) => {
+              const changed = [...data.online_users, ...data.offline_users];
+              const unchanged = prev.filter((user) => !changed.some((u) => u.id === user.id));
+              return [...unchanged, ...data.online_users];
+            });
+          } else if (data.status === "online") {
             setOnlineUsers((prev) => [...prev, ...data.online_users]);
           } else if (data.status === "offline") {
             setOnlineUsers((prev) =>
@@ -101,9 +118,17 @@ const Conversation = ({ conversationId, currentUserId, onBack }) => {
       console.error("WebSocket Error:", error);
     };
 
+    // keeps our presence alive on the server (sockets expire after 60s of silence)
+    const heartbeat = setInterval(() => {
+      if (websocket.readyState === WebSocket.OPEN) {
+        websocket.send(JSON.stringify({ type: "heartbeat" }));
+      }
+    }, 20000);
+
     setSocket(websocket);
 
     return () => {
+      clearInterval(heartbeat);
       if (typingTimeoutRef.current) {
         clearTimeout(typingTimeoutRef.current);
       }